@@ -10,22 +10,27 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 import os
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack # For user authentication in WebSockets
-import groupchat.routing # Import the routing from your app
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'bookhaven.settings')
 
 # Get the default Django ASGI application to handle HTTP requests
+# (this also sets up Django, so it must run before importing app routing)
 django_asgi_app = get_asgi_application()
 
+import groupchat.routing # Import the routing from your app
+from groupchat.admission import AdmissionMiddleware # Sheds handshakes while the worker is overloaded
+from groupchat.middleware import CachedAuthMiddlewareStack # AuthMiddlewareStack with cached, timed user resolution
+
 application = ProtocolTypeRouter({
     # Django's ASGI application to handle traditional HTTP requests
     "http": django_asgi_app,
 
     # WebSocket chat handler
-    "websocket": AuthMiddlewareStack( # Wrap with AuthMiddlewareStack to access request.user
-        URLRouter(
-            groupchat.routing.websocket_urlpatterns
+    "websocket": AdmissionMiddleware(
+        CachedAuthMiddlewareStack( # Wrap with the auth stack to access request.user
+            URLRouter(
+                groupchat.routing.websocket_urlpatterns
+            )
         )
     ),
 })
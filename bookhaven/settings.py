@@ -163,11 +163,162 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # ASGI & Channels settings
 ASGI_APPLICATION = 'bookhaven.asgi.application'
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
-    },
+# Set CHANNEL_REDIS_HOSTS to a comma-separated list of redis:// URLs to run several
+# daphne workers. channels_redis consistent-hashes each chat_<group_id> group (and
+# each worker's channels) onto one of the hosts, so rooms are sharded across them.
+CHANNEL_REDIS_HOSTS = [host.strip() for host in os.getenv('CHANNEL_REDIS_HOSTS', '').split(',') if host.strip()]
+
+if CHANNEL_REDIS_HOSTS:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": CHANNEL_REDIS_HOSTS,
+                "capacity": int(os.getenv('CHANNEL_LAYER_CAPACITY', '1500')),
+                "expiry": int(os.getenv('CHANNEL_LAYER_EXPIRY', '10')), # seconds
+            },
+        },
+    }
+else:
+    # Single-process development mode.
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
+
+# A shared cache keeps membership and handshake auth invalidation consistent across workers.
+if os.getenv('CACHE_REDIS_URL'):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.getenv('CACHE_REDIS_URL'),
+        },
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            # Room for a membership flag, session and user per connected member (Django's default is 300 entries).
+            "OPTIONS": {"MAX_ENTRIES": int(os.getenv('CACHE_LOCMEM_MAX_ENTRIES', '10000'))},
+        },
+    }
+
+# permessage-deflate for chat WebSockets; applied when serving through `python -m groupchat.server`.
+GROUPCHAT_PERMESSAGE_DEFLATE = os.getenv('GROUPCHAT_PERMESSAGE_DEFLATE', 'False') == 'True'
+GROUPCHAT_DEFLATE_NO_CONTEXT_TAKEOVER = os.getenv('GROUPCHAT_DEFLATE_NO_CONTEXT_TAKEOVER', 'True') == 'True'
+
+# Distinct per daphne worker (0-63) so in-process message ids do not collide; required for write-behind.
+GROUPCHAT_WORKER_ID = int(os.getenv('GROUPCHAT_WORKER_ID')) if os.getenv('GROUPCHAT_WORKER_ID') else None
+
+# Group chat persistence: write-behind mode broadcasts messages immediately and
+# stores them in bulk_create batches (see groupchat/persistence.py).
+GROUPCHAT_WRITE_BEHIND = os.getenv('GROUPCHAT_WRITE_BEHIND', 'False') == 'True'
+GROUPCHAT_WRITE_BEHIND_BATCH_SIZE = int(os.getenv('GROUPCHAT_WRITE_BEHIND_BATCH_SIZE', '64'))
+GROUPCHAT_WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv('GROUPCHAT_WRITE_BEHIND_FLUSH_INTERVAL', '0.05')) # seconds
+
+# Chunked file uploads over the chat WebSocket (see groupchat/uploads.py).
+GROUPCHAT_UPLOAD_MAX_SIZE = int(os.getenv('GROUPCHAT_UPLOAD_MAX_SIZE', str(256 * 1024 * 1024))) # bytes
+GROUPCHAT_UPLOAD_CHUNK_SIZE = int(os.getenv('GROUPCHAT_UPLOAD_CHUNK_SIZE', str(256 * 1024))) # bytes per chunk frame
+GROUPCHAT_UPLOAD_WINDOW = int(os.getenv('GROUPCHAT_UPLOAD_WINDOW', '4')) # unacknowledged chunks per upload
+GROUPCHAT_UPLOAD_TEMP_DIR = os.getenv('GROUPCHAT_UPLOAD_TEMP_DIR') # shared by all workers so uploads can resume on any of them
+GROUPCHAT_UPLOAD_USER_QUOTA = int(os.getenv('GROUPCHAT_UPLOAD_USER_QUOTA', str(512 * 1024 * 1024))) # bytes of unfinished uploads per user
+GROUPCHAT_UPLOAD_EXPIRY = int(os.getenv('GROUPCHAT_UPLOAD_EXPIRY', '3600')) # seconds an unfinished upload is kept untouched
+
+# Presence and typing indicators (see groupchat/presence.py); rosters live in the default cache.
+GROUPCHAT_PRESENCE_TICK = float(os.getenv('GROUPCHAT_PRESENCE_TICK', '1.0')) # seconds between merged presence broadcasts
+GROUPCHAT_PRESENCE_TIMEOUT = float(os.getenv('GROUPCHAT_PRESENCE_TIMEOUT', '60')) # seconds without a heartbeat before going offline
+GROUPCHAT_PRESENCE_HEARTBEAT = float(os.getenv('GROUPCHAT_PRESENCE_HEARTBEAT', '25')) # client heartbeat interval
+GROUPCHAT_TYPING_INTERVAL = float(os.getenv('GROUPCHAT_TYPING_INTERVAL', '3')) # min seconds between typing entries per user
+
+# Cached session and user resolution for chat WebSocket handshakes (see groupchat/middleware.py); 0 disables it.
+GROUPCHAT_AUTH_CACHE_TIMEOUT = int(os.getenv('GROUPCHAT_AUTH_CACHE_TIMEOUT', '60')) # seconds
+
+# Multiplexed chat connections at ws/chat/ (see groupchat/consumers.py): one socket per user for all their groups.
+GROUPCHAT_MUX_MAX_SUBSCRIPTIONS = int(os.getenv('GROUPCHAT_MUX_MAX_SUBSCRIPTIONS', '50')) # groups per connection
+GROUPCHAT_MUX_MAX_CONNECTIONS = int(os.getenv('GROUPCHAT_MUX_MAX_CONNECTIONS', '5')) # per user and worker; the oldest is closed
+
+# Chat connection admission control per worker (see groupchat/admission.py); 0 disables a limit.
+GROUPCHAT_ADMISSION_MAX_CONNECTIONS = int(os.getenv('GROUPCHAT_ADMISSION_MAX_CONNECTIONS', '10000')) # sockets per worker
+GROUPCHAT_ADMISSION_MAX_USER_CONNECTIONS = int(os.getenv('GROUPCHAT_ADMISSION_MAX_USER_CONNECTIONS', '20')) # sockets per user and worker
+GROUPCHAT_ADMISSION_MAX_GROUP_CONNECTIONS = int(os.getenv('GROUPCHAT_ADMISSION_MAX_GROUP_CONNECTIONS', '5000')) # sockets per group and worker
+GROUPCHAT_ADMISSION_MAX_HANDSHAKES = int(os.getenv('GROUPCHAT_ADMISSION_MAX_HANDSHAKES', '100')) # in progress; shed above it
+GROUPCHAT_ADMISSION_MAX_LOOP_LAG = float(os.getenv('GROUPCHAT_ADMISSION_MAX_LOOP_LAG', '0.5')) # seconds; shed handshakes above it
+GROUPCHAT_ADMISSION_MAX_EXECUTOR_QUEUE = int(os.getenv('GROUPCHAT_ADMISSION_MAX_EXECUTOR_QUEUE', '200')) # waiting sync calls; shed above it
+GROUPCHAT_ADMISSION_RETRY_AFTER = int(os.getenv('GROUPCHAT_ADMISSION_RETRY_AFTER', '5')) # seconds refused clients wait
+
+# Graceful drain of chat connections when `python -m groupchat.server` stops (see groupchat/drain.py).
+GROUPCHAT_DRAIN_WINDOW = float(os.getenv('GROUPCHAT_DRAIN_WINDOW', '20')) # seconds over which clients reconnect
+GROUPCHAT_DRAIN_TIMEOUT = float(os.getenv('GROUPCHAT_DRAIN_TIMEOUT', '30')) # seconds before the rest are closed
+
+# Room-affinity routing of chat rooms to worker pools (see groupchat/affinity.py). Pools are "name=address" lists,
+# the address a ws(s):// origin or a path prefix the front proxy routes to the pool, e.g. "a=/chat-a,b=/chat-b".
+GROUPCHAT_AFFINITY_POOLS = dict(pool.split('=', 1) for pool in os.getenv('GROUPCHAT_AFFINITY_POOLS', '').split(',') if pool)
+GROUPCHAT_AFFINITY_DEDICATED_POOLS = dict(pool.split('=', 1) for pool in os.getenv('GROUPCHAT_AFFINITY_DEDICATED_POOLS', '').split(',') if pool)
+GROUPCHAT_AFFINITY_POOL = os.getenv('GROUPCHAT_AFFINITY_POOL', '') # this worker's pool; empty serves every room
+GROUPCHAT_AFFINITY_PINS = { # "group_id=pool,..." pinned permanently
+    int(group_id): pool for group_id, pool in (pin.split('=', 1) for pin in os.getenv('GROUPCHAT_AFFINITY_PINS', '').split(',') if pin)
 }
+GROUPCHAT_AFFINITY_HOT_RATE = float(os.getenv('GROUPCHAT_AFFINITY_HOT_RATE', '20')) # room messages/sec; pinned to a dedicated pool above it
+GROUPCHAT_AFFINITY_PIN_TTL = float(os.getenv('GROUPCHAT_AFFINITY_PIN_TTL', '600')) # seconds an automatic pin lasts unless renewed
+GROUPCHAT_AFFINITY_REPORT_INTERVAL = float(os.getenv('GROUPCHAT_AFFINITY_REPORT_INTERVAL', '5')) # seconds between room load reports
+GROUPCHAT_AFFINITY_MOVE_WINDOW = float(os.getenv('GROUPCHAT_AFFINITY_MOVE_WINDOW', '10')) # seconds over which a moved room's sockets reconnect
+
+# Chat message rate limits per worker (see groupchat/ratelimit.py); a rate of 0 disables the limit.
+GROUPCHAT_USER_MESSAGE_RATE = float(os.getenv('GROUPCHAT_USER_MESSAGE_RATE', '5')) # messages/sec per user
+GROUPCHAT_USER_MESSAGE_BURST = int(os.getenv('GROUPCHAT_USER_MESSAGE_BURST', '10'))
+GROUPCHAT_ROOM_MESSAGE_RATE = float(os.getenv('GROUPCHAT_ROOM_MESSAGE_RATE', '50')) # messages/sec per room
+GROUPCHAT_ROOM_MESSAGE_BURST = int(os.getenv('GROUPCHAT_ROOM_MESSAGE_BURST', '100'))
+
+# Per-connection outbound queue (see groupchat/outbound.py): drop_oldest, coalesce or disconnect when full.
+GROUPCHAT_OUTBOUND_QUEUE_SIZE = int(os.getenv('GROUPCHAT_OUTBOUND_QUEUE_SIZE', '256')) # frames
+GROUPCHAT_OUTBOUND_POLICY = os.getenv('GROUPCHAT_OUTBOUND_POLICY', 'coalesce')
+
+# Tick-based batching of busy rooms' messages (see groupchat/batching.py); clients opt in to array frames with ?batch=1.
+GROUPCHAT_BATCH_MESSAGES = os.getenv('GROUPCHAT_BATCH_MESSAGES', 'False') == 'True'
+GROUPCHAT_BATCH_MIN_RATE = float(os.getenv('GROUPCHAT_BATCH_MIN_RATE', '10')) # room messages/sec before batching starts
+GROUPCHAT_BATCH_TARGET = int(os.getenv('GROUPCHAT_BATCH_TARGET', '4')) # messages per batch the window is sized for
+GROUPCHAT_BATCH_MAX_WINDOW = float(os.getenv('GROUPCHAT_BATCH_MAX_WINDOW', '0.05')) # seconds
+GROUPCHAT_BATCH_MAX_MESSAGES = int(os.getenv('GROUPCHAT_BATCH_MAX_MESSAGES', '32'))
+
+# Chat attachment downloads (see groupchat/attachments.py): '' streams from Django, or hand the bytes
+# to the front proxy with 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache, lighttpd).
+GROUPCHAT_ATTACHMENT_SENDFILE = os.getenv('GROUPCHAT_ATTACHMENT_SENDFILE', '')
+GROUPCHAT_ATTACHMENT_ACCEL_PREFIX = os.getenv('GROUPCHAT_ATTACHMENT_ACCEL_PREFIX', '/protected-media/') # nginx internal location of MEDIA_ROOT
+
+# Deduplicated chat attachment storage (see groupchat/storage.py): each distinct file is stored once
+# under GROUPCHAT_BLOB_DIR and hard-linked to its attachment names.
+GROUPCHAT_ATTACHMENT_DEDUP = os.getenv('GROUPCHAT_ATTACHMENT_DEDUP', 'True') == 'True'
+GROUPCHAT_BLOB_DIR = os.getenv('GROUPCHAT_BLOB_DIR', 'group_chat_blobs') # relative to MEDIA_ROOT
+
+# Image derivatives (see content/derivatives.py): thumbnails and previews of chat image attachments
+# and book covers, rendered by a process pool and cached under MEDIA_ROOT/IMAGE_DERIVATIVE_DIR.
+IMAGE_DERIVATIVE_DIR = os.getenv('IMAGE_DERIVATIVE_DIR', 'derivatives')
+IMAGE_DERIVATIVE_WORKERS = int(os.getenv('IMAGE_DERIVATIVE_WORKERS', '2'))
+
+# Chat archival (see groupchat/archive.py; run `manage.py chat_archive`, or with --loop as a worker).
+# Whole months older than the horizon move to compressed segments; an empty horizon disables archival.
+GROUPCHAT_ARCHIVE_AFTER_DAYS = int(os.getenv('GROUPCHAT_ARCHIVE_AFTER_DAYS', '365')) if os.getenv('GROUPCHAT_ARCHIVE_AFTER_DAYS', '365') else None # per-group override: DiscussionGroup.chat_archive_days
+GROUPCHAT_ARCHIVE_SEGMENT_SIZE = int(os.getenv('GROUPCHAT_ARCHIVE_SEGMENT_SIZE', '2000')) # messages per segment
+GROUPCHAT_ARCHIVE_DELETE_CHUNK = int(os.getenv('GROUPCHAT_ARCHIVE_DELETE_CHUNK', '500')) # hot-table rows deleted per transaction
+GROUPCHAT_ARCHIVE_DELETE_PAUSE = float(os.getenv('GROUPCHAT_ARCHIVE_DELETE_PAUSE', '0.05')) # seconds between delete transactions
+GROUPCHAT_ARCHIVE_INTERVAL = float(os.getenv('GROUPCHAT_ARCHIVE_INTERVAL', '3600')) # seconds between runs with --loop
+
+# Chat read watermarks and unread badges (see groupchat/unread.py).
+GROUPCHAT_READ_FLUSH_INTERVAL = float(os.getenv('GROUPCHAT_READ_FLUSH_INTERVAL', '5')) # seconds between batched watermark writes
+GROUPCHAT_UNREAD_CAP = int(os.getenv('GROUPCHAT_UNREAD_CAP', '99')) # badges show "99+" beyond this
+
+# Opt-in chat traffic capture for `manage.py chat_replay` (see groupchat/recorder.py); off unless a directory is set.
+GROUPCHAT_RECORD_DIR = os.getenv('GROUPCHAT_RECORD_DIR')
+GROUPCHAT_RECORD_SAMPLE_RATE = float(os.getenv('GROUPCHAT_RECORD_SAMPLE_RATE', '1.0')) # fraction of connections recorded
+GROUPCHAT_RECORD_REDACT = os.getenv('GROUPCHAT_RECORD_REDACT', 'True') == 'True' # keep message lengths, not texts
+
+# Chat hot-path instrumentation (see groupchat/metrics.py), served to staff and token holders at /groupchat/chat/metrics/.
+GROUPCHAT_METRICS_ENABLED = os.getenv('GROUPCHAT_METRICS_ENABLED', 'True') == 'True'
+GROUPCHAT_METRICS_SAMPLE_RATE = float(os.getenv('GROUPCHAT_METRICS_SAMPLE_RATE', '1.0'))
+GROUPCHAT_METRICS_STAGE_SAMPLE_RATES = {'send': float(os.getenv('GROUPCHAT_METRICS_SEND_SAMPLE_RATE', '0.1'))} # per-recipient sends dominate
+GROUPCHAT_METRICS_TOKEN = os.getenv('GROUPCHAT_METRICS_TOKEN') # scrapers send `Authorization: Bearer <token>`; staff need none
+GROUPCHAT_LOG_INTERVAL = float(os.getenv('GROUPCHAT_LOG_INTERVAL', '10')) # seconds between repeated hot-path warnings
 
 LOGGING = {
     'version': 1,
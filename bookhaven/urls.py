@@ -32,6 +32,7 @@ urlpatterns = [
     path('discussions/', include('discussions.urls', namespace='discussions')),
     path('search/', include('search_hub.urls', namespace='search_hub')),
     path('groupchat/', include('groupchat.urls', namespace='groupchat')),
+    path('content/', include('content.urls', namespace='content')),
     path('<str:username>/', include(('dashboard.urls', 'dashboard'), namespace='dashboard')),
     path('', include('homepage.urls', namespace='homepage')),
 ]
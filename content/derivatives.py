@@ -0,0 +1,227 @@
+"""
+Image derivatives (thumbnails and previews) rendered off the request path.
+
+Chat image attachments and book covers are shown at the sizes in
+`DERIVATIVE_SIZES` (longest edge, in pixels) rather than at full resolution.
+Rendering runs in a process pool of `IMAGE_DERIVATIVE_WORKERS` processes, so
+decoding and resampling neither block a request nor hold the server
+process's GIL. All sizes of a source are rendered in one job, largest first,
+each from the previous one.
+
+Derivatives are WebP files cached on disk, keyed by the source's SHA-256 and
+the pixel size:
+
+    <MEDIA_ROOT>/<IMAGE_DERIVATIVE_DIR>/3f/3f9a...e1-320.webp
+
+so identical sources (the same image attached in several groups) share their
+derivatives, and changing a size renders new files instead of serving stale
+ones. A source's digest is remembered per process by its device, inode, size
+and modification time, so finding a cached derivative costs a `stat()`.
+
+`schedule(path)` queues a source, e.g. when a chat attachment is stored.
+`derivative_path(path, size)` returns the cached derivative, or None after
+queuing the source (optionally waiting a moment for it), in which case the
+caller serves the original. Sources Pillow cannot read are remembered and
+not retried by the process.
+
+The worker function only needs Pillow, not Django: the pool starts its
+processes with 'spawn', which is safe in a threaded server but, as for any
+spawned pool, re-imports the main module, so scripts using this need an
+`if __name__ == '__main__':` guard (`manage.py`, daphne and gunicorn have one).
+
+Settings:
+    IMAGE_DERIVATIVE_DIR (str): Cache directory, relative to `MEDIA_ROOT`. Defaults to 'derivatives'.
+    IMAGE_DERIVATIVE_WORKERS (int): Rendering processes. Defaults to 2.
+"""
+import hashlib
+import logging
+import mimetypes
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from django.conf import settings
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+DERIVATIVE_SIZES = {'thumb': 320, 'preview': 1280}
+DERIVATIVE_FORMAT, DERIVATIVE_EXTENSION, DERIVATIVE_CONTENT_TYPE = 'WEBP', 'webp', 'image/webp'
+DERIVATIVE_QUALITY = 80
+RENDERABLE_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff'}
+HASH_BLOCK_SIZE = 1024 * 1024
+MAX_REMEMBERED = 10000 # source digests kept per process
+
+stats = {'scheduled': 0, 'rendered': 0, 'failed': 0, 'hits': 0, 'misses': 0}
+
+_lock = threading.RLock()
+_pool = None
+_pending = {} # source key -> Future
+_digests = OrderedDict() # source key -> digest, least recently used first
+_failed = set() # source keys Pillow could not render
+
+
+def cache_dir():
+    """Returns the absolute path of the derivative cache."""
+    return os.path.join(settings.MEDIA_ROOT, getattr(settings, 'IMAGE_DERIVATIVE_DIR', 'derivatives'))
+
+
+def cached_path(directory, digest, edge):
+    """Returns the path of the derivative of the source with this SHA-256 at `edge` pixels."""
+    return os.path.join(directory, digest[:2], f'{digest}-{edge}.{DERIVATIVE_EXTENSION}')
+
+
+def is_image(name):
+    """Returns True if a file name looks like an image derivatives can be rendered from."""
+    return mimetypes.guess_type(name)[0] in RENDERABLE_TYPES
+
+
+def render_derivatives(source, directory, edges):
+    """
+    Renders the missing derivatives of an image. Runs in a pool process.
+
+    Args:
+        source (str): Path of the image.
+        directory (str): The derivative cache directory.
+        edges (tuple): Longest edges to render, in pixels.
+
+    Returns:
+        str: The source's SHA-256 hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(source, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    digest = digest.hexdigest()
+
+    missing = [edge for edge in sorted(edges, reverse=True) if not os.path.exists(cached_path(directory, digest, edge))]
+    if not missing:
+        return digest
+    with Image.open(source) as image:
+        image.draft('RGB', (missing[0], missing[0])) # JPEG: decode at the smallest scale that still covers the size
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            has_alpha = image.mode in ('LA', 'PA') or 'transparency' in image.info
+            image = image.convert('RGBA' if has_alpha else 'RGB')
+        for edge in missing:
+            image.thumbnail((edge, edge), Image.Resampling.LANCZOS) # Never enlarges
+            path = cached_path(directory, digest, edge)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f'{path}.{os.getpid()}.tmp'
+            image.save(temp_path, DERIVATIVE_FORMAT, quality=DERIVATIVE_QUALITY)
+            os.replace(temp_path, path) # Readers never see a partial file
+    return digest
+
+
+def get_pool():
+    """Returns the rendering process pool, creating it on first use."""
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=getattr(settings, 'IMAGE_DERIVATIVE_WORKERS', 2),
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _pool
+
+
+def _source_key(path):
+    stat = os.stat(path)
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def schedule(path):
+    """
+    Queues rendering of all derivative sizes of an image, unless they are
+    known to exist, already queued, or the image could not be read before.
+
+    Args:
+        path (str): Absolute path of the image.
+    """
+    global _pool
+    try:
+        key = _source_key(path)
+    except OSError:
+        return
+    with _lock:
+        if key in _digests or key in _pending or key in _failed:
+            return
+        try:
+            future = get_pool().submit(render_derivatives, path, cache_dir(), tuple(DERIVATIVE_SIZES.values()))
+        except BrokenProcessPool as e: # A worker died; start a new pool next time
+            logger.error("Image derivative pool is broken: %s", e)
+            _pool = None
+            return
+        _pending[key] = future
+        stats['scheduled'] += 1
+    future.add_done_callback(partial(_rendered, key, path))
+
+
+def _rendered(key, path, future):
+    with _lock:
+        _pending.pop(key, None)
+        try:
+            digest = future.result()
+        except BrokenProcessPool as e: # A worker died; start a new pool for the next source
+            global _pool
+            _pool = None
+            logger.error("Image derivative pool is broken: %s", e)
+            return
+        except Exception as e:
+            _failed.add(key)
+            stats['failed'] += 1
+            logger.warning("Could not render image derivatives of %s: %s", path, e)
+            return
+        _digests[key] = digest
+        if len(_digests) > MAX_REMEMBERED:
+            _digests.popitem(last=False)
+        stats['rendered'] += 1
+
+
+def derivative_path(path, size, wait=0):
+    """
+    Returns the cached derivative of an image, queuing it when it is missing.
+
+    Args:
+        path (str): Absolute path of the image.
+        size (str): A key of `DERIVATIVE_SIZES`.
+        wait (float, optional): Seconds to wait for a queued rendering, e.g.
+            for an image that was uploaded a moment ago.
+
+    Returns:
+        str or None: Path of the derivative, or None if it is not rendered yet
+        (or cannot be); the caller should serve the original.
+    """
+    edge = DERIVATIVE_SIZES[size]
+    try:
+        key = _source_key(path)
+    except OSError:
+        return None
+    with _lock:
+        digest = _digests.get(key)
+        if digest:
+            _digests.move_to_end(key)
+    if digest:
+        cached = cached_path(cache_dir(), digest, edge)
+        if os.path.exists(cached):
+            stats['hits'] += 1
+            return cached
+        with _lock:
+            _digests.pop(key, None) # The cache was cleared; render again
+    stats['misses'] += 1
+    schedule(path)
+    if wait:
+        with _lock:
+            future = _pending.get(key)
+        try:
+            digest = future.result(timeout=wait) if future else None
+        except Exception: # Still rendering, or failed (logged by `_rendered`)
+            return None
+        cached = digest and cached_path(cache_dir(), digest, edge)
+        if cached and os.path.exists(cached):
+            return cached
+    return None
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 09:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='cover_image',
+            field=models.ImageField(blank=True, null=True, upload_to='book_covers/'),
+        ),
+    ]
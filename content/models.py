@@ -25,7 +25,7 @@ class Book(ContentItem):
     author = models.CharField(max_length=255)
     isbn = models.CharField(max_length=20, blank=True, null=True, unique=True)
     publication_year = models.PositiveIntegerField(blank=True, null=True)
-    # cover_image = models.ImageField(upload_to='book_covers/', blank=True, null=True)
+    cover_image = models.ImageField(upload_to='book_covers/', blank=True, null=True) # Shown as derivatives; see derivatives.py
 
 class Article(ContentItem):
     authors = models.CharField(max_length=500, blank=True)
@@ -1,3 +1,68 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import tempfile
+from concurrent.futures import Future
+from unittest import mock
 
-# Create your tests here.
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from PIL import Image
+
+from .derivatives import DERIVATIVE_SIZES, cached_path, render_derivatives
+from .models import Book
+
+
+def png(width, height):
+    """Returns the bytes of a PNG image of this size."""
+    output = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 40, 40)).save(output, 'PNG')
+    return output.getvalue()
+
+
+class RenderDerivativesTests(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_renders_every_size_without_enlarging(self):
+        source = os.path.join(self.directory, 'wide.png')
+        with open(source, 'wb') as f:
+            f.write(png(2000, 1000))
+        digest = render_derivatives(source, self.directory, tuple(DERIVATIVE_SIZES.values()) + (4000,))
+        for edge, expected in ((320, (320, 160)), (1280, (1280, 640)), (4000, (2000, 1000))):
+            with Image.open(cached_path(self.directory, digest, edge)) as derivative:
+                self.assertEqual((derivative.format, derivative.size), ('WEBP', expected))
+
+
+class BookCoverViewTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings_override = override_settings(MEDIA_ROOT=directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.cover = png(600, 900)
+        self.book = Book.objects.create(title='A Book', author='An Author')
+        self.book.cover_image.save('cover.png', ContentFile(self.cover))
+        self.url = reverse('content:book_cover', args=[self.book.id, 'thumb'])
+
+    def test_original_is_served_until_the_derivative_is_rendered(self):
+        rendering = Future()
+        pool = mock.Mock(submit=mock.Mock(return_value=rendering))
+        with mock.patch('content.derivatives.get_pool', return_value=pool):
+            response = self.client.get(self.url)
+            self.assertEqual((response.status_code, response['Cache-Control']), (200, 'no-cache'))
+            self.assertEqual(b''.join(response.streaming_content), self.cover)
+
+            source, directory, edges = pool.submit.call_args.args[1:]
+            rendering.set_result(render_derivatives(source, directory, edges))
+            response = self.client.get(self.url)
+        self.assertEqual(pool.submit.call_count, 1)
+        self.assertEqual(response['Cache-Control'], 'public, max-age=86400')
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as thumb:
+            self.assertEqual(thumb.size, (213, 320))
+        self.assertEqual(self.client.get(self.url, headers={'If-None-Match': response['ETag']}).status_code, 304)
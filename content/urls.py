@@ -0,0 +1,8 @@
+from django.urls import path
+from . import views
+
+app_name = 'content'
+
+urlpatterns = [
+    path('book/<int:book_id>/cover/<str:size>/', views.book_cover_view, name='book_cover'),
+]
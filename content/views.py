@@ -1,3 +1,40 @@
-from django.shortcuts import render
+"""
+Views for the content application.
 
-# Create your views here.
+Book covers are served at derivative sizes (see derivatives.py) rather than
+at their uploaded resolution.
+"""
+import os
+
+from django.http import FileResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response
+from django.views.decorators.http import require_safe
+from .derivatives import DERIVATIVE_SIZES, derivative_path
+from .models import Book
+
+COVER_MAX_AGE = 24 * 60 * 60 # seconds browsers may cache a cover derivative
+
+
+@require_safe
+def book_cover_view(request, book_id, size):
+    """
+    Serves a book's cover image scaled to `size` ('thumb' or 'preview').
+
+    The original is served, uncached, until the derivative has been rendered.
+    Derivatives are named by their content, which makes the name a strong ETag.
+    """
+    if size not in DERIVATIVE_SIZES:
+        raise Http404("Unknown cover size.")
+    book = get_object_or_404(Book.objects.only('id', 'cover_image'), id=book_id)
+    if not book.cover_image:
+        raise Http404("This book has no cover image.")
+    path = derivative_path(book.cover_image.path, size)
+    if path is None:
+        return FileResponse(book.cover_image.open('rb'), headers={'Cache-Control': 'no-cache'})
+
+    etag = '"%s"' % os.path.splitext(os.path.basename(path))[0]
+    response = get_conditional_response(request, etag=etag) or FileResponse(open(path, 'rb'))
+    response['ETag'] = etag
+    response['Cache-Control'] = f'public, max-age={COVER_MAX_AGE}'
+    return response
@@ -2,6 +2,7 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth import get_user_model
 from django.contrib.auth.decorators import login_required
 from discussions.models import DiscussionGroup
+from groupchat.unread import unread_badge, unread_counts
 
 User = get_user_model()
 
@@ -29,6 +30,12 @@ def dashboard_index(request, username):
     # This fetches DiscussionGroup instances directly
     joined_groups_not_created_by_user = request.user.discussion_groups_joined.exclude(creator=request.user).order_by('-created_at')
 
+    # One query for the unread badges of every group the user belongs to.
+    unread = unread_counts(request.user.id)
+    created_groups, joined_groups_not_created_by_user = list(created_groups), list(joined_groups_not_created_by_user)
+    for group in created_groups + joined_groups_not_created_by_user:
+        group.unread_badge = unread_badge(unread.get(group.id))
+
     context = {
         'dashboard_user': dashboard_user, # The user whose dashboard is being viewed
         'created_groups': created_groups,
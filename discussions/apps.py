@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class DiscussionsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'discussions'
+
+    def ready(self):
+        from . import signals  # noqa: F401  Registers the membership cache invalidation handlers.
@@ -0,0 +1,95 @@
+"""
+Cached membership checks for discussion groups.
+
+The (user, group) membership answer is read on every chat page load, every
+WebSocket connect and in search result templates. This module keeps that
+answer in Django's cache framework so repeated checks (e.g. a reconnect storm
+after a deploy) do not reach the database. Entries are invalidated by the
+`GroupMembership` save/delete signals in `discussions.signals`, so a revoked
+member is rejected on their very next check.
+
+Settings:
+    MEMBERSHIP_CACHE_ALIAS (str): Cache alias to use. Defaults to 'default'.
+    MEMBERSHIP_CACHE_TIMEOUT (int): Entry lifetime in seconds. Defaults to 300.
+"""
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from .models import GroupMembership
+
+_stats = Counter(hits=0, misses=0)
+
+
+def _cache():
+    return caches[getattr(settings, 'MEMBERSHIP_CACHE_ALIAS', 'default')]
+
+
+def _timeout():
+    return getattr(settings, 'MEMBERSHIP_CACHE_TIMEOUT', 300)
+
+
+def membership_cache_key(user_id, group_id):
+    """Returns the cache key holding the membership flag for (user, group)."""
+    return f'discussions:membership:{user_id}:{group_id}'
+
+
+def is_member(user_id, group_id):
+    """
+    Returns True if the user is a member of the group, consulting the cache first.
+
+    Args:
+        user_id (int): ID of the user.
+        group_id (int or str): ID of the discussion group.
+
+    Returns:
+        bool: The membership flag.
+    """
+    key = membership_cache_key(user_id, group_id)
+    cached = _cache().get(key)
+    if cached is not None:
+        _stats['hits'] += 1
+        return cached
+    _stats['misses'] += 1
+    member = GroupMembership.objects.filter(user_id=user_id, group_id=group_id).exists()
+    _cache().set(key, member, _timeout())
+    return member
+
+
+async def ais_member(user_id, group_id):
+    """Async counterpart of `is_member`, using the async cache and ORM APIs."""
+    key = membership_cache_key(user_id, group_id)
+    cached = await _cache().aget(key)
+    if cached is not None:
+        _stats['hits'] += 1
+        return cached
+    _stats['misses'] += 1
+    member = await GroupMembership.objects.filter(user_id=user_id, group_id=group_id).aexists()
+    await _cache().aset(key, member, _timeout())
+    return member
+
+
+def invalidate_membership(user_id, group_id):
+    """Drops the cached membership flag for (user, group)."""
+    _cache().delete(membership_cache_key(user_id, group_id))
+
+
+def membership_cache_stats():
+    """
+    Returns the in-process hit/miss counters.
+
+    Returns:
+        dict: 'hits', 'misses' and 'hit_ratio' (0.0 when nothing was checked yet).
+    """
+    total = _stats['hits'] + _stats['misses']
+    return {
+        'hits': _stats['hits'],
+        'misses': _stats['misses'],
+        'hit_ratio': round(_stats['hits'] / total, 4) if total else 0.0,
+    }
+
+
+def reset_membership_cache_stats():
+    """Resets the in-process hit/miss counters."""
+    _stats['hits'] = 0
+    _stats['misses'] = 0
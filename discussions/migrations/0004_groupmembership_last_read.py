@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-18 08:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0003_discussiongroup_unique_group_name_per_creator'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='groupmembership',
+            name='last_read',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='groupmembership',
+            name='last_read_message_id',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
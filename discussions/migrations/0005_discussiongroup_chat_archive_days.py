@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-18 09:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0004_groupmembership_last_read'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='discussiongroup',
+            name='chat_archive_days',
+            field=models.PositiveIntegerField(blank=True, help_text='Days after which chat messages move to the archive; empty for the site default.', null=True),
+        ),
+    ]
@@ -15,6 +15,8 @@ class DiscussionGroup(models.Model):
         members (ManyToManyField): Users who are members of this group, managed via GroupMembership.
         created_at (DateTimeField): Timestamp of when the group was created.
         is_private (BooleanField): Indicates if the group is private or public.
+        chat_archive_days (PositiveIntegerField): Age in days after which chat messages are
+            archived; GROUPCHAT_ARCHIVE_AFTER_DAYS when unset.
     """
     name = models.CharField(max_length=255)
     description = models.TextField(blank=True)
@@ -40,6 +42,11 @@ class DiscussionGroup(models.Model):
     )
     created_at = models.DateTimeField(auto_now_add=True)
     is_private = models.BooleanField(default=False)
+    chat_archive_days = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Days after which chat messages move to the archive; empty for the site default."
+    )
 
     class Meta:
         ordering = ['-created_at']
@@ -59,6 +66,9 @@ class GroupMembership(models.Model):
         group (ForeignKey): The discussion group the user is a member of.
         date_joined (DateTimeField): Timestamp of when the user joined the group.
         role (CharField): The role of the user in the group (e.g., 'admin', 'member').
+        last_read (DateTimeField): Timestamp of the last chat message the user has read.
+        last_read_message_id (BigIntegerField): ID of that message, the tie-breaker
+            for messages sharing its timestamp.
     """
     ROLE_ADMIN = 'admin'
     ROLE_MEMBER = 'member'
@@ -76,6 +86,9 @@ class GroupMembership(models.Model):
         default=ROLE_MEMBER,
         help_text="The role of the user in this group."
     )
+    # Chat read watermark, advanced in batches by groupchat.unread; unset means nothing read since joining.
+    last_read = models.DateTimeField(null=True, blank=True, editable=False)
+    last_read_message_id = models.BigIntegerField(null=True, blank=True, editable=False)
 
     class Meta:
         unique_together = ('user', 'group') # Ensure a user can only join a group once
@@ -0,0 +1,21 @@
+"""
+Signal handlers for the discussions application.
+
+Keeps the membership cache in `discussions.membership` consistent with the
+`GroupMembership` table.
+"""
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .membership import invalidate_membership
+from .models import GroupMembership
+
+
+@receiver(post_save, sender=GroupMembership)
+@receiver(post_delete, sender=GroupMembership)
+def invalidate_membership_cache(sender, instance, **kwargs):
+    """
+    Drops the cached membership flag once the change is committed, so a
+    concurrent check cannot re-populate the cache with the pre-change state.
+    """
+    transaction.on_commit(lambda: invalidate_membership(instance.user_id, instance.group_id))
@@ -1,5 +1,5 @@
 from django import template
-from discussions.models import GroupMembership
+from discussions.membership import is_member as cached_is_member
 
 register = template.Library()
 
@@ -8,4 +8,4 @@ def is_member(user, group):
     """Checks if a user is a member of a specific group."""
     if not user or not user.is_authenticated:
         return False
-    return GroupMembership.objects.filter(user=user, group=group).exists() 
\ No newline at end of file
+    return cached_is_member(user.id, group.id) 
\ No newline at end of file
@@ -1,3 +1,59 @@
+import datetime
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.test import TestCase
+from django.urls import reverse
+
+from content.models import ContentItem
+from .membership import is_member, membership_cache_stats, reset_membership_cache_stats
+from .models import DiscussionGroup, GroupMembership
+
+
+class MembershipCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        reset_membership_cache_stats()
+        self.user = get_user_model().objects.create_user(
+            username='reader', first_name='Rea', last_name='Der', password='secret',
+            date_of_birth=datetime.date(1990, 1, 1), email='reader@example.com',
+        )
+        self.group = DiscussionGroup.objects.create(
+            name='Readers', content_item=ContentItem.objects.create(title='A Book'), creator=self.user
+        )
+        self.membership = GroupMembership.objects.create(user=self.user, group=self.group)
+
+    def test_repeated_checks_hit_the_cache(self):
+        self.assertTrue(is_member(self.user.id, self.group.id))
+        with self.assertNumQueries(0):
+            self.assertTrue(is_member(self.user.id, self.group.id))
+        self.assertEqual(membership_cache_stats(), {'hits': 1, 'misses': 1, 'hit_ratio': 0.5})
+
+    def test_revoked_member_is_rejected_on_next_check(self):
+        self.assertTrue(is_member(self.user.id, self.group.id))
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.membership.delete()
+        self.assertEqual(len(callbacks), 1)
+        self.assertFalse(is_member(self.user.id, self.group.id))
+        self.assertEqual(membership_cache_stats()['misses'], 2)
+
+    def test_invalidation_waits_for_commit(self):
+        self.assertTrue(is_member(self.user.id, self.group.id))
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            self.membership.delete()
+            # Until the delete commits, other connections still see the member.
+            self.assertTrue(is_member(self.user.id, self.group.id))
+        callbacks[0]()
+        self.assertFalse(is_member(self.user.id, self.group.id))
 
-# Create your tests here.
+    def test_revoked_member_cannot_open_group_chat(self):
+        self.client.force_login(self.user)
+        url = reverse('groupchat:group_chat_view', args=[self.group.id])
+        self.assertTrue(is_member(self.user.id, self.group.id))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.membership.delete()
+        response = self.client.get(url)
+        self.assertRedirects(
+            response, reverse('dashboard:index', kwargs={'username': self.user.username}), fetch_redirect_response=False
+        )
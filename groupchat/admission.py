@@ -0,0 +1,343 @@
+"""
+Admission control and load shedding for chat WebSocket connections.
+
+Without it a worker accepts every socket until it falls over: each handshake
+costs an auth lookup, a membership check, a channel-layer subscription and a
+presence snapshot, and a reconnect storm queues thousands of them at once.
+Admission happens in two places:
+
+* `AdmissionMiddleware`, outermost in the ASGI stack, sheds handshakes while
+  the worker is overloaded, before any session, auth or database work: when
+  `GROUPCHAT_ADMISSION_MAX_HANDSHAKES` handshakes are already in progress
+  (between the middleware and the consumer's accept or close), when the event
+  loop lags more than `GROUPCHAT_ADMISSION_MAX_LOOP_LAG` seconds behind its
+  schedule, or when more than `GROUPCHAT_ADMISSION_MAX_EXECUTOR_QUEUE` calls
+  wait for the thread that runs thread-sensitive sync code (the ORM). Lag and
+  queue depth only rise once admitted handshakes start working, so the
+  handshake cap is what keeps the first burst of a storm from all getting in.
+* The consumers cap the sockets this process holds in total, per user and per
+  group (a multiplexed subscription counts as a socket in its group).
+
+While the worker drains for a restart (see `groupchat.drain`) both refuse
+every new connection with the code 'draining'.
+
+A refused connection is accepted just long enough to receive
+
+    {'type': 'connect.rejected', 'code': 'overloaded', 'retry_after': 5}
+
+('code' is 'overloaded', 'server_full', 'too_many_connections',
+'group_full' or 'draining') and is then closed with code 4013 when the
+worker is overloaded or full, 4029 when a per-user or per-group cap was hit,
+or 4012 while draining. 4013 and 4012 mirror 1013 (Try Again Later) and 1012
+(Service Restart), which autobahn does not let a server send. Clients wait
+between one and two times `retry_after` seconds before reconnecting, so a
+shed storm spreads out instead of coming straight back; a multiplexed
+subscription to a full group is answered with a `subscribe.error` frame coded
+'group_full' instead.
+
+`retry_after` is `GROUPCHAT_ADMISSION_RETRY_AFTER`, stretched while shedding
+by the recent ratio of shed to admitted handshakes (up to `MAX_RETRY_AFTER`):
+if ten clients are turned away for every one let in, retries are spread over
+ten times as long, so they arrive at about the rate the worker admits them
+instead of as a new storm of refusals, each of which still costs a handshake.
+
+Loop lag is sampled every `SAMPLE_INTERVAL` seconds by a task that measures
+how late its sleeps wake up; a sample that is overdue counts as lag already.
+Counts, lag and queue depth are per process and event loop.
+
+Settings (0 disables a limit):
+    GROUPCHAT_ADMISSION_MAX_HANDSHAKES (int): Handshakes in progress above which
+        new ones are shed. Defaults to 100.
+    GROUPCHAT_ADMISSION_MAX_CONNECTIONS (int): Sockets per process. Defaults to 10000.
+    GROUPCHAT_ADMISSION_MAX_USER_CONNECTIONS (int): Sockets per user and process. Defaults to 20.
+    GROUPCHAT_ADMISSION_MAX_GROUP_CONNECTIONS (int): Sockets per group and process. Defaults to 5000.
+    GROUPCHAT_ADMISSION_MAX_LOOP_LAG (float): Seconds of event-loop lag above which
+        handshakes are shed. Defaults to 0.5.
+    GROUPCHAT_ADMISSION_MAX_EXECUTOR_QUEUE (int): Waiting sync calls above which
+        handshakes are shed. Defaults to 200.
+    GROUPCHAT_ADMISSION_RETRY_AFTER (int): Seconds refused clients are asked to wait. Defaults to 5.
+"""
+import asyncio
+import logging
+import math
+import time
+import weakref
+
+from asgiref.sync import AsyncToSync, SyncToAsync
+from django.conf import settings
+from . import metrics
+from .wire import negotiate_codec
+
+logger = logging.getLogger(__name__)
+throttled_log = metrics.RateLimitedLog(logger)
+
+TRY_AGAIN_LATER_CLOSE_CODE = 4013 # The worker is overloaded or full; try again later, possibly elsewhere
+TOO_MANY_CONNECTIONS_CLOSE_CODE = 4029 # A per-user or per-group cap was hit
+SERVICE_RESTART_CLOSE_CODE = 4012 # The worker is draining for a restart; reconnect (to another worker)
+CLOSE_CODES = {
+    'overloaded': TRY_AGAIN_LATER_CLOSE_CODE,
+    'server_full': TRY_AGAIN_LATER_CLOSE_CODE,
+    'too_many_connections': TOO_MANY_CONNECTIONS_CLOSE_CODE,
+    'group_full': TOO_MANY_CONNECTIONS_CLOSE_CODE,
+    'draining': SERVICE_RESTART_CLOSE_CODE,
+}
+SAMPLE_INTERVAL = 0.1 # seconds between event-loop lag samples
+RATE_WINDOW = 1.0 # seconds over which shed and admitted handshakes are compared
+MAX_RETRY_AFTER = 60 # seconds
+
+stats = {
+    'connections': 0, 'loop_lag_ms': 0.0, 'executor_queue': 0,
+    'handshakes': 0, 'shed_handshakes': 0, 'shed_loop_lag': 0, 'shed_executor_queue': 0,
+    'refused_server_full': 0, 'refused_too_many_connections': 0, 'refused_group_full': 0, 'refused_draining': 0,
+}
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def executor_queue_depth():
+    """
+    Returns the number of calls waiting for the thread that runs
+    thread-sensitive sync code (`database_sync_to_async`, the ORM) for the
+    running event loop.
+    """
+    # Private asgiref attributes (checked against 3.8); without them the depth reads as 0 and never sheds.
+    executors = getattr(AsyncToSync, 'loop_thread_executors', None)
+    executor = getattr(SyncToAsync, 'single_thread_executor', None)
+    if isinstance(executors, dict):
+        executor = executors.get(asyncio.get_running_loop(), executor)
+    work_queue = getattr(executor, '_work_queue', None) # Both of asgiref's executor classes queue work here
+    if not hasattr(work_queue, 'qsize'):
+        return 0
+    return work_queue.qsize()
+
+
+def rejection_frame(code, retry_after=None):
+    """
+    Returns the `connect.rejected` frame telling a refused client why and how
+    long to wait: `retry_after` seconds, or `GROUPCHAT_ADMISSION_RETRY_AFTER`.
+    """
+    if retry_after is None:
+        retry_after = _setting('GROUPCHAT_ADMISSION_RETRY_AFTER', 5)
+    return {'type': 'connect.rejected', 'code': code, 'retry_after': retry_after}
+
+
+class AdmissionController:
+    """
+    Tracks the sockets of one event loop and measures its load. Use
+    `get_admission_controller()`.
+    """
+
+    def __init__(self):
+        self.channels = set() # channel names of the admitted sockets
+        self.draining = False
+        self.handshakes = 0 # in progress, see `AdmissionMiddleware`
+        self.users = {} # user_id -> sockets
+        self.groups = {} # group_id -> sockets
+        self.lag = 0.0
+        self.shed_ratio = 0.0 # shed per admitted handshake, smoothed over RATE_WINDOWs
+        self._shed = self._started = 0 # in the current RATE_WINDOW
+        self._window_start = time.monotonic()
+        self._due = None
+        self._task = None
+
+    @property
+    def connections(self):
+        """Number of admitted sockets."""
+        return len(self.channels)
+
+    def loop_lag(self):
+        """Returns how many seconds the event loop currently runs behind its schedule."""
+        self._ensure_sampling()
+        overdue = time.monotonic() - self._due if self._due is not None else 0.0
+        return max(self.lag, overdue)
+
+    def overloaded(self):
+        """
+        Returns why new handshakes should be shed right now ('handshakes',
+        'loop_lag' or 'executor_queue'), or None if the worker can take them.
+        """
+        max_handshakes = _setting('GROUPCHAT_ADMISSION_MAX_HANDSHAKES', 100)
+        if max_handshakes and self.handshakes >= max_handshakes:
+            return 'handshakes'
+        max_lag = _setting('GROUPCHAT_ADMISSION_MAX_LOOP_LAG', 0.5)
+        if max_lag and self.loop_lag() > max_lag:
+            return 'loop_lag'
+        max_queue = _setting('GROUPCHAT_ADMISSION_MAX_EXECUTOR_QUEUE', 200)
+        if max_queue and executor_queue_depth() > max_queue:
+            return 'executor_queue'
+        return None
+
+    def shed(self, cause):
+        """Counts a handshake shed because of `cause` (see `overloaded()`)."""
+        stats[f'shed_{cause}'] += 1
+        self._shed += 1
+
+    def start_handshake(self):
+        """Counts a handshake let through; call `end_handshake()` once it is accepted or closed."""
+        self.handshakes += 1
+        self._started += 1
+        stats['handshakes'] = self.handshakes
+
+    def end_handshake(self):
+        """Counts a handshake started with `start_handshake()` as finished."""
+        self.handshakes -= 1
+        stats['handshakes'] = self.handshakes
+
+    def retry_after(self):
+        """Returns the seconds shed clients should wait, stretched by the recent shed ratio (see the module docstring)."""
+        base = _setting('GROUPCHAT_ADMISSION_RETRY_AFTER', 5)
+        return min(MAX_RETRY_AFTER, math.ceil(base * max(1.0, self.shed_ratio)))
+
+    def admit(self, channel_name, user_id, group_id=None):
+        """
+        Registers a new socket of a user (in a group) unless the worker is
+        draining or this process, the user or the group is at its cap; release
+        it with `release()`.
+
+        Args:
+            channel_name (str): The consumer's channel, which receives the drain notice.
+            user_id (int): The connecting user.
+            group_id (int, optional): The group of a per-group connection.
+
+        Returns:
+            str or None: The refusal code ('draining', 'server_full',
+            'too_many_connections' or 'group_full'), or None if admitted.
+        """
+        if self.draining:
+            return self.refuse('draining')
+        max_connections = _setting('GROUPCHAT_ADMISSION_MAX_CONNECTIONS', 10000)
+        if max_connections and self.connections >= max_connections:
+            return self.refuse('server_full')
+        max_user = _setting('GROUPCHAT_ADMISSION_MAX_USER_CONNECTIONS', 20)
+        if max_user and self.users.get(user_id, 0) >= max_user:
+            return self.refuse('too_many_connections')
+        if group_id is not None:
+            refusal = self.join_group(group_id)
+            if refusal:
+                return refusal
+        self.channels.add(channel_name)
+        self.users[user_id] = self.users.get(user_id, 0) + 1
+        stats['connections'] = self.connections
+        return None
+
+    def release(self, channel_name, user_id, group_id=None):
+        """Unregisters a socket admitted with `admit()`."""
+        if group_id is not None:
+            self.leave_group(group_id)
+        self.channels.discard(channel_name)
+        stats['connections'] = self.connections
+        if self.users[user_id] > 1:
+            self.users[user_id] -= 1
+        else:
+            del self.users[user_id]
+
+    def join_group(self, group_id):
+        """
+        Registers a socket in a group unless the group is at its cap, e.g. a
+        multiplexed subscription; release it with `leave_group()`.
+
+        Returns:
+            str or None: 'group_full', or None if admitted.
+        """
+        max_group = _setting('GROUPCHAT_ADMISSION_MAX_GROUP_CONNECTIONS', 5000)
+        if max_group and self.groups.get(group_id, 0) >= max_group:
+            return self.refuse('group_full')
+        self.groups[group_id] = self.groups.get(group_id, 0) + 1
+        return None
+
+    def leave_group(self, group_id):
+        """Unregisters a socket admitted with `join_group()`."""
+        if self.groups[group_id] > 1:
+            self.groups[group_id] -= 1
+        else:
+            del self.groups[group_id]
+
+    def refuse(self, code):
+        """Counts a refusal and returns its code."""
+        stats[f'refused_{code}'] += 1
+        return code
+
+    def _ensure_sampling(self):
+        if self._task is None or self._task.done():
+            self._due = None
+            self._task = asyncio.get_running_loop().create_task(self._sample())
+
+    async def _sample(self):
+        while True:
+            self._due = time.monotonic() + SAMPLE_INTERVAL
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            now = time.monotonic()
+            self.lag = max(0.0, now - self._due)
+            stats['loop_lag_ms'] = round(self.lag * 1000, 1)
+            stats['executor_queue'] = executor_queue_depth()
+            if now - self._window_start >= RATE_WINDOW:
+                self.shed_ratio = (self.shed_ratio + self._shed / max(self._started, 1)) / 2
+                self._shed = self._started = 0
+                self._window_start = now
+
+
+_controllers = weakref.WeakKeyDictionary()
+
+
+def get_admission_controller():
+    """Returns the `AdmissionController` bound to the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    controller = _controllers.get(loop)
+    if controller is None:
+        controller = _controllers[loop] = AdmissionController()
+    return controller
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware shedding WebSocket handshakes while the worker is
+    overloaded (see the module docstring). Wrap it around the whole
+    WebSocket stack so shed handshakes cost no session or auth lookups.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'websocket':
+            return await self.inner(scope, receive, send)
+        controller = get_admission_controller()
+        if controller.draining:
+            controller.refuse('draining')
+            await self.reject(scope, receive, send, 'draining')
+            return
+        cause = controller.overloaded()
+        if cause:
+            controller.shed(cause)
+            throttled_log.log(logging.WARNING, f'admission.{cause}', "Shedding WebSocket handshake: worker overloaded (%s).", cause)
+            await self.reject(scope, receive, send, 'overloaded', controller.retry_after())
+            return
+
+        handshaking = True
+        controller.start_handshake()
+
+        async def send_tracking_handshake(message):
+            nonlocal handshaking
+            if handshaking and message['type'] in ('websocket.accept', 'websocket.close'):
+                handshaking = False
+                controller.end_handshake()
+            await send(message)
+
+        try:
+            return await self.inner(scope, receive, send_tracking_handshake)
+        finally:
+            if handshaking:
+                controller.end_handshake()
+
+    async def reject(self, scope, receive, send, code, retry_after=None):
+        """Completes the handshake only to send the `connect.rejected` frame and close with the matching code."""
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        codec = negotiate_codec(scope.get('subprotocols'))
+        payload = codec.encode(rejection_frame(code, retry_after))
+        await send({'type': 'websocket.accept', 'subprotocol': codec.subprotocol})
+        await send({'type': 'websocket.send', 'bytes' if isinstance(payload, bytes) else 'text': payload})
+        await send({'type': 'websocket.close', 'code': CLOSE_CODES[code]})
@@ -0,0 +1,469 @@
+"""
+Room-affinity routing of chat rooms to worker pools.
+
+Behind a plain load balancer every daphne worker serves every room, so a few
+very large rooms keep all of them busy fanning out messages and small rooms
+wait behind them. Affinity routing gives each room a home pool of workers:
+
+- Rooms are consistently hashed by their channel layer group name
+  (`chat_<group_id>`) onto the pools in `GROUPCHAT_AFFINITY_POOLS`, so adding
+  or removing a pool only moves the rooms it gains or loses.
+- A room sending more than `GROUPCHAT_AFFINITY_HOT_RATE` messages/sec, summed
+  over the workers reporting it, is pinned to one of the
+  `GROUPCHAT_AFFINITY_DEDICATED_POOLS` (hashed onto them the same way) for
+  `GROUPCHAT_AFFINITY_PIN_TTL` seconds. The pin is renewed while the room
+  stays above half that rate, and lapses back to the hash afterwards.
+- Rooms can be pinned by hand with `python manage.py chat_rooms --pin`, or
+  in settings with `GROUPCHAT_AFFINITY_PINS`. Neither expires, and the
+  setting wins over the others.
+
+A pool is a name and the address its workers are reached at: a `ws://` or
+`wss://` origin, or a path prefix on the site's own host (e.g. `/chat-hot`)
+that the front proxy strips and sends to the pool. The chat page opens its
+socket at the room's pool. A worker started with `GROUPCHAT_AFFINITY_POOL`
+only serves rooms routed to its pool: a connection to another room gets
+
+    {'type': 'reconnect', 'after': 0, 'url': '/chat-hot'}
+
+and close code 4307. When a room's route changes, its sockets on other pools
+get the same frame with delays spread over `GROUPCHAT_AFFINITY_MOVE_WINDOW`
+seconds, and are closed with 4307 if they are still there a window later.
+Multiplexed connections may live on any worker; only their subscriptions to
+rooms on a dedicated pool are refused (`subscribe.error` coded 'moved', with
+the pool's 'url'), so a hot room's fan-out never lands on a shared worker.
+
+Every worker measures each room's messages sent and frames delivered per
+second and publishes its busiest rooms every
+`GROUPCHAT_AFFINITY_REPORT_INTERVAL` seconds. `room_loads()` sums the reports
+of all live workers; `python manage.py chat_rooms` lists them with their
+routes, and the metrics view shows this worker's share under `rooms`. Pins
+and reports live in the default cache, which the workers must share
+(`CACHE_REDIS_URL`) for pins to apply everywhere. Each pin and each worker's
+report is a key of its own that expires with it, so workers updating at the
+same time never overwrite each other: a worker claims one of `WORKER_SLOTS`
+registry keys with `add()` and refreshes it with its reports, and readers
+fetch all of them, or the pins of the rooms they route, with one `get_many()`.
+
+Settings:
+    GROUPCHAT_AFFINITY_POOLS (dict): Pool name -> address of the pools rooms
+        are hashed onto; empty disables routing. Defaults to {}.
+    GROUPCHAT_AFFINITY_DEDICATED_POOLS (dict): Pool name -> address of the
+        pools reserved for pinned rooms. Defaults to {}.
+    GROUPCHAT_AFFINITY_POOL (str): This worker's pool; empty serves every
+        room. Defaults to ''.
+    GROUPCHAT_AFFINITY_PINS (dict): Group id -> pool name of permanent pins. Defaults to {}.
+    GROUPCHAT_AFFINITY_HOT_RATE (float): Messages/sec from which a room is
+        pinned to a dedicated pool; 0 disables automatic pins. Defaults to 20.
+    GROUPCHAT_AFFINITY_PIN_TTL (float): Seconds an automatic pin lasts unless renewed. Defaults to 600.
+    GROUPCHAT_AFFINITY_REPORT_INTERVAL (float): Seconds between load reports
+        and pin table refreshes. Defaults to 5.
+    GROUPCHAT_AFFINITY_MOVE_WINDOW (float): Seconds over which a moved room's
+        sockets reconnect. Defaults to 10.
+"""
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import random
+import socket
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from .batching import RateMeter
+
+logger = logging.getLogger(__name__)
+
+MOVED_CLOSE_CODE = 4307 # The room is served by another pool; reconnect at the address sent before
+VNODES = 100 # points per pool on the hash ring
+TOP_ROOMS = 50 # rooms per worker load report
+RENEW_RATIO = 0.5 # an automatic pin is renewed while the room stays above this share of the hot rate
+WORKER_SLOTS = 256 # registry keys, one per live worker
+MAX_CACHED_PINS = 10000 # rooms whose pin this worker remembers between refreshes
+
+stats = {'rooms': 0, 'redirected': 0, 'moved_rooms': 0, 'pinned': 0, 'renewed': 0, 'reports': 0}
+room_stats = {} # group_id -> this worker's load of the room, as of its last report
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+def _room_key(group_id):
+    return f'chat_{group_id}' # The room's channel layer group, as `consumers.room_group_name`
+
+
+class HashRing:
+    """
+    A consistent hash ring over named nodes. Each node sits at `vnodes`
+    points, so keys spread evenly and removing a node only moves its keys.
+    """
+
+    def __init__(self, nodes, vnodes=VNODES):
+        points = sorted((_hash(f'{node}#{index}'), node) for node in nodes for index in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def lookup(self, key):
+        """Returns the node owning `key`, or None if the ring has no nodes."""
+        if not self.nodes:
+            return None
+        return self.nodes[bisect.bisect(self.hashes, _hash(key)) % len(self.nodes)]
+
+
+_rings = {}
+
+
+def _ring(pools):
+    names = tuple(sorted(pools))
+    ring = _rings.get(names)
+    if ring is None:
+        ring = _rings[names] = HashRing(names)
+    return ring
+
+
+def shared_pools():
+    """Returns the pools rooms are hashed onto, name -> address."""
+    return _setting('GROUPCHAT_AFFINITY_POOLS', {})
+
+
+def dedicated_pools():
+    """Returns the pools reserved for pinned rooms, name -> address."""
+    return _setting('GROUPCHAT_AFFINITY_DEDICATED_POOLS', {})
+
+
+def local_pool():
+    """Returns the pool this worker belongs to, or '' if it serves every room."""
+    return _setting('GROUPCHAT_AFFINITY_POOL', '')
+
+
+def routing_enabled():
+    """Returns whether rooms are routed to pools at all."""
+    return bool(shared_pools())
+
+
+def pool_address(pool):
+    """Returns the address clients reach `pool` at, or '' for an unknown pool."""
+    return shared_pools().get(pool) or dedicated_pools().get(pool, '')
+
+
+def misrouted(pool):
+    """Returns whether this worker must send the sockets of a room routed to `pool` there."""
+    return pool is not None and bool(local_pool()) and pool != local_pool()
+
+
+_pins = {} # group_id -> (its pin or None, when it was read (time.monotonic()))
+
+
+def _pin_key(group_id):
+    return f'groupchat:affinity:pin:{group_id}'
+
+
+def _pin_fresh(group_id):
+    entry = _pins.get(group_id)
+    return entry is not None and time.monotonic() - entry[1] < _setting('GROUPCHAT_AFFINITY_REPORT_INTERVAL', 5.0)
+
+
+def _remember(group_id, pin):
+    if len(_pins) >= MAX_CACHED_PINS and group_id not in _pins:
+        _pins.clear()
+    _pins[group_id] = (pin, time.monotonic())
+
+
+def pins(group_ids):
+    """
+    Returns the pins of these rooms, `{group_id: {'pool': name, 'expires':
+    epoch seconds or None}}`, re-reading each from the cache at most every
+    report interval.
+    """
+    table, stale = {}, []
+    for group_id in group_ids:
+        if _pin_fresh(group_id):
+            table[group_id] = _pins[group_id][0]
+        else:
+            stale.append(group_id)
+    if stale:
+        found = cache.get_many([_pin_key(group_id) for group_id in stale])
+        for group_id in stale:
+            table[group_id] = found.get(_pin_key(group_id))
+            _remember(group_id, table[group_id])
+    return {group_id: pin for group_id, pin in table.items() if pin is not None}
+
+
+def resolve(group_id, pin):
+    """
+    Returns the pool serving a room with the given pin (or None): its pin
+    from settings, its live pin, or its place on the ring of shared pools.
+    """
+    known = shared_pools().keys() | dedicated_pools().keys()
+    pool = _setting('GROUPCHAT_AFFINITY_PINS', {}).get(group_id)
+    if pool in known:
+        return pool
+    if pin and pin['pool'] in known and (pin['expires'] is None or pin['expires'] > time.time()):
+        return pin['pool']
+    return _ring(shared_pools()).lookup(_room_key(group_id))
+
+
+def route(group_id):
+    """Returns the name of the pool serving a room, or None when routing is off."""
+    if not routing_enabled():
+        return None
+    return resolve(group_id, pins([group_id]).get(group_id))
+
+
+async def aroute(group_id):
+    """Async `route()`; only goes to the cache when the room's pin is due for a refresh."""
+    if not routing_enabled():
+        return None
+    if _pin_fresh(group_id):
+        return resolve(group_id, _pins[group_id][0])
+    table = await sync_to_async(pins, thread_sensitive=False)([group_id])
+    return resolve(group_id, table.get(group_id))
+
+
+def pin(group_id, pool, ttl=None):
+    """
+    Pins a room to a pool.
+
+    Args:
+        group_id (int): The room's group.
+        pool (str): A shared or dedicated pool name.
+        ttl (float, optional): Seconds until the pin lapses; None pins until `unpin()`.
+
+    Raises:
+        ValueError: If the pool is not configured.
+    """
+    if pool not in shared_pools() and pool not in dedicated_pools():
+        raise ValueError(f"Unknown chat pool {pool!r}.")
+    value = {'pool': pool, 'expires': time.time() + ttl if ttl else None}
+    cache.set(_pin_key(group_id), value, ttl or None)
+    _remember(group_id, value)
+
+
+def unpin(group_id):
+    """Removes a room's pin; returns whether it had one."""
+    found = cache.delete(_pin_key(group_id))
+    _remember(group_id, None)
+    return bool(found)
+
+
+def route_event(group_id, pool):
+    """Returns the channel layer event telling a room's sockets that it is served by `pool` (see `ChatConsumer.chat_route`)."""
+    return {
+        'type': 'chat.route',
+        'group_id': group_id,
+        'pool': pool,
+        'url': pool_address(pool),
+        'dedicated': pool in dedicated_pools(),
+        'window': _setting('GROUPCHAT_AFFINITY_MOVE_WINDOW', 10.0),
+    }
+
+
+def move_frame(pool, window=0.0):
+    """Returns the `reconnect` frame sending a client to `pool`, due at a random point of `window` seconds."""
+    return {'type': 'reconnect', 'after': round(random.uniform(0, window), 1), 'url': pool_address(pool)}
+
+
+def _slot_key(slot):
+    return f'groupchat:affinity:worker:{slot}'
+
+
+_slots = {} # worker name -> the registry slot it holds
+
+
+def publish_load(worker, rooms, ttl):
+    """
+    Stores a worker's room loads for `ttl` seconds in its registry slot,
+    claiming a free slot first if it holds none (or lost its slot by
+    reporting too late).
+
+    Args:
+        worker (str): The worker's name, unique among workers.
+        rooms (dict): group_id -> `(messages/sec, deliveries/sec, sockets)`.
+        ttl (float): Seconds the report stays valid.
+    """
+    report = {'worker': worker, 'pool': local_pool(), 'rooms': rooms}
+    slot = _slots.get(worker)
+    if slot is not None:
+        held = cache.get(_slot_key(slot))
+        if held is not None and held['worker'] == worker:
+            cache.set(_slot_key(slot), report, ttl)
+            return
+    start = _hash(worker) % WORKER_SLOTS # Workers start at different slots, so claims rarely collide
+    for offset in range(WORKER_SLOTS):
+        slot = (start + offset) % WORKER_SLOTS
+        if cache.add(_slot_key(slot), report, ttl):
+            _slots[worker] = slot
+            return
+    logger.warning("All %s chat worker registry slots are taken; the room loads of %s are not reported.", WORKER_SLOTS, worker)
+
+
+def room_loads():
+    """
+    Returns the rooms reported by live workers, busiest first.
+
+    Returns:
+        list: One dict per room with its 'group', 'rate' (messages/sec) and
+        'deliveries' (frames/sec) summed over workers, its 'sockets', the
+        'workers' reporting it and the 'pool' serving it (None when routing
+        is off).
+    """
+    loads = {}
+    for report in cache.get_many([_slot_key(slot) for slot in range(WORKER_SLOTS)]).values():
+        for group_id, (rate, deliveries, sockets) in report['rooms'].items():
+            load = loads.setdefault(group_id, {'group': group_id, 'rate': 0.0, 'deliveries': 0.0, 'sockets': 0, 'workers': 0})
+            load['rate'] += rate
+            load['deliveries'] += deliveries
+            load['sockets'] += sockets
+            load['workers'] += 1
+    for load in loads.values():
+        load['rate'], load['deliveries'] = round(load['rate'], 2), round(load['deliveries'], 2)
+        load['pool'] = route(load['group'])
+    return sorted(loads.values(), key=lambda load: (load['rate'], load['deliveries']), reverse=True)
+
+
+class RoomLoadTracker:
+    """
+    Measures this worker's load per room, reports it, pins hot rooms and
+    moves sockets of rooms routed elsewhere (see the module docstring).
+    Bound to one event loop; use `get_room_tracker()`.
+    """
+
+    def __init__(self):
+        self.messages = {} # group_id -> RateMeter of messages sent from this worker
+        self.deliveries = {} # group_id -> RateMeter of message frames delivered by this worker
+        self.sockets = {} # group_id -> per-group sockets, which must be on the room's pool
+        self.subscriptions = {} # group_id -> multiplexed subscriptions
+        self.moved = {} # group_id -> when its sockets were last told to move (time.monotonic())
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+        self._task = None
+
+    def observe(self, group_id):
+        """Counts a message sent to a room from this worker."""
+        meter = self.messages.get(group_id)
+        if meter is None:
+            meter = self.messages[group_id] = RateMeter()
+        meter.observe(time.monotonic())
+
+    def deliver(self, group_id, count=1):
+        """Counts `count` message frames delivered to a socket of a room."""
+        meter = self.deliveries.get(group_id)
+        if meter is None:
+            meter = self.deliveries[group_id] = RateMeter()
+        meter.observe(time.monotonic(), count)
+
+    def join(self, group_id, multiplexed=False):
+        """Counts a socket (or multiplexed subscription) joining a room and starts reporting."""
+        counts = self.subscriptions if multiplexed else self.sockets
+        counts[group_id] = counts.get(group_id, 0) + 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def leave(self, group_id, multiplexed=False):
+        """Counts a socket (or multiplexed subscription) leaving a room."""
+        counts = self.subscriptions if multiplexed else self.sockets
+        counts[group_id] -= 1
+        if not counts[group_id]:
+            del counts[group_id]
+
+    def loads(self):
+        """
+        Returns this worker's busiest rooms, group_id -> `(messages/sec,
+        deliveries/sec, sockets)`, and forgets the rate meters of quiet rooms.
+        """
+        now = time.monotonic()
+        rooms = {}
+        for group_id in self.messages.keys() | self.deliveries.keys() | self.sockets.keys() | self.subscriptions.keys():
+            rate = self.messages[group_id].rate(now) if group_id in self.messages else 0.0
+            deliveries = self.deliveries[group_id].rate(now) if group_id in self.deliveries else 0.0
+            sockets = self.sockets.get(group_id, 0) + self.subscriptions.get(group_id, 0)
+            if rate < 0.01:
+                self.messages.pop(group_id, None)
+            if deliveries < 0.01:
+                self.deliveries.pop(group_id, None)
+            if sockets or rate >= 0.01 or deliveries >= 0.01:
+                rooms[group_id] = (round(rate, 2), round(deliveries, 2), sockets)
+        stats['rooms'] = len(rooms)
+        return dict(sorted(rooms.items(), key=lambda item: item[1][1], reverse=True)[:TOP_ROOMS])
+
+    async def _run(self):
+        interval = _setting('GROUPCHAT_AFFINITY_REPORT_INTERVAL', 5.0)
+        while self.sockets or self.subscriptions or self.messages:
+            await asyncio.sleep(interval)
+            try:
+                await self.report(interval)
+            except Exception:
+                logger.exception("Chat room load report failed.")
+
+    async def report(self, interval):
+        """Publishes this worker's room loads, then pins hot rooms and moves misrouted sockets."""
+        rooms = self.loads()
+        room_stats.clear()
+        room_stats.update({
+            group_id: {'rate': rate, 'deliveries': deliveries, 'sockets': sockets}
+            for group_id, (rate, deliveries, sockets) in rooms.items()
+        })
+        await sync_to_async(publish_load, thread_sensitive=False)(self.worker, rooms, interval * 3)
+        stats['reports'] += 1
+        if routing_enabled():
+            await self.pin_hot_rooms(rooms)
+            await self.move_misrouted()
+
+    async def pin_hot_rooms(self, rooms):
+        """Pins this worker's rooms over the hot rate to a dedicated pool, and renews their pins while they stay busy."""
+        hot_rate = _setting('GROUPCHAT_AFFINITY_HOT_RATE', 20.0)
+        if not hot_rate or not dedicated_pools() or not rooms:
+            return
+        loads = {load['group']: load for load in await sync_to_async(room_loads, thread_sensitive=False)()}
+        table = await sync_to_async(pins, thread_sensitive=False)(rooms)
+        ttl = _setting('GROUPCHAT_AFFINITY_PIN_TTL', 600.0)
+        for group_id in rooms:
+            load = loads.get(group_id)
+            if load is None or group_id in _setting('GROUPCHAT_AFFINITY_PINS', {}):
+                continue
+            current = table.get(group_id)
+            if current is None and load['rate'] >= hot_rate:
+                pool = _ring(dedicated_pools()).lookup(_room_key(group_id))
+                await sync_to_async(pin, thread_sensitive=False)(group_id, pool, ttl)
+                stats['pinned'] += 1
+                logger.info("Pinned chat room %s (%.1f messages/sec) to pool %s.", group_id, load['rate'], pool)
+                await get_channel_layer().group_send(_room_key(group_id), route_event(group_id, pool))
+            elif (
+                current is not None and current['expires'] is not None and load['rate'] >= hot_rate * RENEW_RATIO
+                and current['expires'] - time.time() < ttl / 2
+            ):
+                await sync_to_async(pin, thread_sensitive=False)(group_id, current['pool'], ttl)
+                stats['renewed'] += 1
+
+    async def move_misrouted(self):
+        """Tells the sockets of rooms this worker's pool no longer serves to reconnect at their pool, once per move window."""
+        window = _setting('GROUPCHAT_AFFINITY_MOVE_WINDOW', 10.0)
+        now = time.monotonic()
+        for group_id in list(self.sockets):
+            pool = await aroute(group_id)
+            if not misrouted(pool):
+                self.moved.pop(group_id, None)
+            elif now - self.moved.get(group_id, float('-inf')) >= window:
+                self.moved[group_id] = now
+                stats['moved_rooms'] += 1
+                await get_channel_layer().group_send(_room_key(group_id), route_event(group_id, pool))
+
+
+_trackers = weakref.WeakKeyDictionary()
+
+
+def get_room_tracker():
+    """Returns the `RoomLoadTracker` bound to the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    tracker = _trackers.get(loop)
+    if tracker is None:
+        tracker = _trackers[loop] = RoomLoadTracker()
+    return tracker
@@ -4,6 +4,20 @@ Application configuration for the groupchat app.
 This module defines the configuration class for the groupchat Django application.
 """
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def restore_search_triggers(sender, using, **kwargs):
+    """
+    Recreates the SQLite full-text table and triggers when a migration rebuilt
+    the messages table, which drops its triggers (see `search.py`).
+    """
+    from django.db import connections
+    from django.db.migrations.recorder import MigrationRecorder
+    from .search import SEARCH_MIGRATION, ensure_search_index
+    connection = connections[using]
+    if connection.vendor == 'sqlite' and SEARCH_MIGRATION in MigrationRecorder(connection).applied_migrations():
+        ensure_search_index(connection)
 
 
 class GroupchatConfig(AppConfig):
@@ -15,3 +29,7 @@ class GroupchatConfig(AppConfig):
     """
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'groupchat'
+
+    def ready(self):
+        from . import signals  # noqa: F401  Registers the auth cache, message id and attachment handlers.
+        post_migrate.connect(restore_search_triggers, sender=self)
@@ -0,0 +1,286 @@
+"""
+Tiered archival of old chat messages.
+
+Chat history is mostly read near its end, yet `GroupChatMessage` would grow
+forever. `manage.py chat_archive` moves the messages of every whole (UTC)
+month older than a group's horizon (`DiscussionGroup.chat_archive_days`, or
+`GROUPCHAT_ARCHIVE_AFTER_DAYS`) into `ArchivedChatSegment` rows: runs of up to
+`GROUPCHAT_ARCHIVE_SEGMENT_SIZE` messages of one group and month, stored as
+gzip-compressed msgpack arrays
+
+    [id, user_id, text_content, file_attachment name, timestamp in µs since the epoch]
+
+in history order, with the positions of their first and last messages. Each
+segment is committed before its messages are deleted from the hot table, in
+transactions of `GROUPCHAT_ARCHIVE_DELETE_CHUNK` rows (with
+`GROUPCHAT_ARCHIVE_DELETE_PAUSE` seconds between them), so no delete holds
+locks for long. A message is in the hot table, the archive, or briefly both;
+readers never see it twice.
+
+Reads go through transparently: `history.fetch_page` continues into the
+archive when a page runs past the oldest hot message, and `messages_after`
+serves resumes from an archived cursor. Cursors are the same
+`(timestamp, id)` positions in both tiers. Decoded segments are cached per
+process (they never change), so scrolling back through one costs a single
+decompression. Archived messages keep their attachments, which the
+attachment view finds with `find_message`. They are not in the full-text
+search index, which the search API reports as `searched_until`
+(`archived_until`), and count as read.
+
+Settings:
+    GROUPCHAT_ARCHIVE_AFTER_DAYS (int or None): Default horizon; None disables archival. Defaults to 365.
+    GROUPCHAT_ARCHIVE_SEGMENT_SIZE (int): Messages per segment. Defaults to 2000.
+    GROUPCHAT_ARCHIVE_DELETE_CHUNK (int): Rows deleted per transaction. Defaults to 500.
+    GROUPCHAT_ARCHIVE_DELETE_PAUSE (float): Seconds between delete transactions. Defaults to 0.05.
+"""
+import gzip
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import msgpack
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+from .models import ArchivedChatSegment, GroupChatMessage
+from .signals import attachments_kept
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+DECODED_CACHE_SIZE = 64 # decoded segments kept per process
+
+stats = {'segments_read': 0, 'cache_hits': 0, 'archived': 0, 'segments_written': 0}
+
+_decoded = OrderedDict() # segment id -> list of entries
+_decoded_lock = threading.Lock()
+
+
+def archive_horizon(group):
+    """Returns the age in days after which a group's messages are archived, or None if never."""
+    if group.chat_archive_days is not None:
+        return group.chat_archive_days
+    return getattr(settings, 'GROUPCHAT_ARCHIVE_AFTER_DAYS', 365)
+
+
+def month_start(moment):
+    """Returns the first instant of the UTC month containing `moment`."""
+    moment = moment.astimezone(dt_timezone.utc)
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(start):
+    """Returns the first instant of the month after `start` (itself a month start)."""
+    return (start + timedelta(days=32)).replace(day=1)
+
+
+def archive_cutoff(group, now=None):
+    """
+    Returns the instant before which a group's messages are archived: the
+    start of the month its horizon falls in, so only whole months move.
+    None if the group is never archived.
+    """
+    horizon = archive_horizon(group)
+    if horizon is None:
+        return None
+    return month_start((now or timezone.now()) - timedelta(days=horizon))
+
+
+def pack_messages(rows):
+    """Compresses `(id, user_id, text_content, file name, timestamp)` rows into segment data."""
+    records = [
+        [message_id, user_id, text, file_name or None, (timestamp - EPOCH) // timedelta(microseconds=1)]
+        for message_id, user_id, text, file_name, timestamp in rows
+    ]
+    return gzip.compress(msgpack.packb(records, use_bin_type=True), compresslevel=6)
+
+
+def unpack_messages(data):
+    """
+    Decodes segment data.
+
+    Returns:
+        list: `(timestamp, id, user_id, text_content, file name)` entries in history order.
+    """
+    return [
+        (EPOCH + timedelta(microseconds=timestamp), message_id, user_id, text, file_name)
+        for message_id, user_id, text, file_name, timestamp in msgpack.unpackb(gzip.decompress(bytes(data)), raw=False)
+    ]
+
+
+def segment_entries(segment):
+    """Returns the decoded entries of a segment, from the per-process cache when possible."""
+    with _decoded_lock:
+        entries = _decoded.get(segment.id)
+        if entries is not None:
+            _decoded.move_to_end(segment.id)
+            stats['cache_hits'] += 1
+            return entries
+    entries = unpack_messages(segment.data) # Deferred field: loaded now
+    stats['segments_read'] += 1
+    with _decoded_lock:
+        _decoded[segment.id] = entries
+        while len(_decoded) > DECODED_CACHE_SIZE:
+            _decoded.popitem(last=False)
+    return entries
+
+
+def as_messages(group_id, entries):
+    """
+    Turns archive entries into unsaved `GroupChatMessage` instances with their
+    senders loaded, as the history API serializes them. Messages of deleted
+    users are dropped, as the hot table's cascade would.
+    """
+    users = get_user_model().objects.in_bulk({entry[2] for entry in entries})
+    messages = []
+    for timestamp, message_id, user_id, text, file_name in entries:
+        if user_id in users:
+            message = GroupChatMessage(
+                id=message_id, group_id=group_id, user_id=user_id, text_content=text,
+                file_attachment=file_name or None, timestamp=timestamp,
+            )
+            message.user = users[user_id]
+            messages.append(message)
+    return messages
+
+
+def _segments(group_id):
+    return ArchivedChatSegment.objects.filter(group_id=group_id).defer('data')
+
+
+def messages_before(group_id, position, limit):
+    """
+    Returns up to `limit` archived messages immediately older than `position`,
+    newest first.
+
+    Args:
+        group_id (int): ID of the discussion group.
+        position (tuple or None): `(timestamp, id)` bound; None for the newest archived messages.
+        limit (int): Number of messages wanted.
+    """
+    segments = _segments(group_id)
+    if position:
+        timestamp, message_id = position
+        segments = segments.filter(Q(first_timestamp__lt=timestamp) | Q(first_timestamp=timestamp, first_message_id__lt=message_id))
+    entries = []
+    for segment in segments.order_by('-last_timestamp', '-last_message_id').iterator(chunk_size=8):
+        if len(entries) >= limit and (segment.last_timestamp, segment.last_message_id) < entries[limit - 1][:2]:
+            break # Segments are ordered by their newest message; none of the rest is newer than what we have
+        entries.extend(entry for entry in segment_entries(segment) if not position or entry[:2] < position)
+        entries.sort(reverse=True)
+    return as_messages(group_id, entries[:limit])
+
+
+def messages_after(group_id, position, limit, until=None):
+    """
+    Returns up to `limit` archived messages immediately newer than `position`,
+    oldest first.
+
+    Args:
+        group_id (int): ID of the discussion group.
+        position (tuple): `(timestamp, id)` bound.
+        limit (int): Number of messages wanted.
+        until (tuple, optional): Position of the oldest hot message; archived
+            copies from there on are still in the hot table and skipped.
+    """
+    timestamp, message_id = position
+    segments = _segments(group_id).filter(Q(last_timestamp__gt=timestamp) | Q(last_timestamp=timestamp, last_message_id__gt=message_id))
+    entries = []
+    for segment in segments.order_by('first_timestamp', 'first_message_id').iterator(chunk_size=8):
+        if len(entries) >= limit and (segment.first_timestamp, segment.first_message_id) > entries[limit - 1][:2]:
+            break
+        entries.extend(
+            entry for entry in segment_entries(segment) if entry[:2] > position and (until is None or entry[:2] < until)
+        )
+        entries.sort()
+    return as_messages(group_id, entries[:limit])
+
+
+def has_archive_after(group_id, position):
+    """Returns True if the group has archived messages newer than `position`."""
+    timestamp, message_id = position
+    return ArchivedChatSegment.objects.filter(
+        Q(last_timestamp__gt=timestamp) | Q(last_timestamp=timestamp, last_message_id__gt=message_id), group_id=group_id,
+    ).exists()
+
+
+def archived_until(group_id):
+    """Returns the timestamp of the group's newest archived message, or None if nothing is archived."""
+    return _segments(group_id).aggregate(until=Max('last_timestamp'))['until']
+
+
+def find_message(group_id, message_id):
+    """Returns an archived message of the group as an unsaved `GroupChatMessage`, or None."""
+    segments = _segments(group_id).filter(min_message_id__lte=message_id, max_message_id__gte=message_id)
+    for segment in segments:
+        for entry in segment_entries(segment):
+            if entry[1] == message_id:
+                found = as_messages(group_id, [entry])
+                return found[0] if found else None
+    return None
+
+
+def archive_group(group, now=None, dry_run=False, log=None):
+    """
+    Moves a group's messages older than its archive cutoff into segments.
+
+    Args:
+        group (DiscussionGroup): The group.
+        now (datetime, optional): The current time; for tests and backfills.
+        dry_run (bool): Count what would move without changing anything.
+        log (callable, optional): Called with a line per segment written.
+
+    Returns:
+        dict: Counts of 'messages' and 'segments' moved and compressed 'bytes' written.
+    """
+    totals = {'messages': 0, 'segments': 0, 'bytes': 0}
+    cutoff = archive_cutoff(group, now)
+    if cutoff is None:
+        return totals
+    segment_size = getattr(settings, 'GROUPCHAT_ARCHIVE_SEGMENT_SIZE', 2000)
+    chunk_size = getattr(settings, 'GROUPCHAT_ARCHIVE_DELETE_CHUNK', 500)
+    pause = getattr(settings, 'GROUPCHAT_ARCHIVE_DELETE_PAUSE', 0.05)
+    hot = GroupChatMessage.objects.filter(group_id=group.id)
+    after = None # In a dry run nothing is deleted, so the scan moves on by position instead
+
+    while True:
+        pending = hot.filter(timestamp__lt=cutoff)
+        if after:
+            pending = pending.filter(Q(timestamp__gt=after[0]) | Q(timestamp=after[0], id__gt=after[1]))
+        oldest = pending.order_by('timestamp', 'id').values_list('timestamp', flat=True).first()
+        if oldest is None:
+            return totals
+        month = month_start(oldest)
+        rows = list(
+            pending.filter(timestamp__lt=min(next_month(month), cutoff)).order_by('timestamp', 'id')
+            .values_list('id', 'user_id', 'text_content', 'file_attachment', 'timestamp')[:segment_size]
+        )
+        if not rows: # Deleted meanwhile
+            continue
+        ids = [row[0] for row in rows]
+        data = pack_messages(rows)
+        totals['messages'] += len(rows)
+        totals['segments'] += 1
+        totals['bytes'] += len(data)
+        if log:
+            log(f"{group.id}: {month:%Y-%m} {len(rows)} messages, {len(data)} bytes")
+        if dry_run:
+            after = rows[-1][4], rows[-1][0]
+            continue
+
+        ArchivedChatSegment.objects.create(
+            group_id=group.id, month=month.date(),
+            first_timestamp=rows[0][4], first_message_id=rows[0][0],
+            last_timestamp=rows[-1][4], last_message_id=rows[-1][0],
+            min_message_id=min(ids), max_message_id=max(ids),
+            message_count=len(rows), data=data,
+        )
+        stats['segments_written'] += 1
+        # Oldest first, so what is left of the segment in the hot table is always its newest part.
+        for start in range(0, len(ids), chunk_size):
+            with transaction.atomic(), attachments_kept(): # The segment still links the attachments
+                GroupChatMessage.objects.filter(id__in=ids[start:start + chunk_size]).delete()
+            stats['archived'] += len(ids[start:start + chunk_size])
+            if pause:
+                time.sleep(pause)
@@ -0,0 +1,230 @@
+"""
+Serving chat attachments to group members.
+
+Attachments are stored under `MEDIA_ROOT`, which is not served publicly;
+`serve_attachment` answers downloads through the `chat_attachment` view once
+it has checked group membership:
+
+*   `ETag` (size and modification time) and `Last-Modified`, with
+    `If-None-Match` / `If-Modified-Since` answered by 304 Not Modified.
+*   Single byte ranges (`Range: bytes=...`, honoured by `If-Range`) as
+    206 Partial Content, or 416 when unsatisfiable. Multi-range requests get
+    the whole file, which RFC 9110 allows.
+*   The body is a `FileResponse` over the open file, limited to the range.
+    Under a WSGI server with `wsgi.file_wrapper` sendfile support (e.g.
+    gunicorn) the bytes go from the page cache to the socket without being
+    copied through Python; otherwise they are streamed in `block_size`
+    chunks.
+
+With `GROUPCHAT_ATTACHMENT_SENDFILE` set, the response carries no body and
+leaves the bytes, Range and conditional requests to the front proxy:
+
+*   'x-accel-redirect' (nginx): `X-Accel-Redirect:
+    <GROUPCHAT_ATTACHMENT_ACCEL_PREFIX><file name>`, the prefix mapping to an
+    `internal` location aliased to `MEDIA_ROOT`.
+*   'x-sendfile' (Apache mod_xsendfile, lighttpd): `X-Sendfile: <absolute path>`.
+
+With a `size` ('thumb' or 'preview'), image attachments are served inline as
+the cached derivative from `content.derivatives`, or as the original while it
+is being rendered.
+
+Storages without local paths (e.g. object storage) are redirected to the
+storage's own URL.
+
+Settings:
+    GROUPCHAT_ATTACHMENT_SENDFILE (str): '', 'x-accel-redirect' or 'x-sendfile'. Defaults to ''.
+    GROUPCHAT_ATTACHMENT_ACCEL_PREFIX (str): nginx internal location of `MEDIA_ROOT`.
+        Defaults to '/protected-media/'.
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, HttpResponseRedirect
+from django.urls import reverse
+from django.utils.http import http_date, parse_http_date_safe
+from content.derivatives import DERIVATIVE_EXTENSION, DERIVATIVE_SIZES, derivative_path, is_image, schedule
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+DERIVATIVE_WAIT = 1.0 # seconds a sized request waits for a derivative being rendered, e.g. of a new upload
+
+
+def attachment_url(message):
+    """Returns the permission-checked download URL of a message's attachment, or None."""
+    if not message.file_attachment:
+        return None
+    return reverse('groupchat:chat_attachment', kwargs={'group_id': message.group_id, 'message_id': message.id})
+
+
+def schedule_derivatives(message):
+    """Queues rendering of the thumbnail and preview of an image attachment."""
+    field = message.file_attachment
+    if field and is_image(field.name):
+        try:
+            schedule(field.path)
+        except NotImplementedError: # Remote storage
+            pass
+
+
+def make_etag(stat):
+    """Returns a strong ETag for a file from its size and modification time."""
+    return f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+
+def parse_range(header, size):
+    """
+    Parses a single-range `Range` header.
+
+    Args:
+        header (str): The header value, e.g. 'bytes=0-499', 'bytes=500-' or 'bytes=-500'.
+        size (int): The file size.
+
+    Returns:
+        tuple or None: The inclusive `(first, last)` byte positions, or None when
+        the header is malformed or asks for several ranges (the whole file is sent).
+
+    Raises:
+        ValueError: If the range is not satisfiable.
+    """
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first: # Suffix range: the last N bytes
+        length = int(last)
+        if not length or not size:
+            raise ValueError("Empty suffix range.")
+        return max(0, size - length), size - 1
+    first, last = int(first), int(last) if last else None
+    if last is not None and last < first:
+        return None # Invalid range spec; ignored
+    if first >= size:
+        raise ValueError("Range starts beyond the end of the file.")
+    return first, size - 1 if last is None else min(last, size - 1)
+
+
+def not_modified(request, etag, mtime):
+    """Returns True if the request's validators show the client's copy is current."""
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return if_none_match.strip() == '*' or etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    return since is not None and int(mtime) <= since
+
+
+class RangeFile:
+    """
+    A read-only view of `length` bytes of an open file starting at its current
+    position. Keeps `fileno()` so sendfile-capable file wrappers can still use it.
+    """
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def serve_attachment(request, message, size=None):
+    """
+    Returns the response for a download of a message's attachment. The caller
+    has checked that the user may see the message.
+
+    Args:
+        request (HttpRequest): The GET or HEAD request.
+        message (GroupChatMessage): A message with a file attachment.
+        size (str, optional): A `content.derivatives.DERIVATIVE_SIZES` key; image
+            attachments are then served inline at that size once the derivative
+            is rendered, and as the original until then.
+
+    Returns:
+        HttpResponse: 200, 206, 304 or 416, or a redirect for remote storages.
+    """
+    field = message.file_attachment
+    try:
+        path = field.path
+    except NotImplementedError:
+        return HttpResponseRedirect(field.url)
+    name, file_name = field.name, os.path.basename(field.name)
+    if size in DERIVATIVE_SIZES and is_image(file_name):
+        derivative = derivative_path(path, size, wait=DERIVATIVE_WAIT)
+        if derivative:
+            path, name = derivative, os.path.relpath(derivative, settings.MEDIA_ROOT)
+            file_name = f'{os.path.splitext(file_name)[0]}-{size}.{DERIVATIVE_EXTENSION}'
+    return serve_file(request, path, name, file_name, as_attachment=size is None)
+
+
+def serve_file(request, path, name, file_name, as_attachment=True):
+    """
+    Returns the response for a download of a file under `MEDIA_ROOT`.
+
+    Args:
+        request (HttpRequest): The GET or HEAD request.
+        path (str): Absolute path of the file.
+        name (str): The path relative to `MEDIA_ROOT`, for X-Accel-Redirect.
+        file_name (str): The name the client sees.
+        as_attachment (bool): Ask the browser to save the file rather than show it.
+
+    Returns:
+        HttpResponse: 200, 206, 304, 404 or 416.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return HttpResponse(status=404)
+
+    disposition = 'attachment' if as_attachment else 'inline'
+    mode = getattr(settings, 'GROUPCHAT_ATTACHMENT_SENDFILE', '')
+    if mode:
+        # The proxy serves the bytes and answers Range and conditional requests with its own validators.
+        response = HttpResponse(content_type=mimetypes.guess_type(file_name)[0] or 'application/octet-stream')
+        if mode == 'x-accel-redirect':
+            prefix = getattr(settings, 'GROUPCHAT_ATTACHMENT_ACCEL_PREFIX', '/protected-media/')
+            response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(name.replace(os.sep, '/'))
+        else:
+            response['X-Sendfile'] = path
+        response['Content-Disposition'] = f"{disposition}; filename*=UTF-8''{quote(file_name)}"
+        return response
+
+    etag = make_etag(stat)
+    validators = {'ETag': etag, 'Last-Modified': http_date(stat.st_mtime)}
+    if not_modified(request, etag, stat.st_mtime):
+        return HttpResponseNotModified(headers=validators)
+
+    size = stat.st_size
+    byte_range = None
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    if range_header and (not if_range or if_range.strip() in (etag, validators['Last-Modified'])):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    headers = {**validators, 'Accept-Ranges': 'bytes', 'Cache-Control': 'private, max-age=0, must-revalidate'}
+    file = open(path, 'rb')
+    if not byte_range:
+        return FileResponse(file, as_attachment=as_attachment, filename=file_name, headers=headers)
+    first, last = byte_range
+    file.seek(first)
+    response = FileResponse(
+        RangeFile(file, last - first + 1), as_attachment=as_attachment, filename=file_name, status=206, headers=headers
+    )
+    response['Content-Range'] = f'bytes {first}-{last}/{size}'
+    response['Content-Length'] = str(last - first + 1)
+    return response
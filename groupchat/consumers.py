@@ -4,17 +4,85 @@ WebSocket consumers for the group chat application.
 This module handles WebSocket connections, message broadcasting, and real-time
 communication for group chats. It integrates with Django Channels for asynchronous
 operations and database access.
+
+`ChatConsumer` serves one group per connection (`ws/chat/<group_id>/`).
+`MultiplexChatConsumer` serves every group a user subscribes to over a single
+connection (`ws/chat/`):
+
+    -> {'type': 'subscribe', 'group': 12, 'last_id': 345}   last_id optional, as `?last_id=`
+    <- {'type': 'subscribed', 'group': 12}, then the group's presence snapshot and replay
+    -> {'type': 'unsubscribe', 'group': 12}
+    <- {'type': 'unsubscribed', 'group': 12}
+
+Every other client frame names its group in 'group' and is handled as on a
+per-group connection; every frame about a group carries it in 'group' on both
+endpoints (broadcasts are encoded once for all of them). Each subscription is
+one channel-layer group membership and presence entry; the connection, its
+outbound queue, upload slots and auth handshake are shared. A refused
+subscription is answered with `subscribe.error` ('code' is 'invalid',
+'not_member', 'too_many_subscriptions', 'group_full' or 'moved'); a frame
+that is not a map, or names a group that is not subscribed, with
+`message.error` (coded 'not_subscribed' in the latter case).
+
+Both consumers admit connections through `groupchat.admission`, which caps
+the sockets per process, user and group; a refused connection gets a
+`connect.rejected` frame and is closed with 4013, 4029 or, while the worker
+drains, 4012. A draining worker (`groupchat.drain`) sends every connection a
+`{'type': 'reconnect', 'after': <seconds>}` frame. With room-affinity routing
+(`groupchat.affinity`) a per-group connection reaching a worker outside its
+room's pool gets that frame with the pool's 'url' and is closed with 4307.
+
+Settings:
+    GROUPCHAT_MUX_MAX_SUBSCRIPTIONS (int): Groups one multiplexed connection may
+        subscribe to. Defaults to 50.
+    GROUPCHAT_MUX_MAX_CONNECTIONS (int): Multiplexed connections per user and
+        process; a further one closes the user's oldest with code 4009. Defaults to 5.
 """
-import json
+import asyncio
 import logging # Import logging
+import random
+import weakref
+from datetime import datetime
+from urllib.parse import parse_qs
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async # For database operations
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from discussions.models import DiscussionGroup, GroupMembership
+from discussions.membership import ais_member
+from . import metrics
+from .admission import CLOSE_CODES, SERVICE_RESTART_CLOSE_CODE, get_admission_controller, rejection_frame
+from .affinity import (
+    MOVED_CLOSE_CODE, aroute, dedicated_pools, get_room_tracker, local_pool, misrouted, move_frame, pool_address,
+    stats as affinity_stats,
+)
+from .attachments import attachment_url
+from .batching import broadcast
+from .history import acursor_for_message, afetch_page, encode_cursor, serialize_message
 from .models import GroupChatMessage
+from .outbound import OutboundQueue
+from .persistence import get_message_writer, write_behind_enabled
+from .presence import get_presence_hub
+from .ratelimit import message_rate_limiter
+from .unread import get_read_marker
+from .recorder import get_traffic_recorder
+from .uploads import ChunkedUpload, UploadError, chunk_size, decode_chunk, is_chunk_frame, window
+from .wire import encode_for_broadcast, negotiate_codec
 
 User = get_user_model()
+
+SLOW_CONSUMER_CLOSE_CODE = 4008 # Outbound queue overflowed under the 'disconnect' policy, or held nothing to drop
+REPLACED_CLOSE_CODE = 4009 # The user opened more multiplexed connections than allowed
 logger = logging.getLogger(__name__) # Get a logger instance
+throttled_log = metrics.RateLimitedLog(logger) # For warnings a misbehaving client can trigger once per frame
+
+multiplex_stats = {'connections': 0, 'replaced': 0, 'subscriptions': 0, 'subscribe_refused': 0}
+
+
+def room_group_name(group_id):
+    """Returns the channel layer group of a discussion group's chat room."""
+    return f'chat_{group_id}'
+
 
 class ChatConsumer(AsyncWebsocketConsumer):
     """
@@ -32,38 +100,127 @@ class ChatConsumer(AsyncWebsocketConsumer):
         adds the connection to the appropriate channel layer group and accepts
         the WebSocket connection.
         """
-        self.group_id = self.scope['url_route']['kwargs']['group_id']
-        self.room_group_name = f'chat_{self.group_id}'
+        self.group_id = int(self.scope['url_route']['kwargs']['group_id'])
+        self.room_group_name = room_group_name(self.group_id)
         self.user = self.scope['user']
-        logger.info(f"Connect Step 1: User {self.user} attempting to connect to group {self.group_id}.") # Reverted to INFO
-        logger.error(f"ERROR_LOG: Connect Step 1: User {self.user}, Group {self.group_id}")
+        self.codec = negotiate_codec(self.scope.get('subprotocols'))
+        logger.debug("User %s attempting to connect to group %s.", self.user, self.group_id)
 
         if not self.user or not self.user.is_authenticated:
-            logger.warning(f"User {self.user} is not authenticated. Closing connection to group {self.group_id}.")
-            logger.error(f"ERROR_LOG: Connect Step 2a - Not authenticated. Closing. User {self.user}, Group {self.group_id}")
+            throttled_log.log(logging.WARNING, 'connect.anonymous', "Unauthenticated WebSocket connection to group %s closed.", self.group_id)
             await self.close()
             return
-        logger.error(f"ERROR_LOG: Connect Step 2b - Authenticated. User {self.user}, Group {self.group_id}")
 
-        is_member = await self.is_user_member(self.user, self.group_id)
-        logger.error(f"ERROR_LOG: Connect Step 3 - is_member call returned: {is_member}. User {self.user}, Group {self.group_id}")
+        with metrics.track('membership'):
+            is_member = await self.is_user_member(self.user, self.group_id)
         if not is_member:
-            logger.warning(f"User {self.user} is not a member of group {self.group_id}. Closing connection.")
-            logger.error(f"ERROR_LOG: Connect Step 4a - Not member. Closing. User {self.user}, Group {self.group_id}")
+            throttled_log.log(logging.WARNING, 'connect.not_member', "User %s is not a member of group %s. Closing connection.", self.user.id, self.group_id)
             await self.close()
             return
-        logger.error(f"ERROR_LOG: Connect Step 4b - Is member. User {self.user}, Group {self.group_id}")
 
-        logger.info(f"User {self.user} successfully connected to group {self.group_id}. Adding to channel layer.")
-        logger.error(f"ERROR_LOG: Connect Step 5 - Before group_add. User {self.user}, Group {self.group_id}")
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
-        logger.error(f"ERROR_LOG: Connect Step 6 - After group_add, before accept. User {self.user}, Group {self.group_id}")
-        await self.accept()
-        logger.info(f"WebSocket accepted for user {self.user} in group {self.group_id}.")
-        logger.error(f"ERROR_LOG: Connect Step 7 - After accept. User {self.user}, Group {self.group_id}")
+        pool = await aroute(self.group_id)
+        if misrouted(pool):
+            await self.redirect(pool)
+            return
+
+        self.admission = get_admission_controller()
+        refusal = self.admission.admit(self.channel_name, self.user.id, self.group_id)
+        if refusal:
+            throttled_log.log(logging.WARNING, f'connect.{refusal}', "Refused connection of user %s to group %s (%s).", self.user.id, self.group_id, refusal)
+            await self.reject(refusal)
+            return
+        self.admitted = True
+
+        with metrics.track('group_add'):
+            await self.channel_layer.group_add(
+                self.room_group_name,
+                self.channel_name
+            )
+        await self.accept(subprotocol=self.codec.subprotocol)
+        self.start_session()
+        self.rooms.join(self.group_id)
+        self.tracked = True
+        logger.debug("WebSocket accepted for user %s in group %s (%s frames).", self.user.id, self.group_id, self.codec.name)
+
+        recorder = get_traffic_recorder()
+        self.recording = recorder.open(self) if recorder else None # Opt-in traffic capture for replay
+
+        self.presence.join(self.group_id, self.channel_name, self.user.id, self.sender['user_full_name'])
+        await self.send_frame(await self.presence.snapshot(self.group_id))
+
+        # Live events queue up in this consumer's channel while the replay runs,
+        # and are only dispatched once connect() returns.
+        last_id = self.query.get('last_id', [None])[0]
+        if last_id:
+            await self.replay_missed_messages(self.group_id, last_id)
+
+    async def reject(self, code):
+        """
+        Refuses the connection: accepts it only to send a `connect.rejected`
+        frame telling the client how long to wait, then closes it with the
+        matching code (see `groupchat.admission`).
+
+        Args:
+            code (str): The refusal code, e.g. 'too_many_connections'.
+        """
+        await self.accept(subprotocol=self.codec.subprotocol)
+        await self.send(**self.codec.send_kwargs(self.codec.encode(rejection_frame(code))))
+        await self.close(code=CLOSE_CODES[code])
+
+    async def redirect(self, pool):
+        """
+        Sends a connection for a room this worker's pool does not serve to the
+        room's pool (see `groupchat.affinity`): accepts it only to send a
+        `reconnect` frame with the pool's address, then closes it.
+
+        Args:
+            pool (str): The name of the pool serving the room.
+        """
+        affinity_stats['redirected'] += 1
+        await self.accept(subprotocol=self.codec.subprotocol)
+        await self.send(**self.codec.send_kwargs(self.codec.encode(move_frame(pool))))
+        await self.close(code=MOVED_CLOSE_CODE)
+
+    async def chat_route(self, event):
+        """
+        Handles a change of the room's pool (see `groupchat.affinity`): unless
+        this worker belongs to the new pool, tells the client to reconnect
+        there at a random point of the move window, and closes the connection
+        if it is still here when the next notice comes.
+        """
+        if not misrouted(event['pool']):
+            return
+        if getattr(self, 'moving', False):
+            await self.close(code=MOVED_CLOSE_CODE)
+            return
+        self.moving = True
+        await self.send_frame({'type': 'reconnect', 'after': round(random.uniform(0, event['window']), 1), 'url': event['url']})
+
+    async def chat_drain(self, event):
+        """
+        Handles the worker's drain notice (see `groupchat.drain`): tells the
+        client to reconnect after `event['after']` seconds, or closes the
+        connection with code 4012 once the drain timed out.
+        """
+        if event.get('close'):
+            await self.close(code=SERVICE_RESTART_CLOSE_CODE)
+        else:
+            await self.send_frame({'type': 'reconnect', 'after': event['after']})
+
+    def start_session(self):
+        """
+        Sets up the per-connection state of an accepted connection: the
+        outbound queue, open uploads, resume positions and the query options.
+        """
+        # Resolve the sender display payload once per connection instead of once per message.
+        self.sender = self.get_sender_payload(self.user)
+        self.outbound = OutboundQueue(self.send, self.build_skipped_frame)
+        self.uploads = {} # upload_id -> ChunkedUpload started on this connection
+        self.resume_positions = {} # group_id -> position of the last replayed message, until live messages pass it
+        self.query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.batch_frames = self.query.get('batch') == ['1'] # The client unpacks array frames (see `chat_batch`)
+        self.presence = get_presence_hub()
+        self.rooms = get_room_tracker()
 
     async def disconnect(self, close_code):
         """
@@ -74,80 +231,289 @@ class ChatConsumer(AsyncWebsocketConsumer):
         Args:
             close_code: The code indicating the reason for disconnection.
         """
-        logger.error(f"ERROR_LOG: Disconnect called. User {self.user}, Group {self.group_id}, Code: {close_code}") # Add error log here
-        logger.info(f"User {self.user} disconnecting from group {self.group_id} with code: {close_code}")
+        logger.debug("User %s disconnecting from group %s with code: %s", getattr(self, 'user', None), getattr(self, 'group_id', None), close_code)
         if hasattr(self, 'room_group_name') and hasattr(self, 'channel_name'):
              await self.channel_layer.group_discard(
                 self.room_group_name,
                 self.channel_name
             )
-        logger.info(f"User {self.user} removed from channel layer for group {self.group_id}.")
-
-    async def receive(self, text_data):
+        if getattr(self, 'admitted', False):
+            self.admission.release(self.channel_name, self.user.id, self.group_id)
+        if getattr(self, 'tracked', False):
+            self.rooms.leave(self.group_id)
+        if hasattr(self, 'outbound'):
+            self.outbound.close()
+        if hasattr(self, 'presence'):
+            self.presence.leave(self.group_id, self.channel_name)
+        if getattr(self, 'recording', None):
+            self.recording.disconnect(close_code)
+        # Unfinished uploads stay on disk so the client can resume them after reconnecting.
+        for upload in getattr(self, 'uploads', {}).values():
+            await sync_to_async(upload.close, thread_sensitive=False)()
+
+    async def receive(self, text_data=None, bytes_data=None):
         """
         Handles incoming messages from a WebSocket connection.
 
-        Parses the message (expected to be JSON), validates its content,
-        saves it to the database, and then broadcasts it to the channel layer group.
-        If an error occurs during processing (e.g., invalid JSON, save failure),
-        an error message may be sent back to the originating client.
+        Decodes the message with the connection's negotiated codec (JSON text or
+        msgpack binary) and hands it to `handle_frame`. Binary upload chunks go
+        to `receive_upload_chunk`.
 
         Args:
-            text_data (str): The raw message data received from the WebSocket,
-                             expected to be a JSON string containing 'message' and 'temp_id'.
+            text_data (str): A JSON text frame containing 'message' and 'temp_id'.
+            bytes_data (bytes): A msgpack binary frame with the same fields.
         """
-        logger.info(f"Received message from user {self.user} in group {self.group_id}: {text_data}")
+        logger.debug("Received frame from user %s in group %s.", self.user.id, self.group_id)
+        self.presence.touch(self.group_id, self.channel_name) # Any frame counts as a heartbeat
+        if self.recording:
+            self.recording.receive(text_data, bytes_data)
+        if is_chunk_frame(bytes_data):
+            await self.receive_upload_chunk(bytes_data)
+            return
         try:
-            text_data_json = json.loads(text_data)
-            message_text = text_data_json.get('message')
-            temp_id = text_data_json.get('temp_id') 
+            frame = self.codec.decode(text_data, bytes_data)
+        except ValueError as e:
+            throttled_log.log(logging.WARNING, 'receive.invalid', "Invalid frame from user %s in group %s: %s", self.user.id, self.group_id, e)
+            return
+        await self.handle_frame(self.group_id, frame)
 
-            if not message_text:
-                logger.warning(f"Received empty message text from {self.user} (temp_id: {temp_id}). Ignoring.")
+    async def handle_frame(self, group_id, frame):
+        """
+        Handles a decoded client frame addressed to a group.
+
+        Validates a chat message, saves it to the database, and then broadcasts
+        it to the channel layer group; `upload.*` control frames are handed to
+        the upload handlers. If an error occurs during processing (e.g., invalid
+        frame, save failure), an error message may be sent back to the
+        originating client.
+
+        Args:
+            group_id (int): The group the frame is for.
+            frame (dict): The frame, with long field names.
+        """
+        if not isinstance(frame, dict):
+            throttled_log.log(logging.WARNING, 'receive.invalid', "Invalid frame from user %s in group %s: not a map.", self.user.id, group_id)
+            await self.send_frame({'type': 'message.error', 'group': group_id, 'error': 'Frames must be JSON objects.'})
+            return
+        try:
+            if frame.get('type') == 'heartbeat':
+                return
+            if frame.get('type') == 'typing':
+                self.presence.typing(group_id, self.user.id)
+                return
+            if frame.get('type') == 'read':
+                if isinstance(frame.get('id'), int) and not isinstance(frame['id'], bool):
+                    get_read_marker().mark(self.user.id, group_id, frame['id'])
+                return
+            if frame.get('type') == 'upload.start':
+                if await self.check_rate_limit(group_id, frame.get('temp_id')):
+                    await self.start_upload(group_id, frame)
+                return
+            if frame.get('type') == 'upload.cancel':
+                await self.cancel_upload(frame.get('upload_id'))
+                return
+            message_text = frame.get('message')
+            temp_id = frame.get('temp_id') 
+
+            if not message_text or not isinstance(message_text, str):
+                throttled_log.log(logging.WARNING, 'receive.empty', "Received empty message text from user %s (temp_id: %s). Ignoring.", self.user.id, temp_id)
+                return
+            if not await self.check_rate_limit(group_id, temp_id):
                 return
 
-            logger.info(f"Attempting to save message for user {self.user}, group {self.group_id}, temp_id {temp_id}.")
-            chat_message = await self.save_message(self.user, self.group_id, message_text)
+            if write_behind_enabled():
+                # Broadcast right away; the per-process writer batches the INSERT and
+                # reports a failure back to this channel as `message.error`.
+                chat_message = get_message_writer().enqueue(
+                    self.user.id, group_id, message_text, temp_id=temp_id, reply_channel=self.channel_name
+                )
+            else:
+                with metrics.track('db_save'):
+                    chat_message = await self.save_message(self.user, group_id, message_text)
             
             if not chat_message:
-                logger.error(f"Failed to save message for user {self.user}, group {self.group_id}, temp_id {temp_id}.")
                 if temp_id:
-                    await self.send(text_data=json.dumps({
+                    await self.send_frame({
                         'type': 'message.error',
+                        'group': group_id,
                         'temp_id': temp_id,
                         'error': 'Message could not be saved due to a server issue.'
-                    }))
+                    })
                 return
-            
-            logger.info(f"Message saved (ID: {chat_message.id}) for user {self.user}. Broadcasting to group {self.group_id}.")
-            user_full_name = await self.get_user_full_name(self.user)
-            logger.info(f"Retrieved full name '{user_full_name}' for user {self.user}.")
 
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'chat.message',
-                    'message_id': chat_message.id,
-                    'temp_id': temp_id, 
-                    'user_id': self.user.id,
-                    'username': self.user.username,
-                    'user_full_name': user_full_name,
-                    'text': chat_message.text_content,
-                    'timestamp': chat_message.timestamp.isoformat(),
-                }
-            )
-            logger.info(f"Message (ID: {chat_message.id}, temp_id: {temp_id}) broadcasted to group {self.room_group_name}.")
-        except json.JSONDecodeError as e:
-            logger.error(f"JSONDecodeError in receive for user {self.user}, group {self.group_id}: {e}. Data: {text_data}")
+            event = {
+                'type': 'chat.message',
+                'group_id': group_id,
+                'message_id': chat_message.id,
+                'temp_id': temp_id, 
+                **self.sender,
+                'text': chat_message.text_content,
+                'timestamp': chat_message.timestamp.isoformat(),
+            }
+            await self.broadcast_message(event)
+        except ValueError as e:
+            throttled_log.log(logging.WARNING, 'receive.invalid', "Invalid frame from user %s in group %s: %s", self.user.id, group_id, e)
         except Exception as e:
-            logger.error(f"Generic Exception in receive for user {self.user}, group {self.group_id}: {e}", exc_info=True) # Log full traceback
+            throttled_log.log(logging.ERROR, 'receive.error', "Unexpected error in receive for user %s, group %s: %s", self.user.id, group_id, e, exc_info=True)
             # Optionally, send a generic error to the client if a temp_id was available
             if locals().get('temp_id'):
-                 await self.send(text_data=json.dumps({
+                 await self.send_frame({
                     'type': 'message.error',
+                    'group': group_id,
                     'temp_id': locals().get('temp_id'),
                     'error': 'An unexpected server error occurred.'
-                }))
+                })
+
+    async def check_rate_limit(self, group_id, temp_id):
+        """
+        Takes a token from the sender's and the room's rate-limit buckets.
+
+        When either is empty the client gets a `message.error` frame with
+        `code: 'rate_limited'` and the seconds to wait in `retry_after`.
+
+        Args:
+            group_id (int): The room the message is for.
+            temp_id (str): The client's id for the rejected message, if any.
+
+        Returns:
+            bool: True if the message may proceed.
+        """
+        scope, retry_after = message_rate_limiter.check(self.user.id, group_id)
+        if scope is None:
+            return True
+        throttled_log.log(logging.WARNING, f'ratelimit.{scope}', "Rate limited user %s in group %s (%s limit).", self.user.id, group_id, scope)
+        await self.send_frame({
+            'type': 'message.error',
+            'group': group_id,
+            'code': 'rate_limited',
+            'temp_id': temp_id,
+            'retry_after': round(retry_after, 2),
+            'error': (
+                'You are sending messages too quickly. Please wait a moment.' if scope == 'user'
+                else 'This chat is very busy right now. Please wait a moment.'
+            ),
+        })
+        return False
+
+    async def broadcast_message(self, event):
+        """
+        Encodes a `chat.message` event once per wire format and sends it to
+        the room, batched with other messages when the room is busy (see
+        `batching`). The sender has read their own message, so it also
+        advances their read watermark.
+
+        Args:
+            event (dict): The channel layer event (see `chat_message`).
+        """
+        # Serialize once per wire format here rather than once per recipient.
+        with metrics.track('encode'):
+            event['encoded'] = encode_for_broadcast(self.build_message_frame(event))
+        with metrics.track('group_send'):
+            await broadcast(self.channel_layer, room_group_name(event['group_id']), event)
+        self.rooms.observe(event['group_id'])
+        get_read_marker().mark(self.user.id, event['group_id'], event['message_id'], datetime.fromisoformat(event['timestamp']))
+
+    async def start_upload(self, group_id, frame):
+        """
+        Starts (or resumes) a chunked upload and tells the client where to continue.
+
+        Args:
+            group_id (int): The group the file is sent to.
+            frame (dict): An `upload.start` frame with 'file_name', 'size',
+                          'temp_id' and optionally 'message' and 'upload_id'.
+        """
+        temp_id = frame.get('temp_id')
+        max_open = getattr(settings, 'GROUPCHAT_UPLOAD_MAX_OPEN', 4)
+        try:
+            if len(self.uploads) >= max_open and frame.get('upload_id') not in self.uploads:
+                raise UploadError(f"At most {max_open} uploads may run at once.")
+            previous = self.uploads.pop(frame.get('upload_id'), None)
+            if previous:
+                await sync_to_async(previous.close, thread_sensitive=False)()
+            upload = await sync_to_async(ChunkedUpload.open, thread_sensitive=False)(
+                self.user.id, group_id, frame.get('file_name'), frame.get('size'),
+                upload_id=frame.get('upload_id'), text=frame.get('message'), temp_id=temp_id,
+            )
+        except UploadError as e:
+            await self.send_frame({'type': 'message.error', 'group': group_id, 'temp_id': temp_id, 'error': str(e)})
+            return
+        self.uploads[upload.upload_id] = upload
+        await self.send_frame({
+            'type': 'upload.ready',
+            'group': group_id,
+            'temp_id': temp_id,
+            'upload_id': upload.upload_id,
+            'offset': upload.offset,
+            'chunk_size': chunk_size(),
+            'window': window(),
+        })
+
+    async def receive_upload_chunk(self, bytes_data):
+        """
+        Writes one binary chunk frame to its upload's part file and acknowledges it.
+
+        A chunk that does not start at the upload's current offset is dropped
+        and answered with the current offset, so the client rewinds. The last
+        chunk finalizes the upload into a message that is broadcast to the room.
+
+        Args:
+            bytes_data (bytes): The frame built by `uploads.encode_chunk`.
+        """
+        try:
+            upload_id, offset, data = decode_chunk(bytes_data)
+        except UploadError as e:
+            throttled_log.log(logging.WARNING, 'upload.invalid', "Invalid upload chunk from user %s: %s", self.user.id, e)
+            return
+        upload = self.uploads.get(upload_id)
+        if upload is None:
+            await self.send_frame({'type': 'message.error', 'upload_id': upload_id, 'error': 'Unknown upload; start it again.'})
+            return
+        if offset == upload.offset:
+            try:
+                with metrics.track('upload_write'):
+                    await sync_to_async(upload.write, thread_sensitive=False)(data)
+            except UploadError as e:
+                await self.abort_upload(upload, str(e))
+                return
+        await self.send_frame({'type': 'upload.ack', 'group': upload.group_id, 'upload_id': upload_id, 'offset': upload.offset})
+        if upload.complete:
+            await self.finish_upload(upload)
+
+    async def finish_upload(self, upload):
+        """Stores a completed upload as a message and broadcasts it."""
+        del self.uploads[upload.upload_id]
+        try:
+            with metrics.track('upload_finalize'):
+                chat_message = await database_sync_to_async(upload.finalize)()
+        except Exception as e:
+            throttled_log.log(logging.ERROR, 'upload.finalize_error', "Could not store upload %s for user %s: %s", upload.upload_id, self.user.id, e, exc_info=True)
+            await self.abort_upload(upload, 'File could not be saved due to a server issue.')
+            return
+        await self.broadcast_message({
+            'type': 'chat.message',
+            'group_id': upload.group_id,
+            'message_id': chat_message.id,
+            'temp_id': upload.temp_id,
+            **self.sender,
+            'text': chat_message.text_content or '',
+            'file_url': attachment_url(chat_message),
+            'file_name': chat_message.file_attachment.name.rsplit('/', 1)[-1], # The storage may have renamed it
+            'timestamp': chat_message.timestamp.isoformat(),
+        })
+
+    async def abort_upload(self, upload, error):
+        """Deletes an upload and reports `error` to the client."""
+        self.uploads.pop(upload.upload_id, None)
+        await sync_to_async(upload.discard, thread_sensitive=False)()
+        await self.send_frame({
+            'type': 'message.error', 'group': upload.group_id, 'temp_id': upload.temp_id, 'upload_id': upload.upload_id, 'error': error,
+        })
+
+    async def cancel_upload(self, upload_id):
+        """Deletes an upload of this connection at the client's request."""
+        upload = self.uploads.pop(upload_id, None)
+        if upload:
+            await sync_to_async(upload.discard, thread_sensitive=False)()
 
     async def chat_message(self, event):
         """
@@ -157,13 +523,106 @@ class ChatConsumer(AsyncWebsocketConsumer):
         This method is typically called by the channel layer after a message
         is broadcast using `group_send`.
 
+        Forwards the frame pre-encoded for this connection's wire format when
+        the event carries one, and only encodes it here otherwise.
+
         Args:
             event (dict): A dictionary containing the message details to be sent,
-                          including 'message_id', 'user_id', 'username',
-                          'user_full_name', 'text', 'timestamp', and optionally 'temp_id'.
+                          including 'group_id', 'message_id', 'user_id', 'username',
+                          'user_full_name', 'text', 'timestamp', and optionally
+                          'temp_id' and 'encoded' (see `wire.encode_for_broadcast`).
+        """
+        if self.already_replayed(event.get('group_id', self.group_id), event['timestamp'], event['message_id']):
+            return
+        payload = event.get('encoded', {}).get(self.codec.name)
+        if payload is None:
+            payload = self.codec.encode(self.build_message_frame({'group_id': self.group_id, **event}))
+        self.rooms.deliver(event.get('group_id', self.group_id))
+        await self.push(self.codec.send_kwargs(payload))
+
+    async def chat_batch(self, event):
+        """
+        Sends the messages of a `chat.batch` event (see `batching.RoomBatcher`)
+        to the WebSocket client: as one array frame if the client connected
+        with `?batch=1`, otherwise as one frame per message.
+
+        Args:
+            event (dict): Carries the room's 'group_id', the messages'
+                          `[timestamp, message_id]` in 'positions' and their
+                          pre-encoded frames in 'encoded'.
+        """
+        group_id = event.get('group_id', self.group_id)
+        payloads = [
+            encoded[self.codec.name]
+            for (timestamp, message_id), encoded in zip(event['positions'], event['encoded'])
+            if not self.already_replayed(group_id, timestamp, message_id)
+        ]
+        self.rooms.deliver(group_id, len(payloads))
+        if self.batch_frames and len(payloads) > 1:
+            await self.push(self.codec.send_kwargs(self.codec.encode_batch(payloads)))
+            return
+        for payload in payloads:
+            await self.push(self.codec.send_kwargs(payload))
+
+    def already_replayed(self, group_id, timestamp, message_id):
+        """
+        Returns True for live messages of a group the resume replay already
+        delivered. The first newer message ends the check for that group.
+        """
+        position = self.resume_positions.get(group_id)
+        if position:
+            if (datetime.fromisoformat(timestamp), message_id) <= position:
+                return True
+            del self.resume_positions[group_id]
+        return False
+
+    async def push(self, kwargs):
+        """
+        Queues a frame pushed by the room on the bounded outbound queue, and
+        closes the connection if it overflows under the `disconnect` policy.
+
+        Args:
+            kwargs (dict): `send()` keyword arguments of the encoded frame.
         """
-        logger.info(f"Sending chat_message event to client {self.channel_name} in group {self.group_id}: {event}")
-        await self.send(text_data=json.dumps({
+        if not self.outbound.put(kwargs) and not self.outbound.overflowed:
+            self.outbound.overflowed = True
+            throttled_log.log(logging.WARNING, 'outbound.overflow', "Closing slow connection of user %s.", self.user.id)
+            await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    def build_skipped_frame(self, count):
+        """
+        Returns the `send()` kwargs of the frame telling a slow client that
+        `count` frames were dropped; the client reconnects to resume.
+        """
+        return self.codec.send_kwargs(self.codec.encode({'type': 'messages.skipped', 'count': count}))
+
+    async def presence_delta(self, event):
+        """
+        Forwards a room's merged presence changes (see `presence.PresenceHub`)
+        to the client, pre-encoded for its wire format.
+
+        Args:
+            event (dict): Carries the frame in 'encoded', keyed by codec name.
+        """
+        await self.push(self.codec.send_kwargs(event['encoded'][self.codec.name]))
+
+    async def presence_expired(self, event):
+        """Closes a connection the presence hub stopped hearing heartbeats from."""
+        await self.close()
+
+    @staticmethod
+    def build_message_frame(event):
+        """
+        Builds the client-facing frame of a `chat.message` event.
+
+        Args:
+            event (dict): The channel layer event (see `chat_message`).
+
+        Returns:
+            dict: The frame with long field names and an ISO timestamp.
+        """
+        frame = {
+            'group': event['group_id'],
             'id': event['message_id'],
             'temp_id': event.get('temp_id'), 
             'user_id': event['user_id'],
@@ -172,23 +631,91 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'text': event['text'],
             'timestamp': event['timestamp'],
             'message_type': 'new_message' 
-        }))
-        logger.info(f"chat_message event sent to client {self.channel_name}.")
+        }
+        if event.get('file_url'):
+            frame['file_url'] = event['file_url']
+            frame['file_name'] = event['file_name']
+        return frame
+
+    async def send_frame(self, frame):
+        """
+        Encodes a frame with this connection's negotiated codec and queues it
+        for sending. Unlike room broadcasts these frames are never dropped;
+        this waits for space in the outbound queue instead.
 
-    # Future: Handler for specific message error events if needed
-    # async def message_error(self, event):
-    #     await self.send(text_data=json.dumps({
-    #         'type': 'message.error',
-    #         'temp_id': event['temp_id'],
-    #         'error': event['error'],
-    #     }))
+        Args:
+            frame (dict): The frame, with long field names.
+        """
+        await self.outbound.put_wait(self.codec.send_kwargs(self.codec.encode(frame)))
+
+    async def replay_missed_messages(self, group_id, last_id):
+        """
+        Replays the messages of a group stored after the client's last seen message.
+
+        Messages are read in keyset batches of `GROUPCHAT_RESUME_BATCH_SIZE` and
+        at most `GROUPCHAT_RESUME_MAX_MESSAGES` are replayed. The replay ends with
+        a `resume.complete` frame; when `truncated` is true the gap was too large
+        and the client should reload the history instead.
 
-    @database_sync_to_async
-    def is_user_member(self, user, group_id):
+        Args:
+            group_id (int): The group to replay.
+            last_id (str or int): The id of the last message the client has rendered.
+        """
+        if write_behind_enabled():
+            # Before resolving the cursor: `last_id` is often a message that was broadcast but is still queued.
+            await get_message_writer().flush()
+        try:
+            cursor = await acursor_for_message(group_id, int(last_id))
+        except (TypeError, ValueError):
+            cursor = None
+        if cursor is None:
+            throttled_log.log(logging.WARNING, 'resume.unknown', "Resume requested from unknown message %r in group %s.", last_id, group_id)
+            await self.send_frame({'type': 'resume.complete', 'group': group_id, 'replayed': 0, 'truncated': True})
+            return
+
+        batch_size = getattr(settings, 'GROUPCHAT_RESUME_BATCH_SIZE', 100)
+        max_messages = getattr(settings, 'GROUPCHAT_RESUME_MAX_MESSAGES', 1000)
+        replayed, has_more = 0, True
+        while has_more and replayed < max_messages:
+            page, has_more = await afetch_page(group_id, after=cursor, limit=min(batch_size, max_messages - replayed))
+            if not page:
+                break
+            for message in page:
+                await self.send_frame({
+                    **serialize_message(message), 'group': group_id, 'message_type': 'new_message', 'replayed': True,
+                })
+            replayed += len(page)
+            cursor = encode_cursor(page[-1])
+            self.resume_positions[group_id] = (page[-1].timestamp, page[-1].id)
+
+        logger.debug("Replayed %s missed messages to user %s in group %s.", replayed, self.user.id, group_id)
+        await self.send_frame({'type': 'resume.complete', 'group': group_id, 'replayed': replayed, 'truncated': has_more})
+
+    async def message_error(self, event):
+        """
+        Sends a `message.error` event addressed to this connection to the client.
+
+        Sent by the write-behind writer when a message that was already
+        broadcast could not be persisted.
+
+        Args:
+            event (dict): Contains the 'group_id' and 'temp_id' of the failed
+                          message and an 'error' text.
+        """
+        await self.send_frame({
+            'type': 'message.error',
+            'group': event.get('group_id'),
+            'temp_id': event['temp_id'],
+            'error': event['error'],
+        })
+
+    async def is_user_member(self, user, group_id):
         """
         Checks if a given user is a member of the specified discussion group.
 
-        This method performs a synchronous database query in an asynchronous context.
+        Goes through the shared membership cache, so reconnects only reach the
+        database on a cache miss. A membership row can only exist for an
+        existing group, so no `DiscussionGroup` lookup is needed.
 
         Args:
             user (User): The user instance to check.
@@ -197,25 +724,18 @@ class ChatConsumer(AsyncWebsocketConsumer):
         Returns:
             bool: True if the user is a member, False otherwise.
         """
-        logger.info(f"Checking membership for user {user.id} in group {group_id}")
         try:
-            group = DiscussionGroup.objects.get(id=group_id)
-            is_member = GroupMembership.objects.filter(user=user, group=group).exists()
-            logger.info(f"User {user.id} membership status in group {group_id}: {is_member}")
-            return is_member
-        except DiscussionGroup.DoesNotExist:
-            logger.error(f"DiscussionGroup with id {group_id} DoesNotExist in is_user_member for user {user.id}.")
-            return False
+            return await ais_member(user.id, group_id)
         except Exception as e:
-            logger.error(f"Exception in is_user_member for user {user.id}, group {group_id}: {e}", exc_info=True)
+            throttled_log.log(logging.ERROR, 'membership.error', "Exception in is_user_member for user %s, group %s: %s", user.id, group_id, e, exc_info=True)
             return False # Important to return a boolean
 
-    @database_sync_to_async
-    def save_message(self, user, group_id, message_text):
+    async def save_message(self, user, group_id, message_text):
         """
         Saves a new chat message to the database.
 
-        This method performs a synchronous database query in an asynchronous context.
+        Writes by `group_id` directly through the native async ORM (`acreate`),
+        so no `DiscussionGroup` lookup precedes the INSERT.
 
         Args:
             user (User): The user who sent the message.
@@ -224,44 +744,258 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         Returns:
             GroupChatMessage or None: The created GroupChatMessage instance if successful,
-                                      None otherwise (e.g., if the group doesn't exist).
+                                      None otherwise (e.g., if the group no longer exists).
         """
-        logger.info(f"DB: Attempting to save message by user {user.id} in group {group_id}: '{message_text[:50]}...'")
         try:
-            group = DiscussionGroup.objects.get(id=group_id)
-            chat_message = GroupChatMessage.objects.create(
-                user=user,
-                group=group,
+            chat_message = await GroupChatMessage.objects.acreate(
+                user_id=user.id,
+                group_id=group_id,
                 text_content=message_text
             )
-            logger.info(f"DB: Message saved with ID {chat_message.id} by user {user.id} in group {group_id}.")
             return chat_message
-        except DiscussionGroup.DoesNotExist:
-            logger.error(f"DB: DiscussionGroup {group_id} DoesNotExist in save_message for user {user.id}.")
-            return None 
         except Exception as e:
-            logger.error(f"DB: Exception in save_message for user {user.id}, group {group_id}: {e}", exc_info=True)
+            throttled_log.log(logging.ERROR, 'db.save_error', "Exception in save_message for user %s, group %s: %s", user.id, group_id, e, exc_info=True)
             return None
-        
-    @database_sync_to_async
-    def get_user_full_name(self, user):
+
+    @staticmethod
+    def get_sender_payload(user):
         """
-        Retrieves the full name of a user, falling back to their username.
+        Builds the sender fields that accompany every broadcast message.
 
-        This method performs a synchronous database query (potentially, depending
-        on how `user.get_full_name()` is implemented) in an asynchronous context.
+        Only reads attributes already loaded on the user instance, so it is
+        safe to call from the event loop and is computed once per connection.
 
         Args:
-            user (User): The user instance.
+            user (User): The connected user.
 
         Returns:
-            str: The user's full name if available, otherwise their username.
+            dict: 'user_id', 'username' and 'user_full_name' (falling back to
+                  the username when no full name is set).
         """
-        logger.info(f"DB: Getting full name for user {user.id}")
+        return {
+            'user_id': user.id,
+            'username': user.username,
+            'user_full_name': user.get_full_name() or user.username,
+        }
+
+
+_user_connections = weakref.WeakKeyDictionary() # event loop -> {user_id: [MultiplexChatConsumer, ...]}, oldest first
+
+
+def user_connections(user_id):
+    """Returns the list of a user's multiplexed connections on the running event loop, oldest first."""
+    connections = _user_connections.setdefault(asyncio.get_running_loop(), {})
+    return connections.setdefault(user_id, [])
+
+
+class MultiplexChatConsumer(ChatConsumer):
+    """
+    A WebSocket consumer serving all the groups a user subscribes to over one
+    connection (see the module docstring for the protocol).
+
+    Each subscription adds the connection to the group's channel layer group
+    and presence room; frames in both directions are tagged with 'group'.
+    """
+    group_id = None # No connection-wide group; every frame names its own
+
+    async def connect(self):
+        """
+        Accepts an authenticated user's connection without subscribing to
+        any group. If the user now has more than `GROUPCHAT_MUX_MAX_CONNECTIONS`
+        multiplexed connections in this process, their oldest is closed.
+        """
+        self.user = self.scope['user']
+        self.codec = negotiate_codec(self.scope.get('subprotocols'))
+        if not self.user or not self.user.is_authenticated:
+            throttled_log.log(logging.WARNING, 'connect.anonymous', "Unauthenticated multiplexed WebSocket connection closed.")
+            await self.close()
+            return
+
+        self.admission = get_admission_controller()
+        refusal = self.admission.admit(self.channel_name, self.user.id)
+        if refusal:
+            throttled_log.log(logging.WARNING, f'connect.{refusal}', "Refused multiplexed connection of user %s (%s).", self.user.id, refusal)
+            await self.reject(refusal)
+            return
+        self.admitted = True
+        await self.accept(subprotocol=self.codec.subprotocol)
+        self.start_session()
+        self.subscriptions = set()
+        recorder = get_traffic_recorder()
+        self.recording = recorder.open(self) if recorder else None # Opt-in traffic capture for replay
+        multiplex_stats['connections'] += 1
+        logger.debug("Multiplexed WebSocket accepted for user %s (%s frames).", self.user.id, self.codec.name)
+
+        connections = user_connections(self.user.id)
+        connections.append(self)
+        max_connections = getattr(settings, 'GROUPCHAT_MUX_MAX_CONNECTIONS', 5)
+        while len(connections) > max_connections:
+            oldest = connections.pop(0)
+            multiplex_stats['replaced'] += 1
+            throttled_log.log(logging.WARNING, 'mux.replaced', "Closing the oldest multiplexed connection of user %s.", self.user.id)
+            await oldest.close(code=REPLACED_CLOSE_CODE)
+
+    async def disconnect(self, close_code):
+        """
+        Handles a WebSocket disconnection by ending every subscription.
+
+        Args:
+            close_code: The code indicating the reason for disconnection.
+        """
+        logger.debug("User %s disconnecting multiplexed connection with code: %s", getattr(self, 'user', None), close_code)
+        for group_id in list(getattr(self, 'subscriptions', ())):
+            await self.end_subscription(group_id)
+        if getattr(self, 'admitted', False):
+            self.admission.release(self.channel_name, self.user.id)
+        if hasattr(self, 'subscriptions'):
+            multiplex_stats['connections'] -= 1
+            connections = user_connections(self.user.id)
+            if self in connections:
+                connections.remove(self)
+            if not connections:
+                del _user_connections[asyncio.get_running_loop()][self.user.id]
+        if hasattr(self, 'outbound'):
+            self.outbound.close()
+        # Unfinished uploads stay on disk so the client can resume them after reconnecting.
+        for upload in getattr(self, 'uploads', {}).values():
+            await sync_to_async(upload.close, thread_sensitive=False)()
+        if getattr(self, 'recording', None):
+            self.recording.disconnect(close_code)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        Handles an incoming frame: `subscribe` and `unsubscribe` change the
+        subscriptions, binary upload chunks go to `receive_upload_chunk`, and
+        every other frame goes to `handle_frame` for the subscribed group it
+        names in 'group'.
+
+        Args:
+            text_data (str): A JSON text frame.
+            bytes_data (bytes): A msgpack binary frame or an upload chunk.
+        """
+        for group_id in self.subscriptions:
+            self.presence.touch(group_id, self.channel_name) # Any frame counts as a heartbeat
+        if self.recording:
+            self.recording.receive(text_data, bytes_data)
+        if is_chunk_frame(bytes_data):
+            await self.receive_upload_chunk(bytes_data)
+            return
         try:
-            name = user.get_full_name() or user.username
-            logger.info(f"DB: Retrieved name '{name}' for user {user.id}")
-            return name
-        except Exception as e:
-            logger.error(f"DB: Exception in get_user_full_name for user {user.id}: {e}", exc_info=True)
-            return user.username # Fallback 
\ No newline at end of file
+            frame = self.codec.decode(text_data, bytes_data)
+            if not isinstance(frame, dict):
+                raise ValueError("Frames must be maps.")
+        except ValueError as e:
+            throttled_log.log(logging.WARNING, 'receive.invalid', "Invalid multiplexed frame from user %s: %s", self.user.id, e)
+            await self.send_frame({'type': 'message.error', 'group': None, 'error': 'Frames must be JSON objects.'})
+            return
+        group_id = frame.get('group')
+        if frame.get('type') == 'subscribe':
+            await self.subscribe(group_id, frame.get('last_id'))
+        elif frame.get('type') == 'unsubscribe':
+            if group_id in self.subscriptions:
+                await self.end_subscription(group_id)
+            await self.send_frame({'type': 'unsubscribed', 'group': group_id})
+        elif frame.get('type') == 'heartbeat':
+            return
+        elif group_id in self.subscriptions:
+            await self.handle_frame(group_id, frame)
+        else:
+            throttled_log.log(logging.WARNING, 'mux.not_subscribed', "User %s sent a frame for unsubscribed group %r.", self.user.id, group_id)
+            await self.send_frame({
+                'type': 'message.error',
+                'code': 'not_subscribed',
+                'group': group_id,
+                'temp_id': frame.get('temp_id'),
+                'error': 'Subscribe to this group first.',
+            })
+
+    async def subscribe(self, group_id, last_id=None):
+        """
+        Subscribes the connection to a group the user is a member of, sends its
+        presence snapshot and, with `last_id`, replays what the client missed.
+        Subscribing again to a subscribed group only repeats the snapshot and replay.
+
+        Args:
+            group_id (int): The group, as sent by the client.
+            last_id (int, optional): The id of the last message the client has rendered.
+        """
+        if not isinstance(group_id, int) or isinstance(group_id, bool):
+            await self.refuse_subscription(group_id, 'invalid', 'Name the group to subscribe to by its id.')
+            return
+        if group_id not in self.subscriptions:
+            max_subscriptions = getattr(settings, 'GROUPCHAT_MUX_MAX_SUBSCRIPTIONS', 50)
+            if len(self.subscriptions) >= max_subscriptions:
+                await self.refuse_subscription(
+                    group_id, 'too_many_subscriptions', f"At most {max_subscriptions} groups may be subscribed at once.",
+                )
+                return
+            with metrics.track('membership'):
+                is_member = await self.is_user_member(self.user, group_id)
+            if not is_member:
+                await self.refuse_subscription(group_id, 'not_member', 'You are not a member of this group.')
+                return
+            pool = await aroute(group_id)
+            if pool in dedicated_pools() and pool != local_pool():
+                await self.refuse_moved(group_id, pool)
+                return
+            if self.admission.join_group(group_id):
+                await self.refuse_subscription(group_id, 'group_full', 'This group has too many connections; try again later.')
+                return
+            with metrics.track('group_add'):
+                await self.channel_layer.group_add(room_group_name(group_id), self.channel_name)
+            self.subscriptions.add(group_id)
+            self.rooms.join(group_id, multiplexed=True)
+            multiplex_stats['subscriptions'] += 1
+            self.presence.join(group_id, self.channel_name, self.user.id, self.sender['user_full_name'])
+        await self.send_frame({'type': 'subscribed', 'group': group_id})
+        await self.send_frame(await self.presence.snapshot(group_id))
+        # As in `ChatConsumer.connect`, live events wait in the channel until this returns.
+        if last_id:
+            await self.replay_missed_messages(group_id, last_id)
+
+    async def refuse_subscription(self, group_id, code, error, **extra):
+        """Answers a `subscribe` frame that was refused with a `subscribe.error` frame, carrying `extra` fields."""
+        multiplex_stats['subscribe_refused'] += 1
+        throttled_log.log(logging.WARNING, f'mux.{code}', "Refused subscription of user %s to group %r (%s).", self.user.id, group_id, code)
+        await self.send_frame({'type': 'subscribe.error', 'group': group_id, 'code': code, 'error': error, **extra})
+
+    async def refuse_moved(self, group_id, pool):
+        """Refuses a subscription to a room on a dedicated pool, naming the pool's address to connect to instead."""
+        await self.refuse_subscription(
+            group_id, 'moved', 'This group is served by its own connection.', url=pool_address(pool),
+        )
+
+    async def end_subscription(self, group_id):
+        """Removes the connection from a group's channel layer group and presence room, keeping its uploads on disk."""
+        self.subscriptions.discard(group_id)
+        self.admission.leave_group(group_id)
+        self.rooms.leave(group_id, multiplexed=True)
+        multiplex_stats['subscriptions'] -= 1
+        await self.channel_layer.group_discard(room_group_name(group_id), self.channel_name)
+        self.presence.leave(group_id, self.channel_name)
+        self.resume_positions.pop(group_id, None)
+        for upload in [upload for upload in self.uploads.values() if upload.group_id == group_id]:
+            del self.uploads[upload.upload_id]
+            await sync_to_async(upload.close, thread_sensitive=False)()
+
+    async def chat_route(self, event):
+        """Ends the subscription to a room that moved to a dedicated pool of which this worker is not part (see `refuse_moved`)."""
+        group_id = event['group_id']
+        if event['dedicated'] and group_id in self.subscriptions and event['pool'] != local_pool():
+            await self.end_subscription(group_id)
+            await self.refuse_moved(group_id, event['pool'])
+
+    async def chat_message(self, event):
+        """Forwards a room message, unless the group was unsubscribed while it was in flight."""
+        if event.get('group_id') in self.subscriptions:
+            await super().chat_message(event)
+
+    async def chat_batch(self, event):
+        """Forwards a room's message batch, unless the group was unsubscribed while it was in flight."""
+        if event.get('group_id') in self.subscriptions:
+            await super().chat_batch(event)
+
+    async def presence_delta(self, event):
+        """Forwards a room's presence changes, unless the group was unsubscribed while they were in flight."""
+        if event.get('group_id') in self.subscriptions:
+            await super().presence_delta(event)
@@ -0,0 +1,133 @@
+"""
+Graceful drain of a worker's chat connections before it exits.
+
+Restarting a worker used to drop all of its sockets at once, and every client
+reconnected within seconds to the remaining workers. `drain()` hands them
+over gradually instead:
+
+1. The worker stops admitting connections: new handshakes get a
+   `connect.rejected` frame coded 'draining' and close code 4012 (see
+   `groupchat.admission`), so the client's retry lands on another worker.
+2. Every connected socket is sent
+
+       {'type': 'reconnect', 'after': 7.4}
+
+   with the delays spread evenly over `GROUPCHAT_DRAIN_WINDOW` seconds in
+   random order. Each client reconnects when its turn comes and resumes from
+   its last message, so the other workers see about
+   `connections / GROUPCHAT_DRAIN_WINDOW` reconnects per second.
+3. The drain waits until the sockets are gone, for at most
+   `GROUPCHAT_DRAIN_TIMEOUT` seconds, then closes the rest with code 4012.
+   A consumer gives up its admission slot in `disconnect()`, which runs
+   after the frame it was handling, so message saves in progress complete
+   first.
+4. What the worker buffers in process is written out: pending room batches,
+   the write-behind queue, read watermarks and presence, so other workers
+   stop listing the drained connections straight away.
+
+`python -m groupchat.server` drains when it receives SIGTERM or SIGINT,
+before daphne cancels its application instances, so the process manager's
+stop timeout must exceed `GROUPCHAT_DRAIN_TIMEOUT` (plus a few seconds for
+the flush). A drained worker does not accept connections again.
+
+Settings:
+    GROUPCHAT_DRAIN_WINDOW (float): Seconds over which clients are asked to reconnect. Defaults to 20.
+    GROUPCHAT_DRAIN_TIMEOUT (float): Seconds to wait for sockets to leave before
+        closing them. Defaults to 30.
+"""
+import asyncio
+import logging
+import random
+import time
+
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .admission import get_admission_controller
+from .batching import get_room_batcher
+from .persistence import get_message_writer
+from .presence import get_presence_hub
+from .unread import get_read_marker
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.1 # seconds between checks for sockets that are still open
+CLOSE_GRACE = 5.0 # seconds sockets closed at the timeout get to finish their disconnect
+
+stats = {'drains': 0, 'notified': 0, 'left': 0, 'closed': 0, 'flushed_messages': 0}
+
+
+async def _notify(channel_layer, channel_name, event):
+    try:
+        await channel_layer.send(channel_name, event)
+    except ChannelFull: # Hopelessly backed up; it is cancelled when the worker exits
+        logger.warning("Could not send %s to %s: channel full.", event['type'], channel_name)
+
+
+async def _wait_for_sockets(controller, seconds):
+    deadline = time.monotonic() + seconds
+    while controller.channels and time.monotonic() < deadline:
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def flush_buffers():
+    """
+    Writes out everything the chat buffers in this worker: pending room
+    batches, the write-behind queue, read watermarks and presence changes.
+
+    Returns:
+        int: The number of write-behind messages that were still pending.
+    """
+    batcher = get_room_batcher()
+    for group_name in list(batcher.pending):
+        await batcher.flush(group_name)
+    writer = get_message_writer()
+    pending = writer.pending_count
+    await writer.flush()
+    await get_read_marker().flush() # After the writer, so marks of just-written messages resolve
+    await get_presence_hub().flush()
+    return pending
+
+
+async def drain(window=None, timeout=None):
+    """
+    Drains this worker's chat connections (see the module docstring).
+
+    Args:
+        window (float, optional): Seconds over which clients are asked to
+            reconnect; defaults to `GROUPCHAT_DRAIN_WINDOW`.
+        timeout (float, optional): Seconds to wait for sockets to leave;
+            defaults to `GROUPCHAT_DRAIN_TIMEOUT`.
+
+    Returns:
+        dict: The number of sockets 'notified', how many 'left' by themselves
+        and were 'closed' at the timeout, and the write-behind messages that
+        were still pending ('flushed_messages').
+    """
+    window = window if window is not None else getattr(settings, 'GROUPCHAT_DRAIN_WINDOW', 20.0)
+    timeout = timeout if timeout is not None else getattr(settings, 'GROUPCHAT_DRAIN_TIMEOUT', 30.0)
+    controller = get_admission_controller()
+    controller.draining = True
+    channel_layer = get_channel_layer()
+    channels = list(controller.channels)
+    random.shuffle(channels)
+    logger.info("Draining %d chat connections over %s seconds.", len(channels), window)
+
+    for index, channel_name in enumerate(channels):
+        await _notify(channel_layer, channel_name, {'type': 'chat.drain', 'after': round(window * index / len(channels), 1)})
+    await _wait_for_sockets(controller, timeout)
+
+    remaining = list(controller.channels)
+    if remaining:
+        logger.warning("Closing %d chat connections that did not reconnect in time.", len(remaining))
+        for channel_name in remaining:
+            await _notify(channel_layer, channel_name, {'type': 'chat.drain', 'close': True})
+        await _wait_for_sockets(controller, CLOSE_GRACE)
+
+    flushed = await flush_buffers()
+    result = {'notified': len(channels), 'left': len(channels) - len(remaining), 'closed': len(remaining), 'flushed_messages': flushed}
+    stats['drains'] += 1
+    for key, value in result.items():
+        stats[key] += value
+    logger.info("Drain finished: %s", result)
+    return result
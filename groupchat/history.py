@@ -0,0 +1,188 @@
+"""
+Keyset pagination over a group's chat history.
+
+Pages are addressed by opaque cursors encoding a message's `(timestamp, id)`
+pair, so fetching any page is an index range scan on the composite
+`(group, timestamp, id)` index instead of an OFFSET over the whole history.
+Pages reaching past the oldest message of the hot table continue into the
+archive (see archive.py) with the same cursors.
+"""
+import base64
+import binascii
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from . import archive
+from .attachments import attachment_url
+from .models import GroupChatMessage
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+class InvalidCursor(ValueError):
+    """Raised when a history cursor cannot be decoded."""
+
+
+def page_size(requested=None):
+    """
+    Clamps a requested page size to `GROUPCHAT_HISTORY_MAX_PAGE_SIZE`.
+
+    Args:
+        requested (int or str, optional): The client-requested size.
+
+    Returns:
+        int: A size between 1 and the configured maximum.
+    """
+    default = getattr(settings, 'GROUPCHAT_HISTORY_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+    maximum = getattr(settings, 'GROUPCHAT_HISTORY_MAX_PAGE_SIZE', MAX_PAGE_SIZE)
+    try:
+        size = int(requested) if requested else default
+    except (TypeError, ValueError):
+        size = default
+    return max(1, min(size, maximum))
+
+
+def encode_cursor(message):
+    """Returns the opaque cursor pointing at `message`."""
+    raw = f'{message.timestamp.isoformat()}|{message.id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor produced by `encode_cursor`.
+
+    Returns:
+        tuple: `(timestamp, id)`.
+
+    Raises:
+        InvalidCursor: If the cursor is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        timestamp, message_id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise InvalidCursor(f"Invalid history cursor: {cursor!r}") from e
+
+
+def _before(position):
+    timestamp, message_id = position
+    return Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+
+
+def _after(position):
+    timestamp, message_id = position
+    return Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=message_id)
+
+
+def history_queryset(group_id):
+    """Base queryset of a group's messages with the sender preloaded."""
+    return GroupChatMessage.objects.filter(group_id=group_id).select_related('user')
+
+
+def _page_query(group_id, before, after, limit):
+    """Returns `(queryset, newest_first)` for one page, `limit + 1` rows long."""
+    queryset = history_queryset(group_id)
+    if after:
+        return queryset.filter(_after(decode_cursor(after))).order_by('timestamp', 'id')[:limit + 1], False
+    if before:
+        queryset = queryset.filter(_before(decode_cursor(before)))
+    return queryset.order_by('-timestamp', '-id')[:limit + 1], True
+
+
+def _as_page(rows, limit, newest_first):
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return (rows[::-1] if newest_first else rows), has_more
+
+
+def _position(message):
+    return message.timestamp, message.id
+
+
+def _read_through(group_id, rows, before, after, limit, newest_first):
+    """
+    Completes a page of hot rows (`limit + 1` long when full) with archived
+    messages where it runs past the oldest hot message.
+    """
+    if newest_first:
+        if len(rows) > limit:
+            return rows
+        # Every hot message before the cursor is in `rows`, so the archive continues below the oldest of them.
+        bound = _position(rows[-1]) if rows else (decode_cursor(before) if before else None)
+        return rows + archive.messages_before(group_id, bound, limit + 1 - len(rows))
+    position = decode_cursor(after)
+    if not archive.has_archive_after(group_id, position):
+        return rows
+    oldest_hot = GroupChatMessage.objects.filter(group_id=group_id).order_by('timestamp', 'id').only('id', 'timestamp').first()
+    archived = archive.messages_after(group_id, position, limit + 1, until=_position(oldest_hot) if oldest_hot else None)
+    return (archived + rows)[:limit + 1]
+
+
+def fetch_page(group_id, before=None, after=None, limit=None):
+    """
+    Fetches one page of a group's messages.
+
+    Without a cursor the latest page is returned. With `before`, the page of
+    messages immediately older than that cursor; with `after`, the page
+    immediately newer. Archived messages are included where the page reaches them.
+
+    Args:
+        group_id (int): ID of the discussion group.
+        before (str, optional): Cursor to page backwards from.
+        after (str, optional): Cursor to page forwards from.
+        limit (int, optional): Page size; clamped by `page_size()`.
+
+    Returns:
+        tuple: `(messages, has_more)` where `messages` is in chronological order
+               and `has_more` tells whether another page exists in the paging direction.
+
+    Raises:
+        InvalidCursor: If a cursor is malformed.
+    """
+    limit = page_size(limit)
+    queryset, newest_first = _page_query(group_id, before, after, limit)
+    rows = _read_through(group_id, list(queryset), before, after, limit, newest_first)
+    return _as_page(rows, limit, newest_first)
+
+
+async def afetch_page(group_id, before=None, after=None, limit=None):
+    """Async counterpart of `fetch_page`, using the async ORM."""
+    limit = page_size(limit)
+    queryset, newest_first = _page_query(group_id, before, after, limit)
+    rows = [message async for message in queryset]
+    if newest_first and len(rows) > limit:
+        return _as_page(rows, limit, newest_first) # The common case: no archive involved
+    rows = await sync_to_async(_read_through)(group_id, rows, before, after, limit, newest_first)
+    return _as_page(rows, limit, newest_first)
+
+
+async def acursor_for_message(group_id, message_id):
+    """
+    Returns the cursor of a message in the group, or None if there is no such message.
+    """
+    row = await GroupChatMessage.objects.filter(group_id=group_id, id=message_id).only('id', 'timestamp').afirst()
+    return encode_cursor(row) if row else None
+
+
+def serialize_message(message):
+    """
+    Returns the JSON-ready representation of a stored message, using the same
+    keys as the frames pushed over the chat WebSocket.
+    """
+    user = message.user
+    return {
+        'id': message.id,
+        'user_id': message.user_id,
+        'username': user.username,
+        'user_full_name': user.get_full_name() or user.username,
+        'text': message.text_content,
+        'file_url': attachment_url(message),
+        'file_name': message.file_attachment.name.rsplit('/', 1)[-1] if message.file_attachment else None,
+        'timestamp': message.timestamp.isoformat(),
+        'cursor': encode_cursor(message),
+    }
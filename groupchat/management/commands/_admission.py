@@ -0,0 +1,113 @@
+"""
+The `admission` benchmark scenario: a cold-restart storm with and without
+load shedding.
+"""
+import asyncio
+import json
+import random
+import time
+
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from discussions.membership import is_member
+from django.test import override_settings
+from groupchat.admission import AdmissionMiddleware, get_admission_controller, stats as admission_stats
+from groupchat.middleware import TimedAuthMiddlewareStack
+from groupchat.routing import websocket_urlpatterns
+
+from ._bench import ChatFixture, summarize_latencies
+from ._loadgen import InProcessClient, session_cookie
+
+
+def bench(command, options):
+    """
+    Simulates a reconnect storm larger than the worker can take: every
+    member of a `--members` room opens its chat socket at once through
+    `AdmissionMiddleware` and uncached auth, as after a cold restart, so
+    every handshake queues session and user lookups on the executor.
+    Unguarded, every handshake waits behind all the others; with the
+    configured admission thresholds the worker sheds what it cannot take
+    yet, and refused clients come back after one to two times the
+    `retry_after` they were given (at least 1 second here), as the chat
+    page does. The clients share the worker's event loop, so their
+    retries count against it too.
+    """
+    members = options['members'] or 2000
+    command.stdout.write(f'Creating {members} members...')
+    fixture = ChatFixture(members=members)
+    sessions = []
+    try:
+        cookies = [session_cookie(user, sessions) for user in fixture.users]
+        for user in fixture.users:
+            is_member(user.id, fixture.group.id)
+        application = AdmissionMiddleware(TimedAuthMiddlewareStack(URLRouter(websocket_urlpatterns)))
+        variants = (
+            ('unguarded', {
+                'GROUPCHAT_ADMISSION_MAX_HANDSHAKES': 0, 'GROUPCHAT_ADMISSION_MAX_LOOP_LAG': 0, 'GROUPCHAT_ADMISSION_MAX_EXECUTOR_QUEUE': 0,
+            }),
+            ('admission', {'GROUPCHAT_ADMISSION_RETRY_AFTER': 1}),
+        )
+        causes = ('shed_handshakes', 'shed_loop_lag', 'shed_executor_queue')
+        for label, overrides in variants:
+            shed_before = {cause: admission_stats[cause] for cause in causes}
+            with override_settings(**overrides):
+                elapsed, latencies_ms, attempts, peak_lag = async_to_sync(drive)(
+                    application, cookies, fixture.group.id,
+                )
+            command.report(label, {
+                'connected': members,
+                'refused': attempts - members,
+                **{cause: admission_stats[cause] - shed_before[cause] for cause in causes},
+                'seconds_to_all_connected': round(elapsed, 2),
+                'peak_loop_lag_ms': round(peak_lag * 1000, 1),
+                **summarize_latencies(latencies_ms),
+            })
+    finally:
+        for session in sessions:
+            session.delete()
+        fixture.cleanup()
+
+
+async def drive(application, cookies, group_id):
+    """
+    Opens one connection per session cookie, all at once, retrying refused
+    ones with jittered backoff until every one is in.
+
+    Returns:
+        tuple: Seconds until every connection was accepted, the latency in
+        ms of each accepted handshake (its last attempt only), the number
+        of attempts, and the peak event-loop lag in seconds.
+    """
+    controller = get_admission_controller()
+    peak_lag = 0.0
+    storming = True
+
+    async def watch_lag():
+        nonlocal peak_lag
+        while storming:
+            peak_lag = max(peak_lag, controller.loop_lag())
+            await asyncio.sleep(0.05)
+
+    async def connect(cookie):
+        attempts = 0
+        while True:
+            attempts += 1
+            client = InProcessClient(application, f'/ws/chat/{group_id}/', cookie)
+            started = time.perf_counter()
+            if not await client.connect(timeout=300):
+                raise RuntimeError("Benchmark connection was rejected.")
+            frame = json.loads(await client.receive())
+            if frame.get('type') != 'connect.rejected':
+                return client, (time.perf_counter() - started) * 1000, attempts
+            await client.close()
+            await asyncio.sleep(frame['retry_after'] * (1 + random.random())) # As the chat page
+
+    watcher = asyncio.ensure_future(watch_lag())
+    started = time.perf_counter()
+    connected = await asyncio.gather(*(connect(cookie) for cookie in cookies))
+    elapsed = time.perf_counter() - started
+    storming = False
+    await watcher
+    for client, _, _ in connected:
+        await client.close()
+    return elapsed, [latency for _, latency, _ in connected], sum(attempts for _, _, attempts in connected), peak_lag
@@ -0,0 +1,181 @@
+"""
+The `affinity` benchmark scenario and its worker process entry point.
+
+Kept free of model imports at module level so `room_worker` can be imported
+by a freshly spawned interpreter before Django is set up.
+"""
+import asyncio
+import multiprocessing
+import os
+import random
+import time
+
+from django.test import override_settings
+from groupchat.affinity import route
+
+SMALL_ROOMS = 20
+SMALL_ROOM_MEMBERS = 5
+SMALL_ROOM_RATE = 1.0 # messages/sec per small room
+
+
+def bench(command, options):
+    """
+    Runs a hot room of `--members` members receiving `--rate` messages/sec
+    next to small rooms that send one message a second. 'shared' routes
+    every room to one pool, served by one worker process; 'affinity' pins
+    the hot room to a dedicated pool with its own process, placing rooms
+    with `affinity.route()`. Reports the small and hot rooms' delivery
+    latency and each variant's CPU seconds.
+    """
+    from ._bench import ChatFixture
+
+    members = options['members'] or 300
+    command.stdout.write(f'Creating a room of {members} members and {SMALL_ROOMS} rooms of {SMALL_ROOM_MEMBERS}...')
+    hot, small = ChatFixture(members=members), ChatFixture(members=SMALL_ROOM_MEMBERS, rooms=SMALL_ROOMS)
+    rooms = [('hot', hot.group.id, [user.id for user in hot.users], options['rate'])] + [
+        ('small', group_id, [user.id for user in users], SMALL_ROOM_RATE) for group_id, users in small.members.items()
+    ]
+    overrides = {
+        'GROUPCHAT_USER_MESSAGE_RATE': 0, 'GROUPCHAT_ROOM_MESSAGE_RATE': 0,
+        'GROUPCHAT_WRITE_BEHIND': True, # Held in memory, so the processes do not contend for the database
+        'GROUPCHAT_WRITE_BEHIND_BATCH_SIZE': 1000000,
+        'GROUPCHAT_WRITE_BEHIND_FLUSH_INTERVAL': 3600,
+    }
+    variants = (
+        ('shared', {'GROUPCHAT_AFFINITY_POOLS': {'shared': '/shared'}}),
+        ('affinity', {
+            'GROUPCHAT_AFFINITY_POOLS': {'shared': '/shared'},
+            'GROUPCHAT_AFFINITY_DEDICATED_POOLS': {'hot': '/hot'},
+            'GROUPCHAT_AFFINITY_PINS': {hot.group.id: 'hot'},
+        }),
+    )
+    try:
+        for label, routing in variants:
+            with override_settings(**routing):
+                placement = {}
+                for room in rooms:
+                    placement.setdefault(route(room[1]), []).append(room)
+            result = run_room_workers(placement, options['duration'], {**overrides, **routing})
+            command.report(label, result)
+    finally:
+        hot.cleanup()
+        small.cleanup()
+
+
+def run_room_workers(placement, duration, overrides):
+    """Starts a `room_worker` process per pool of `placement` (pool -> rooms) and summarizes their results."""
+    from ._bench import summarize_latencies
+
+    context = multiprocessing.get_context('spawn')
+    ready_queue, result_queue, start_event = context.Queue(), context.Queue(), context.Event()
+    workers = [
+        context.Process(
+            target=room_worker,
+            args=(
+                rooms, duration, {**overrides, 'GROUPCHAT_AFFINITY_POOL': pool, 'GROUPCHAT_WORKER_ID': worker_id},
+                ready_queue, start_event, result_queue,
+            ),
+        )
+        for worker_id, (pool, rooms) in enumerate(placement.items())
+    ]
+    for worker in workers:
+        worker.start()
+    for _ in workers:
+        ready_queue.get(timeout=300)
+    start_event.set()
+    latencies_ms, cpu, lost = {'hot': [], 'small': []}, 0.0, 0
+    for _ in workers:
+        _, worker_latencies, worker_cpu, worker_lost = result_queue.get(timeout=duration + 120)
+        for kind, samples in worker_latencies.items():
+            latencies_ms[kind].extend(samples)
+        cpu += worker_cpu
+        lost += worker_lost
+    for worker in workers:
+        worker.join()
+    small, hot = summarize_latencies(latencies_ms['small']), summarize_latencies(latencies_ms['hot'])
+    return {
+        'processes': len(workers),
+        **{f'small_{key}': value for key, value in small.items()},
+        'hot_p50_ms': hot['p50_ms'],
+        'hot_p99_ms': hot['p99_ms'],
+        'undelivered': lost,
+        'cpu_s': round(cpu, 2),
+    }
+
+
+def room_worker(rooms, duration, overrides, ready_queue, start_event, result_queue):
+    """
+    Serves `rooms` in this process as one worker of a pool: connects every
+    member over `ChatConsumer`, then has each room's first member send its
+    rate of messages for `duration` seconds and records how long they take
+    to reach the room's second member.
+
+    Args:
+        rooms (list): `(kind, group_id, member user ids, messages/sec)` tuples.
+        duration (float): Seconds to send for.
+        overrides (dict): Settings to run under, e.g. the worker's pool.
+        ready_queue: Gets the process id once every member is connected.
+        start_event: Set by the parent to start sending.
+        result_queue: Gets `(pid, {kind: latencies_ms}, CPU seconds, messages
+            never received)` when done.
+    """
+    import django
+    django.setup()
+    from django.contrib.auth import get_user_model
+    from groupchat.consumers import ChatConsumer
+    from ._bench import chat_communicator
+
+    users = get_user_model().objects.in_bulk([user_id for _, _, members, _ in rooms for user_id in members])
+
+    async def run():
+        application = ChatConsumer.as_asgi()
+        sent_at, latencies_ms, communicators, listeners = {}, {}, [], []
+
+        async def listen(communicator, timed):
+            while True:
+                output = await communicator.receive_output(timeout=3600)
+                if timed and output.get('text') and '"temp_id"' in output['text']:
+                    received = time.perf_counter()
+                    kind, temp_id = timed, output['text'].split('"temp_id": "', 1)[1].split('"', 1)[0]
+                    if temp_id in sent_at:
+                        latencies_ms.setdefault(kind, []).append((received - sent_at.pop(temp_id)) * 1000)
+
+        for kind, group_id, members, _ in rooms:
+            for index, user_id in enumerate(members):
+                communicator = chat_communicator(application, users[user_id], group_id)
+                connected, _ = await communicator.connect(timeout=60)
+                if not connected:
+                    raise RuntimeError("Benchmark connection was rejected.")
+                await communicator.receive_output(timeout=60) # Presence snapshot
+                communicators.append(communicator)
+                listeners.append(asyncio.ensure_future(listen(communicator, kind if index == 1 else None)))
+        ready_queue.put(os.getpid())
+        await asyncio.get_running_loop().run_in_executor(None, start_event.wait)
+
+        async def send(kind, group_id, communicator, rate):
+            await asyncio.sleep(random.random() / rate) # Rooms do not send in lockstep
+            started = time.perf_counter()
+            for sequence in range(int(rate * duration)):
+                temp_id = f'{group_id}-{sequence}'
+                sent_at[temp_id] = time.perf_counter()
+                await communicator.send_to(text_data=f'{{"message": "Affinity benchmark {sequence}", "temp_id": "{temp_id}"}}')
+                await asyncio.sleep(max(0.0, started + (sequence + 1) / rate - time.perf_counter()))
+
+        senders, position = [], 0
+        cpu_started = time.process_time()
+        for kind, group_id, members, rate in rooms:
+            senders.append(send(kind, group_id, communicators[position], rate))
+            position += len(members)
+        await asyncio.gather(*senders)
+        deadline = time.perf_counter() + 30 # A saturated worker keeps delivering its backlog.
+        while sent_at and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        cpu = time.process_time() - cpu_started
+        for listener in listeners:
+            listener.cancel()
+        result_queue.put((os.getpid(), latencies_ms, cpu, len(sent_at)))
+        for communicator in communicators:
+            await communicator.disconnect()
+
+    with override_settings(**overrides):
+        asyncio.run(run())
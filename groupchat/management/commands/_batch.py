@@ -0,0 +1,112 @@
+"""
+The `batch` benchmark scenario: one event and frame per message against the
+room batcher.
+"""
+import asyncio
+import json
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.test import override_settings
+from groupchat.batching import broadcast, stats as batching_stats
+from groupchat.consumers import ChatConsumer
+from groupchat.presence import get_presence_hub
+from groupchat.wire import encode_for_broadcast
+
+from ._bench import ChatFixture, chat_communicator, summarize_latencies
+
+
+def bench(command, options):
+    """
+    Broadcasts `--rate` messages/sec for `--duration` seconds to a room of
+    `--members` connections that accept array frames, once with one event
+    and frame per message and once through the room batcher, and compares
+    frames/sec, CPU and delivery latency.
+    """
+    members = options['members'] or 300
+    command.stdout.write(f'Creating {members} members...')
+    fixture = ChatFixture(members=members)
+    try:
+        for label, enabled in (('unbatched', False), ('batched', True)):
+            with override_settings(GROUPCHAT_BATCH_MESSAGES=enabled):
+                result = async_to_sync(drive)(fixture, options)
+            command.report(label, result)
+    finally:
+        fixture.cleanup()
+
+
+async def drive(fixture, options):
+    """Returns frames, messages, CPU and latency of one batching variant."""
+    application = ChatConsumer.as_asgi()
+    counts = {'frames': 0, 'messages': 0}
+    sent_at, latencies_ms = {}, []
+
+    async def drain(communicator, timed):
+        while True:
+            payload = await communicator.receive_output(timeout=3600)
+            text = payload.get('text')
+            if payload.get('type') != 'websocket.send' or text is None:
+                continue
+            counts['frames'] += 1
+            received = text.count('"message_type"')
+            counts['messages'] += received
+            if timed and received:
+                now = time.perf_counter()
+                frames = json.loads(text)
+                for frame in frames if isinstance(frames, list) else [frames]:
+                    latencies_ms.append((now - sent_at[frame['id']]) * 1000)
+
+    communicators, drainers = [], []
+    for index, user in enumerate(fixture.users):
+        communicator = chat_communicator(application, user, fixture.group.id, query='batch=1')
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise RuntimeError("Benchmark connection was rejected.")
+        communicators.append(communicator)
+        drainers.append(asyncio.ensure_future(drain(communicator, timed=index == 0)))
+    await asyncio.sleep(get_presence_hub().tick * 2) # Let the join presence frames go out first.
+
+    layer, group_name = get_channel_layer(), f'chat_{fixture.group.id}'
+    sender = ChatConsumer.get_sender_payload(fixture.users[0])
+    total_messages = int(options['rate'] * options['duration'])
+    interval = 1 / options['rate']
+    counts.update(frames=0, messages=0)
+    batching_stats.update(messages=0, immediate=0, batches=0, group_sends=0)
+
+    started, cpu_started = time.perf_counter(), time.process_time()
+    for sequence in range(total_messages):
+        event = {
+            'type': 'chat.message',
+            'group_id': fixture.group.id,
+            'message_id': sequence,
+            'temp_id': None,
+            **sender,
+            'text': f'Batch benchmark message {sequence}',
+            'timestamp': '2026-10-18T08:16:10.837155+00:00',
+        }
+        event['encoded'] = encode_for_broadcast(ChatConsumer.build_message_frame(event))
+        sent_at[sequence] = time.perf_counter()
+        await broadcast(layer, group_name, event)
+        await asyncio.sleep(max(0.0, started + (sequence + 1) * interval - time.perf_counter()))
+    deadline = time.perf_counter() + 60 # A saturated variant keeps delivering its backlog.
+    while counts['messages'] < total_messages * len(communicators) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+
+    for drainer in drainers:
+        drainer.cancel()
+    for communicator in communicators:
+        await communicator.disconnect()
+    return {
+        'members': len(communicators),
+        'msgs_per_sec': options['rate'],
+        'delivered': counts['messages'],
+        'lost': total_messages * len(communicators) - counts['messages'],
+        'frames_per_sec': round(counts['frames'] / elapsed, 1),
+        'msgs_per_frame': round(counts['messages'] / max(1, counts['frames']), 2),
+        'group_sends': batching_stats['group_sends'] if batching_stats['messages'] else total_messages,
+        'cpu_pct': round(cpu / elapsed * 100, 1),
+        'cpu_us_per_delivery': round(cpu / max(1, counts['messages']) * 1_000_000, 1),
+        **summarize_latencies(latencies_ms),
+    }
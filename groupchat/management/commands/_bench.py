@@ -0,0 +1,163 @@
+"""
+Shared helpers for the groupchat benchmark and load-generation commands.
+
+Provides synthetic fixture creation/cleanup, a database query counter and
+small statistics helpers so each command only has to describe the scenario
+it measures.
+"""
+import datetime
+import math
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.db import connections
+from django.db.backends.signals import connection_created
+from content.models import ContentItem
+from discussions.models import DiscussionGroup, GroupMembership
+
+User = get_user_model()
+
+BENCH_PREFIX = 'bench_'
+
+
+class ChatFixture:
+    """
+    A throwaway content item, discussion groups and their member users.
+
+    Every row is created with a unique `bench_<token>` prefix so that
+    `cleanup()` can remove exactly what was created (messages cascade with
+    the groups).
+
+    Args:
+        members (int): Members per room.
+        rooms (int): Number of discussion groups, each with its own members.
+            `group` is the first one; `members` maps every group id to its users.
+    """
+
+    def __init__(self, members=1, rooms=1):
+        self.token = uuid.uuid4().hex[:10]
+        self.users = User.objects.bulk_create(
+            User(
+                username=f'{BENCH_PREFIX}{self.token}_{index}',
+                first_name='Bench',
+                last_name=f'User {index}',
+                date_of_birth=datetime.date(1990, 1, 1),
+                email=f'{BENCH_PREFIX}{self.token}_{index}@example.invalid',
+            )
+            for index in range(members * rooms)
+        )
+        self.content_item = ContentItem.objects.create(title=f'{BENCH_PREFIX}{self.token}')
+        self.groups = [
+            DiscussionGroup.objects.create(
+                name=f'{BENCH_PREFIX}{self.token}_{room}',
+                content_item=self.content_item,
+                creator=self.users[room * members],
+            )
+            for room in range(rooms)
+        ]
+        self.group = self.groups[0]
+        self.members = {
+            group.id: self.users[room * members:(room + 1) * members] for room, group in enumerate(self.groups)
+        }
+        GroupMembership.objects.bulk_create(
+            GroupMembership(user=user, group_id=group_id)
+            for group_id, users in self.members.items()
+            for user in users
+        )
+
+    def cleanup(self):
+        """Deletes every row created by this fixture."""
+        DiscussionGroup.objects.filter(pk__in=[group.pk for group in self.groups]).delete()
+        self.content_item.delete()
+        User.objects.filter(pk__in=[user.pk for user in self.users]).delete()
+
+
+class QueryProfile:
+    """
+    A database execute wrapper counting queries and their time per statement
+    type, installed on every connection while a replay or benchmark runs.
+
+    `install()` must run in the thread calling `async_to_sync`, which is the
+    thread `database_sync_to_async` code runs in; connections opened in other
+    threads are picked up through the `connection_created` signal.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = defaultdict(lambda: {'count': 0, 'total_ms': 0.0})
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            verb = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else '?'
+            with self.lock:
+                self.queries[verb]['count'] += 1
+                self.queries[verb]['total_ms'] += elapsed_ms
+
+    def install(self):
+        for connection in connections.all():
+            self.connection_created(None, connection)
+        connection_created.connect(self.connection_created)
+
+    def uninstall(self):
+        connection_created.disconnect(self.connection_created)
+        for connection in connections.all(initialized_only=True):
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+    def connection_created(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def summary(self, messages):
+        """Returns the per-statement counts and times, their total and queries per message (or handshake)."""
+        result = {verb: {'count': entry['count'], 'total_ms': round(entry['total_ms'], 3)} for verb, entry in sorted(self.queries.items())}
+        total = sum(entry['count'] for entry in self.queries.values())
+        result['total'] = {'count': total, 'total_ms': round(sum(entry['total_ms'] for entry in self.queries.values()), 3)}
+        result['per_message'] = round(total / messages, 2) if messages else 0.0
+        return result
+
+
+def chat_communicator(application, user, group_id, query=''):
+    """
+    Builds a `WebsocketCommunicator` for a chat consumer with the scope an
+    authenticated connection to `ws/chat/<group_id>/?<query>` would have.
+    """
+    communicator = WebsocketCommunicator(application, f'/ws/chat/{group_id}/' + (f'?{query}' if query else ''))
+    communicator.scope['user'] = user
+    communicator.scope['url_route'] = {'args': (), 'kwargs': {'group_id': str(group_id)}}
+    return communicator
+
+
+async def receive_frame(communicator, timeout=30, skip=('presence',)):
+    """Returns the next JSON frame whose `type` is not in `skip` (presence updates by default)."""
+    while True:
+        frame = await communicator.receive_json_from(timeout=timeout)
+        if frame.get('type') not in skip:
+            return frame
+
+
+def percentile(samples, pct):
+    """Returns the `pct` percentile (0-100) of `samples` using nearest-rank."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize_latencies(samples_ms):
+    """Returns the p50/p95/p99/max summary of a list of millisecond samples."""
+    return {
+        'p50_ms': round(percentile(samples_ms, 50), 3),
+        'p95_ms': round(percentile(samples_ms, 95), 3),
+        'p99_ms': round(percentile(samples_ms, 99), 3),
+        'max_ms': round(max(samples_ms), 3) if samples_ms else 0.0,
+    }
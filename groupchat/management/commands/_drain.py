@@ -0,0 +1,128 @@
+"""
+The `drain` benchmark scenario: an abrupt worker restart against a drained
+one.
+"""
+import asyncio
+import json
+import random
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from discussions.membership import is_member
+from django.test import override_settings
+from groupchat.admission import AdmissionMiddleware, get_admission_controller
+from groupchat.drain import drain
+from groupchat.middleware import TimedAuthMiddlewareStack
+from groupchat.persistence import get_message_writer
+from groupchat.routing import websocket_urlpatterns
+
+from ._bench import ChatFixture
+from ._loadgen import InProcessClient, session_cookie
+
+RECONNECT_INTERVAL = 3.0 # The chat page's first reconnect delay, before its 1-2x jitter
+CONNECT_BATCH = 50
+
+
+def bench(command, options):
+    """
+    Simulates restarting a worker holding `--members` connections (rooms
+    of 10), each of which just sent a message that the write-behind writer
+    still holds. 'abrupt' closes every socket at once, as stopping daphne
+    did, and the clients reconnect after the chat page's jittered first
+    delay; 'drain' runs `drain()` with a `--duration` window. Reports the
+    peak reconnects per second the next workers would see, how long the
+    hand-over took, and how many messages would have been lost with the
+    process.
+    """
+    connections = options['members'] or 1000
+    rooms = max(1, connections // 10)
+    command.stdout.write(f'Creating {rooms} rooms of 10 members...')
+    fixture = ChatFixture(members=10, rooms=rooms)
+    sessions = []
+    try:
+        cookies = [session_cookie(user, sessions) for user in fixture.users]
+        group_ids = [group_id for group_id, users in fixture.members.items() for _ in users] # Users are created room by room
+        targets = list(zip(cookies, group_ids))
+        for user, group_id in zip(fixture.users, group_ids):
+            is_member(user.id, group_id)
+        application = AdmissionMiddleware(TimedAuthMiddlewareStack(URLRouter(websocket_urlpatterns)))
+        writes_held = {
+            'GROUPCHAT_WRITE_BEHIND': True,
+            'GROUPCHAT_WORKER_ID': 0,
+            'GROUPCHAT_WRITE_BEHIND_BATCH_SIZE': 1000000,
+            'GROUPCHAT_WRITE_BEHIND_FLUSH_INTERVAL': 3600,
+        }
+        for label in ('abrupt', 'drain'):
+            with override_settings(**writes_held):
+                reconnects, elapsed, unsaved = async_to_sync(drive)(application, targets, label == 'drain', options['duration'])
+            per_second = {}
+            for moment in reconnects:
+                per_second[int(moment)] = per_second.get(int(moment), 0) + 1
+            command.report(label, {
+                'connections': len(targets),
+                'reconnects': len(reconnects),
+                'peak_reconnects_per_sec': max(per_second.values()),
+                'mean_reconnects_per_sec': round(len(reconnects) / (max(reconnects) - min(reconnects) or 1), 1),
+                'seconds_to_hand_over': round(elapsed, 2),
+                'messages_lost': unsaved,
+            })
+    finally:
+        for session in sessions:
+            session.delete()
+        fixture.cleanup()
+
+
+async def drive(application, targets, graceful, window):
+    """
+    Connects a client per `(cookie, group_id)` target, has each send a
+    message, then restarts the worker abruptly or with `drain()`.
+
+    Returns:
+        tuple: Each client's reconnect time in seconds since the restart
+        began, the seconds until the last client left, and the number of
+        messages still unsaved.
+    """
+    async def connect(cookie, group_id):
+        client = InProcessClient(application, f'/ws/chat/{group_id}/', cookie)
+        if not await client.connect(timeout=120) or json.loads(await client.receive())['type'] == 'connect.rejected':
+            raise RuntimeError("Benchmark connection was rejected.")
+        return client
+
+    async def say_goodbye(client, index):
+        await client.send(json.dumps({'message': 'Restarting soon', 'temp_id': f'drain-{index}'}))
+        while json.loads(await client.receive()).get('temp_id') != f'drain-{index}':
+            pass # Until the echo of our own message, so the writer holds it
+
+    async def follow(client):
+        while True:
+            frame = await client.receive()
+            if frame is None: # Closed by the server: the page's first reconnect attempt
+                await asyncio.sleep(RECONNECT_INTERVAL * (1 + random.random()))
+                break
+            frame = json.loads(frame)
+            if frame.get('type') == 'reconnect':
+                await asyncio.sleep(frame['after'])
+                break
+        reconnected = time.perf_counter() - started
+        await client.close()
+        return reconnected
+
+    clients = []
+    for batch in range(0, len(targets), CONNECT_BATCH): # Below the admission handshake cap
+        clients += await asyncio.gather(*(connect(cookie, group_id) for cookie, group_id in targets[batch:batch + CONNECT_BATCH]))
+    await asyncio.gather(*(say_goodbye(client, index) for index, client in enumerate(clients)))
+    followers = [asyncio.ensure_future(follow(client)) for client in clients]
+    started = time.perf_counter()
+    if graceful:
+        await drain(window=window, timeout=window + 10)
+    else:
+        channel_layer = get_channel_layer()
+        for channel_name in list(get_admission_controller().channels):
+            await channel_layer.send(channel_name, {'type': 'chat.drain', 'close': True})
+    elapsed = time.perf_counter() - started
+    reconnects = await asyncio.gather(*followers)
+    if not graceful:
+        elapsed = max(reconnects)
+    return reconnects, elapsed, get_message_writer().pending_count
@@ -0,0 +1,129 @@
+"""
+The `fanout` benchmark scenario and its worker process entry point.
+
+Kept free of model imports at module level so `fanout_worker` can be imported
+by a freshly spawned interpreter before Django is set up.
+"""
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels_redis.core import RedisChannelLayer
+from django.core.management.base import CommandError
+
+
+def bench(command, options):
+    """
+    Measures cross-worker fan-out: the parent `group_send`s to one room whose
+    members are channels held by `--workers` separate processes.
+    """
+    from ._bench import summarize_latencies
+
+    hosts = start_stand_in_servers(options['stand_in']) if options['stand_in'] else None
+    layer = RedisChannelLayer(hosts=hosts) if hosts else get_channel_layer()
+    if isinstance(layer, InMemoryChannelLayer):
+        raise CommandError(
+            "The fanout scenario needs a cross-process channel layer; set CHANNEL_REDIS_HOSTS or pass --stand-in."
+        )
+
+    group_name = f'chat_bench_{int(time.time())}'
+    total_messages = options['messages']
+    context = multiprocessing.get_context('spawn')
+    ready_queue, result_queue = context.Queue(), context.Queue()
+    timeout = total_messages / options['rate'] + 30
+    workers = [
+        context.Process(
+            target=fanout_worker,
+            args=(group_name, options['listeners'], total_messages, timeout, ready_queue, result_queue, hosts),
+        )
+        for _ in range(options['workers'])
+    ]
+    for worker in workers:
+        worker.start()
+    for _ in workers:
+        ready_queue.get(timeout=60)
+
+    async def send_all():
+        interval = 1 / options['rate']
+        for sequence in range(total_messages):
+            await layer.group_send(group_name, {'type': 'chat.message', 'seq': sequence, 'sent_at': time.time()})
+            await asyncio.sleep(interval)
+
+    async_to_sync(send_all)()
+    latencies_ms = []
+    for _ in workers:
+        _, worker_latencies = result_queue.get(timeout=timeout + 30)
+        latencies_ms.extend(worker_latencies)
+    for worker in workers:
+        worker.join()
+
+    expected = total_messages * options['listeners'] * options['workers']
+    shard = f'{layer.consistent_hash(group_name)}/{layer.ring_size}' if hasattr(layer, 'consistent_hash') else 'n/a'
+    command.report('fanout', {
+        'workers': options['workers'],
+        'recipients': options['listeners'] * options['workers'],
+        'shard': shard,
+        'delivered': len(latencies_ms),
+        'lost': expected - len(latencies_ms),
+        **summarize_latencies(latencies_ms),
+    })
+
+
+def start_stand_in_servers(count):
+    """
+    Starts `count` Redis-compatible servers on ephemeral localhost ports in
+    background threads of this process and returns their redis:// URLs.
+    """
+    try:
+        from fakeredis import TcpFakeServer
+    except ImportError:
+        raise CommandError("--stand-in requires the 'fakeredis[lua]' package.")
+    hosts = []
+    for _ in range(count):
+        server = TcpFakeServer(('127.0.0.1', 0), server_type='redis')
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        hosts.append(f'redis://127.0.0.1:{server.server_address[1]}/0')
+    return hosts
+
+
+def fanout_worker(group_name, listeners, messages, timeout, ready_queue, result_queue, hosts=None):
+    """
+    Joins `listeners` channels of this process to `group_name` and records the
+    delivery latency of every group message they receive.
+
+    Uses the configured channel layer, or a `RedisChannelLayer` over `hosts`
+    when given. Puts the process id on `ready_queue` once subscribed, and a
+    `(pid, latencies_ms)` tuple on `result_queue` when done.
+    """
+    import django
+    django.setup()
+    from channels.layers import get_channel_layer
+    from channels_redis.core import RedisChannelLayer
+
+    async def run():
+        layer = RedisChannelLayer(hosts=hosts) if hosts else get_channel_layer()
+        channels = [await layer.new_channel() for _ in range(listeners)]
+        for channel in channels:
+            await layer.group_add(group_name, channel)
+        ready_queue.put(os.getpid())
+
+        latencies_ms = []
+
+        async def listen(channel):
+            for _ in range(messages):
+                event = await layer.receive(channel)
+                latencies_ms.append((time.time() - event['sent_at']) * 1000)
+
+        try:
+            await asyncio.wait_for(asyncio.gather(*(listen(channel) for channel in channels)), timeout)
+        except asyncio.TimeoutError:
+            pass # Missing deliveries are reported as loss by the parent.
+        for channel in channels:
+            await layer.group_discard(group_name, channel)
+        result_queue.put((os.getpid(), latencies_ms))
+
+    asyncio.run(run())
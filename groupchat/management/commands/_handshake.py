@@ -0,0 +1,93 @@
+"""
+The `handshake` benchmark scenario: a reconnect storm through the full auth
+stack, uncached and cached.
+"""
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from channels.routing import URLRouter
+from discussions.membership import is_member
+from groupchat import metrics
+from groupchat.middleware import (
+    INVALIDATION_GRACE, CachedAuthMiddlewareStack, TimedAuthMiddlewareStack, invalidate_session, invalidate_user,
+)
+from groupchat.routing import websocket_urlpatterns
+
+from ._bench import ChatFixture, QueryProfile, summarize_latencies
+from ._loadgen import InProcessClient, session_cookie
+
+
+def bench(command, options):
+    """
+    Simulates the reconnect storm after a worker restart: every member of a
+    `--members` room opens its chat socket at once, on a real session,
+    through the full middleware stack. Compares channels' session and user
+    lookups with the cached resolution, once with a cold cache (a restarted
+    worker with a per-process cache, or the first storm) and once warm (a
+    shared cache that outlived the worker).
+    """
+    members = options['members'] or 500
+    command.stdout.write(f'Creating {members} members...')
+    fixture = ChatFixture(members=members)
+    sessions = []
+    try:
+        cookies = [session_cookie(user, sessions) for user in fixture.users]
+        for user in fixture.users:
+            is_member(user.id, fixture.group.id) # Warm the membership cache; only auth differs between variants.
+        variants = (
+            ('uncached', TimedAuthMiddlewareStack, False),
+            ('cached_cold', CachedAuthMiddlewareStack, True),
+            ('cached_warm', CachedAuthMiddlewareStack, False),
+        )
+        for label, stack, cold in variants:
+            if cold:
+                for session in sessions:
+                    invalidate_session(session.session_key)
+                for user in fixture.users:
+                    invalidate_user(user.id)
+                time.sleep(INVALIDATION_GRACE) # Let the tombstones expire
+            metrics.reset()
+            profile = QueryProfile()
+            profile.install()
+            try:
+                elapsed, latencies_ms = async_to_sync(drive)(
+                    stack(URLRouter(websocket_urlpatterns)), cookies, fixture.group.id,
+                )
+            finally:
+                profile.uninstall()
+            auth = metrics.snapshot().get('auth', {})
+            command.report(label, {
+                'handshakes': members,
+                'handshakes_per_sec': round(members / elapsed, 1),
+                'queries_per_handshake': profile.summary(members)['per_message'],
+                'auth_p50_ms': auth.get('p50_ms'),
+                'auth_p99_ms': auth.get('p99_ms'),
+                **summarize_latencies(latencies_ms),
+            })
+    finally:
+        for session in sessions:
+            session.delete()
+        fixture.cleanup()
+
+
+async def drive(application, cookies, group_id):
+    """
+    Opens one connection per session cookie, all at once.
+
+    Returns:
+        tuple: Seconds until every connection was accepted, and each one's connect latency in ms.
+    """
+    async def connect(cookie):
+        client = InProcessClient(application, f'/ws/chat/{group_id}/', cookie)
+        started = time.perf_counter()
+        if not await client.connect(timeout=120):
+            raise RuntimeError("Benchmark connection was rejected.")
+        return client, (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    connected = await asyncio.gather(*(connect(cookie) for cookie in cookies))
+    elapsed = time.perf_counter() - started
+    for client, _ in connected:
+        await client.close()
+    return elapsed, [latency for _, latency in connected]
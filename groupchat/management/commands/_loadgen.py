@@ -0,0 +1,184 @@
+"""
+WebSocket clients for the chat load-generation and replay commands.
+
+`InProcessClient` drives an ASGI application in this process through channels'
+`WebsocketCommunicator`; `NetworkClient` talks to a running server over TCP.
+Both expose the same small interface: `connect()`, `send(data)`, `receive()`
+and `close()`. `session_cookie` logs a user in for either of them.
+
+`NetworkClient` is a minimal RFC 6455 client on asyncio streams. autobahn's
+asyncio client cannot be used here: once Django loads the `daphne` app, txaio
+is committed to Twisted for the whole process.
+"""
+import asyncio
+import base64
+import os
+import struct
+from importlib import import_module
+from urllib.parse import urlsplit
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+
+OP_CONTINUATION, OP_TEXT, OP_BINARY, OP_CLOSE, OP_PING, OP_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+
+
+def session_cookie(user, sessions):
+    """
+    Logs `user` in on a new session and returns the `Cookie` header value for it.
+
+    Args:
+        user (User): The user to log in.
+        sessions (list): Collects the session stores so the caller can delete them.
+    """
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    sessions.append(session)
+    return f'{settings.SESSION_COOKIE_NAME}={session.session_key}'
+
+
+def _mask(payload, mask):
+    """XORs `payload` with the repeated 4-byte `mask`; client frames must be masked (RFC 6455 section 5.3)."""
+    length = len(payload)
+    repeated = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')).to_bytes(length, 'big')
+
+
+class InProcessClient:
+    """
+    A chat connection to an ASGI application running in this process.
+
+    Args:
+        application: The ASGI application, e.g. `bookhaven.asgi.application`.
+        path (str): Request path including the query string.
+        cookie (str): `Cookie` header value carrying the session.
+        subprotocols (list, optional): Subprotocols offered in the handshake.
+    """
+
+    def __init__(self, application, path, cookie, subprotocols=None):
+        self.communicator = WebsocketCommunicator(
+            application, path, headers=[(b'cookie', cookie.encode())], subprotocols=subprotocols
+        )
+
+    async def connect(self, timeout=10):
+        """Opens the connection; returns False if the server rejected it."""
+        connected, _ = await self.communicator.connect(timeout=timeout)
+        return connected
+
+    async def send(self, data):
+        """Sends a text frame, or a binary one if `data` is bytes."""
+        if isinstance(data, bytes):
+            await self.communicator.send_to(bytes_data=data)
+        else:
+            await self.communicator.send_to(text_data=data)
+
+    async def receive(self):
+        """Returns the next frame (str or bytes), or None once the server closed the connection."""
+        while True:
+            message = await self.communicator.receive_output(timeout=24 * 60 * 60)
+            if message['type'] == 'websocket.close':
+                return None
+            if message.get('text') is not None:
+                return message['text']
+            if message.get('bytes') is not None:
+                return message['bytes']
+
+    async def close(self):
+        """Closes the connection and waits for the consumer to finish."""
+        await self.communicator.disconnect()
+
+
+class NetworkClient:
+    """
+    A chat connection to a server listening on a `ws://` URL.
+
+    Args:
+        url (str): The full URL, including path and query string.
+        cookie (str): `Cookie` header value carrying the session.
+    """
+
+    def __init__(self, url, cookie):
+        self.url = url
+        self.cookie = cookie
+        self.reader = self.writer = None
+
+    async def connect(self, timeout=10):
+        """Performs the opening handshake; returns False if it was refused or rejected."""
+        parts = urlsplit(self.url)
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        key = base64.b64encode(os.urandom(16)).decode()
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(parts.hostname, parts.port or 80), timeout
+            )
+            self.writer.write((
+                f'GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                f'Sec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\nCookie: {self.cookie}\r\n\r\n'
+            ).encode())
+            response = await asyncio.wait_for(self.reader.readuntil(b'\r\n\r\n'), timeout)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            await self.close()
+            return False
+        if response.split(b' ', 2)[1:2] != [b'101']:
+            await self.close()
+            return False
+        return True
+
+    def _write_frame(self, opcode, payload):
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+        self.writer.write(header + mask + _mask(payload, mask))
+
+    async def _read_frame(self):
+        first, second = await self.reader.readexactly(2)
+        length = second & 0x7F
+        if length == 126:
+            length, = struct.unpack('!H', await self.reader.readexactly(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', await self.reader.readexactly(8))
+        return first & 0x80, first & 0x0F, await self.reader.readexactly(length)
+
+    async def send(self, data):
+        """Sends a text frame, or a binary one if `data` is bytes."""
+        if isinstance(data, bytes):
+            self._write_frame(OP_BINARY, data)
+        else:
+            self._write_frame(OP_TEXT, data.encode())
+
+    async def receive(self):
+        """Returns the next frame (str or bytes), or None once the connection closed."""
+        message, message_opcode = b'', None
+        while True:
+            try:
+                final, opcode, payload = await self._read_frame()
+            except (OSError, asyncio.IncompleteReadError):
+                return None
+            if opcode == OP_PING:
+                self._write_frame(OP_PONG, payload)
+            elif opcode == OP_CLOSE:
+                return None
+            elif opcode in (OP_TEXT, OP_BINARY, OP_CONTINUATION):
+                message += payload
+                message_opcode = message_opcode or opcode
+                if final:
+                    return message.decode() if message_opcode == OP_TEXT else message
+
+    async def close(self):
+        """Sends a close frame and closes the socket."""
+        if self.writer and not self.writer.is_closing():
+            try:
+                self._write_frame(OP_CLOSE, struct.pack('!H', 1000))
+                self.writer.close()
+                await asyncio.wait_for(self.writer.wait_closed(), 5)
+            except (OSError, asyncio.TimeoutError):
+                pass
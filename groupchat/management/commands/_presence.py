@@ -0,0 +1,94 @@
+"""
+The `presence` benchmark scenario: presence frames delivered during a join
+storm and while members type.
+"""
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from groupchat.consumers import ChatConsumer
+from groupchat.presence import get_presence_hub
+
+from ._bench import ChatFixture, chat_communicator
+
+
+def bench(command, options):
+    """
+    Connects a `--members` room, has `--typists` of them send typing frames
+    at `--keystroke-rate` for `--duration` seconds, and compares the
+    presence frames actually delivered with a per-event fan-out.
+    """
+    members = options['members'] or 1000
+    command.stdout.write(f'Creating {members} members...')
+    fixture = ChatFixture(members=members)
+    try:
+        join, typing = async_to_sync(drive)(fixture, options)
+        command.report('join', join)
+        command.report('typing', typing)
+    finally:
+        fixture.cleanup()
+
+
+async def drive(fixture, options):
+    """Returns the join-storm and typing results."""
+    application = ChatConsumer.as_asgi()
+    members = len(fixture.users)
+    frames = [0]
+
+    async def drain(communicator):
+        while True:
+            payload = await communicator.receive_output(timeout=3600)
+            if payload.get('type') == 'websocket.send':
+                frames[0] += 1
+
+    communicators, drainers = [], []
+    started = time.perf_counter()
+    for user in fixture.users:
+        communicator = chat_communicator(application, user, fixture.group.id)
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise RuntimeError("Benchmark connection was rejected.")
+        communicators.append(communicator)
+        drainers.append(asyncio.ensure_future(drain(communicator)))
+    hub = get_presence_hub()
+    await asyncio.sleep(hub.tick * 2) # Let the last joins be announced.
+    elapsed = time.perf_counter() - started
+    join = {
+        'members': members,
+        'naive_frames': members * members, # Every join sent to everyone connected.
+        'frames': frames[0],
+        'frames_per_sec': round(frames[0] / elapsed, 1),
+        'broadcasts': hub.stats['broadcasts'],
+    }
+
+    frames[0] = 0
+    typists = communicators[:options['typists']]
+    interval = 1 / options['keystroke_rate']
+    deadline = time.perf_counter() + options['duration']
+    keystrokes = [0]
+
+    async def type_(communicator):
+        while time.perf_counter() < deadline:
+            await communicator.send_json_to({'type': 'typing'})
+            keystrokes[0] += 1
+            await asyncio.sleep(interval)
+
+    started = time.process_time()
+    await asyncio.gather(*(type_(communicator) for communicator in typists))
+    await asyncio.sleep(hub.tick * 1.5) # Deliver the final tick.
+    cpu = time.process_time() - started
+    duration = options['duration'] + hub.tick * 1.5
+    typing = {
+        'typists': len(typists),
+        'keystrokes_per_sec': round(keystrokes[0] / options['duration'], 1),
+        'naive_frames_per_sec': round(keystrokes[0] / options['duration'] * members, 1),
+        'frames_per_sec': round(frames[0] / duration, 1),
+        'frames_per_member_per_sec': round(frames[0] / duration / members, 2),
+        'cpu_pct': round(cpu / duration * 100, 1),
+    }
+
+    for drainer in drainers:
+        drainer.cancel()
+    for communicator in communicators:
+        await communicator.disconnect()
+    return join, typing
@@ -0,0 +1,101 @@
+"""
+The `receive` benchmark scenario: the legacy two-hop receive path against the
+async ORM fast path.
+"""
+import asyncio
+import json
+import time
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from discussions.models import DiscussionGroup
+from groupchat.consumers import ChatConsumer
+from groupchat.models import GroupChatMessage
+
+from ._bench import ChatFixture, chat_communicator, summarize_latencies
+
+
+class LegacyChatConsumer(ChatConsumer):
+    """
+    Reproduces the original receive path for comparison: one thread hop that
+    re-fetches the `DiscussionGroup` before the INSERT, and a second hop to
+    resolve the sender's full name for every message.
+    """
+
+    async def receive(self, text_data):
+        data = json.loads(text_data)
+        chat_message = await self.legacy_save_message(self.user, self.group_id, data['message'])
+        user_full_name = await self.legacy_get_user_full_name(self.user)
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                'type': 'chat.message',
+                'group_id': self.group_id,
+                'message_id': chat_message.id,
+                'temp_id': data.get('temp_id'),
+                'user_id': self.user.id,
+                'username': self.user.username,
+                'user_full_name': user_full_name,
+                'text': chat_message.text_content,
+                'timestamp': chat_message.timestamp.isoformat(),
+            }
+        )
+
+    @database_sync_to_async
+    def legacy_save_message(self, user, group_id, message_text):
+        group = DiscussionGroup.objects.get(id=group_id)
+        return GroupChatMessage.objects.create(user=user, group=group, text_content=message_text)
+
+    @database_sync_to_async
+    def legacy_get_user_full_name(self, user):
+        return user.get_full_name() or user.username
+
+
+def bench(command, options):
+    """Compares the legacy two-hop receive path with the async ORM fast path."""
+    fixture = ChatFixture(members=options['clients'])
+    try:
+        for label, consumer_class in (('before', LegacyChatConsumer), ('after', ChatConsumer)):
+            result = async_to_sync(drive)(consumer_class, fixture, options['messages'], options['clients'])
+            command.report(label, result)
+    finally:
+        fixture.cleanup()
+
+
+async def drive(consumer_class, fixture, total_messages, clients):
+    """
+    Connects `clients` members, has each send its share of messages one at a
+    time and records the latency until its own echo arrives.
+    """
+    application = consumer_class.as_asgi()
+    communicators = [chat_communicator(application, user, fixture.group.id) for user in fixture.users[:clients]]
+    for communicator in communicators:
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise RuntimeError("Benchmark connection was rejected.")
+
+    latencies_ms = []
+    per_client = max(1, total_messages // len(communicators))
+
+    async def sender(index, communicator):
+        for sequence in range(per_client):
+            temp_id = f'temp_{index}_{sequence}'
+            started = time.perf_counter()
+            await communicator.send_json_to({'message': f'bench {sequence}', 'temp_id': temp_id})
+            while True:
+                frame = await communicator.receive_json_from(timeout=30)
+                if frame.get('temp_id') == temp_id:
+                    break
+            latencies_ms.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(index, communicator) for index, communicator in enumerate(communicators)))
+    elapsed = time.perf_counter() - started
+
+    for communicator in communicators:
+        await communicator.disconnect()
+    return {
+        'messages': len(latencies_ms),
+        'msgs_per_sec': round(len(latencies_ms) / elapsed, 1),
+        **summarize_latencies(latencies_ms),
+    }
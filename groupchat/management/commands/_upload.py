@@ -0,0 +1,70 @@
+"""
+The `upload` benchmark scenario: throughput and memory of the chunked upload
+protocol.
+"""
+import resource
+import time
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from groupchat.consumers import ChatConsumer
+from groupchat.models import GroupChatMessage
+from groupchat.uploads import encode_chunk
+
+from ._bench import ChatFixture, chat_communicator, receive_frame
+
+
+def bench(command, options):
+    """
+    Streams a `--upload-mb` file through the chunked upload protocol and
+    reports throughput and how much the process's peak RSS grew.
+    """
+    fixture = ChatFixture(members=1)
+    try:
+        result = async_to_sync(drive)(fixture, options['upload_mb'] * 1024 * 1024)
+        command.report('upload', result)
+    finally:
+        fixture.cleanup()
+
+
+async def drive(fixture, size):
+    """Uploads `size` bytes of generated data, honouring the server's window."""
+    communicator = chat_communicator(ChatConsumer.as_asgi(), fixture.users[0], fixture.group.id)
+    connected, _ = await communicator.connect()
+    if not connected:
+        raise RuntimeError("Benchmark connection was rejected.")
+    peak_before_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    started = time.perf_counter()
+    await communicator.send_json_to({'type': 'upload.start', 'temp_id': 'temp_upload', 'file_name': 'bench.bin', 'size': size})
+    ready = await receive_frame(communicator)
+    if ready.get('type') != 'upload.ready':
+        raise RuntimeError(f"Upload was refused: {ready}")
+    upload_id, chunk, window = ready['upload_id'], ready['chunk_size'], ready['window']
+    block = bytes(range(256)) * (chunk // 256 + 1)
+
+    sent = acked = 0
+    while acked < size:
+        while sent < size and sent - acked < chunk * window:
+            length = min(chunk, size - sent)
+            await communicator.send_to(bytes_data=encode_chunk(upload_id, sent, block[:length]))
+            sent += length
+        frame = await receive_frame(communicator)
+        if frame.get('type') != 'upload.ack':
+            raise RuntimeError(f"Unexpected frame during upload: {frame}")
+        acked = frame['offset']
+    broadcast = await receive_frame(communicator, timeout=60)
+    elapsed = time.perf_counter() - started
+    await communicator.disconnect()
+
+    peak_after_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    message = await GroupChatMessage.objects.aget(id=broadcast['id'])
+    stored = message.file_attachment.size
+    await database_sync_to_async(message.file_attachment.delete)(save=False)
+    return {
+        'mib': size // (1024 * 1024),
+        'stored_bytes_ok': stored == size,
+        'mib_per_sec': round(size / (1024 * 1024) / elapsed, 1),
+        'peak_rss_mib': round(peak_after_kb / 1024, 1),
+        'peak_rss_growth_mib': round((peak_after_kb - peak_before_kb) / 1024, 1),
+    }
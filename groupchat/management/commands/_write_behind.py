@@ -0,0 +1,41 @@
+"""
+The `write_behind` benchmark scenario: persisted messages/sec of the
+write-behind writer per batch size.
+"""
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync
+from groupchat.persistence import MessageWriter
+
+from ._bench import ChatFixture
+
+
+def bench(command, options):
+    """Measures persisted messages/sec of the write-behind writer per batch size."""
+    fixture = ChatFixture(members=1)
+    try:
+        for batch_size in (int(size) for size in options['batch_sizes'].split(',')):
+            result = async_to_sync(drive)(fixture, options['messages'], batch_size)
+            command.report(f'batch={batch_size}', result)
+    finally:
+        fixture.cleanup()
+
+
+async def drive(fixture, total_messages, batch_size):
+    """Enqueues `total_messages` messages and times until all are stored."""
+    writer = MessageWriter(batch_size=batch_size, flush_interval=0.01)
+    user_id, group_id = fixture.users[0].id, fixture.group.id
+    started = time.perf_counter()
+    for sequence in range(total_messages):
+        writer.enqueue(user_id, group_id, f'bench {sequence}')
+        if sequence % batch_size == 0:
+            await asyncio.sleep(0) # Let the flusher run, as interleaved receives would.
+    await writer.flush()
+    elapsed = time.perf_counter() - started
+    return {
+        'persisted': writer.stats['persisted'],
+        'failed': writer.stats['failed'],
+        'batches': writer.stats['batches'],
+        'msgs_per_sec': round(writer.stats['persisted'] / elapsed, 1),
+    }
@@ -0,0 +1,59 @@
+"""
+Management command moving old chat messages into compressed archive segments
+(see `groupchat.archive`).
+
+Each group's messages from whole months older than its horizon are archived;
+history reads continue into the archive transparently. With `--loop` the
+command keeps running and archives every `--interval` seconds, for
+deployments that run it as a long-lived worker rather than from cron.
+
+Usage:
+    python manage.py chat_archive --dry-run
+    python manage.py chat_archive --group 12 --group 15
+    python manage.py chat_archive --loop --interval 3600
+"""
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+from discussions.models import DiscussionGroup
+from groupchat.archive import archive_group
+
+
+class Command(BaseCommand):
+    help = "Moves chat messages older than each group's horizon into compressed archive segments."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--group', type=int, action='append', help="Only archive this group (repeatable).")
+        parser.add_argument('--dry-run', action='store_true', help="Report what would be archived without changing anything.")
+        parser.add_argument('--loop', action='store_true', help="Keep running, archiving every --interval seconds.")
+        parser.add_argument(
+            '--interval', type=float, default=getattr(settings, 'GROUPCHAT_ARCHIVE_INTERVAL', 3600),
+            help="Seconds between runs with --loop.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            self.run(options)
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
+
+    def run(self, options):
+        """Archives every selected group once and reports the totals."""
+        groups = DiscussionGroup.objects.only('id', 'chat_archive_days').order_by('id')
+        if options['group']:
+            groups = groups.filter(id__in=options['group'])
+        log = self.stdout.write if options['verbosity'] > 1 else None
+        totals = {'groups': 0, 'messages': 0, 'segments': 0, 'bytes': 0}
+        for group in groups.iterator():
+            moved = archive_group(group, dry_run=options['dry_run'], log=log)
+            if moved['messages']:
+                totals['groups'] += 1
+                for key, value in moved.items():
+                    totals[key] += value
+        self.stdout.write(
+            f"{'Would archive' if options['dry_run'] else 'Archived'} {totals['messages']} message(s) of "
+            f"{totals['groups']} group(s) into {totals['segments']} segment(s), {filesizeformat(totals['bytes'])} compressed."
+        )
@@ -0,0 +1,67 @@
+"""
+Management command for micro-benchmarking the group chat hot paths.
+
+Each scenario drives the real consumers in-process through channels'
+`WebsocketCommunicator` against the configured database and channel layer,
+so numbers are comparable between builds on the same machine. Scenarios live
+in this package's underscore modules, one per feature; each exposes
+`bench(command, options)`.
+
+Message rate limits are disabled while a scenario runs, unless
+`--rate-limits` is passed.
+
+Usage:
+    python manage.py chat_benchmark receive --messages 2000 --clients 8
+"""
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from . import (
+    _admission, _affinity, _batch, _drain, _fanout, _handshake, _presence, _receive, _upload, _wire, _write_behind,
+)
+
+
+class Command(BaseCommand):
+    help = "Benchmarks group chat hot paths in-process (messages/sec and latency percentiles)."
+
+    scenarios = {
+        'receive': _receive, 'write_behind': _write_behind, 'fanout': _fanout, 'wire': _wire, 'upload': _upload,
+        'presence': _presence, 'batch': _batch, 'handshake': _handshake, 'admission': _admission, 'drain': _drain,
+        'affinity': _affinity,
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=list(self.scenarios), help="The benchmark scenario to run.")
+        parser.add_argument('--messages', type=int, default=1000, help="Total messages sent per variant.")
+        parser.add_argument('--clients', type=int, default=4, help="Concurrent sending connections.")
+        parser.add_argument('--batch-sizes', default='1,16,128', help="Comma-separated write-behind batch sizes.")
+        parser.add_argument('--workers', type=int, default=4, help="Worker processes for the fanout scenario.")
+        parser.add_argument('--listeners', type=int, default=25, help="Subscribed channels per fanout worker.")
+        parser.add_argument('--rate', type=float, default=50.0, help="Messages per second sent in the fanout and batch scenarios, and to the affinity scenario's hot room.")
+        parser.add_argument(
+            '--members', type=int, default=None,
+            help=(
+                "Room size for the wire (default 500), presence (default 1000), batch (default 300) "
+                "handshake (default 500), admission (default 2000), drain (default 1000 connections) "
+                "and affinity (default 300) scenarios."
+            ),
+        )
+        parser.add_argument('--typists', type=int, default=100, help="Members typing in the presence scenario.")
+        parser.add_argument('--keystroke-rate', type=float, default=5.0, help="Typing frames per second per typist.")
+        parser.add_argument('--duration', type=float, default=5.0, help="Seconds of load in the presence, batch and affinity scenarios; the drain window.")
+        parser.add_argument('--upload-mb', type=int, default=200, help="File size for the upload scenario, in MiB.")
+        parser.add_argument('--rate-limits', action='store_true', help="Keep the message rate limits enabled.")
+        parser.add_argument(
+            '--stand-in', type=int, default=0, metavar='N',
+            help="Run the fanout scenario against N in-process Redis-compatible stand-in servers (requires fakeredis).",
+        )
+
+    def handle(self, *args, **options):
+        limits = {} if options['rate_limits'] else {'GROUPCHAT_USER_MESSAGE_RATE': 0, 'GROUPCHAT_ROOM_MESSAGE_RATE': 0}
+        with override_settings(**limits):
+            self.scenarios[options['scenario']].bench(self, options)
+
+    def report(self, label, result):
+        """Writes one result row to stdout."""
+        fields = ', '.join(f'{key}={value}' for key, value in result.items())
+        self.stdout.write(f'{label:<12} {fields}')
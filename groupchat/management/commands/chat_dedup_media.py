@@ -0,0 +1,104 @@
+"""
+Management command deduplicating the chat attachments already in `MEDIA_ROOT`
+(see `groupchat.storage`).
+
+Every file under `group_chat_files/` that is not yet a link to a blob is
+hashed. If a blob with its content exists, the file is replaced by a hard link
+to it (its own bytes are freed once no other name links them); otherwise the
+file becomes the blob for its content. Names, and so the attachments' paths
+and URLs, do not change. Files sharing an inode are hashed once, and running
+the command again only hashes what was added without deduplication.
+
+`--prune` also removes blobs no attachment links any more (link count 1),
+such as those of deleted messages. Blobs are only pruned once unchanged for
+`PRUNE_GRACE` seconds, so an upload between storing its blob and linking its
+name keeps it.
+
+Usage:
+    python manage.py chat_dedup_media --dry-run
+    python manage.py chat_dedup_media --prune
+"""
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+from groupchat.storage import ContentAddressedStorage, file_digest
+
+ATTACHMENT_DIR = 'group_chat_files'
+PRUNE_GRACE = 3600 # seconds since a blob's last link change before it may be pruned
+
+
+class Command(BaseCommand):
+    help = "Replaces duplicate chat attachments with hard links to shared blobs and reports the bytes reclaimed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report what would change without changing anything.")
+        parser.add_argument('--prune', action='store_true', help="Also remove blobs no attachment links.")
+
+    def handle(self, *args, **options):
+        storage = ContentAddressedStorage()
+        dry_run = options['dry_run']
+        counts = {'files': 0, 'bytes': 0, 'duplicates': 0, 'reclaimed': 0, 'pruned': 0, 'pruned_bytes': 0}
+        digests = {} # (st_dev, st_ino) -> digest, so hard-linked names are hashed once
+        new_blobs = {} # digest -> (st_dev, st_ino) of the files that become blobs in this run
+
+        for path in self.walk(storage.path(ATTACHMENT_DIR)):
+            stat = os.stat(path)
+            counts['files'] += 1
+            counts['bytes'] += stat.st_size
+            inode = stat.st_dev, stat.st_ino
+            digest = digests.get(inode)
+            if digest is None:
+                digest = digests[inode] = file_digest(path)
+            blob = storage.blob_path(digest)
+            blob_inode = new_blobs.get(digest)
+            if blob_inode is None:
+                try:
+                    blob_stat = os.stat(blob)
+                    blob_inode = blob_stat.st_dev, blob_stat.st_ino
+                except FileNotFoundError:
+                    new_blobs[digest] = inode # This file's inode becomes the blob
+                    if not dry_run:
+                        os.makedirs(os.path.dirname(blob), exist_ok=True)
+                        os.link(path, blob)
+                    continue
+            if blob_inode == inode:
+                continue # Already linked
+            counts['duplicates'] += 1
+            if stat.st_nlink == 1:
+                counts['reclaimed'] += stat.st_size
+            if not dry_run:
+                # Link under a temporary name and rename over the file, so the name never goes missing.
+                temp_path = f'{path}.dedup-{os.getpid()}'
+                os.link(blob, temp_path)
+                os.replace(temp_path, path)
+
+        if options['prune']:
+            cutoff = time.time() - PRUNE_GRACE
+            for path in self.walk(storage.path(storage.blob_dir)):
+                stat = os.stat(path)
+                if stat.st_nlink == 1 and stat.st_ctime < cutoff and (stat.st_dev, stat.st_ino) not in new_blobs.values():
+                    counts['pruned'] += 1
+                    counts['pruned_bytes'] += stat.st_size
+                    if not dry_run:
+                        os.remove(path)
+
+        self.stdout.write(
+            f"{'Would reclaim' if dry_run else 'Reclaimed'} {filesizeformat(counts['reclaimed'])} "
+            f"({counts['reclaimed']} bytes): {counts['duplicates']} duplicate(s) among {counts['files']} file(s) "
+            f"({filesizeformat(counts['bytes'])}), {len(new_blobs)} new blob(s)."
+        )
+        if options['prune']:
+            self.stdout.write(
+                f"{'Would prune' if dry_run else 'Pruned'} {counts['pruned']} unreferenced blob(s), "
+                f"{filesizeformat(counts['pruned_bytes'])} ({counts['pruned_bytes']} bytes)."
+            )
+
+    def walk(self, root):
+        """Yields the paths of the regular files under `root`, skipping staging and temporary files."""
+        for directory, _, files in os.walk(root):
+            for name in sorted(files):
+                path = os.path.join(directory, name)
+                if not name.startswith('.staging-') and '.dedup-' not in name and os.path.isfile(path):
+                    yield path
@@ -0,0 +1,258 @@
+"""
+Management command generating WebSocket load against the chat subsystem.
+
+Seeds `--rooms` discussion groups with `--members` synthetic members each,
+connects every member with a real session cookie, and has each room send
+`--rate` messages/sec from randomly chosen members (seeded with `--seed`) for
+`--duration` seconds. Reports connect rate, end-to-end delivery latency
+percentiles, message loss and database write rate, and with `--output` also
+writes them as JSON for regression tracking.
+
+Targets:
+    (default)  `bookhaven.asgi.application` in this process through channels'
+               `WebsocketCommunicator`.
+    --daphne   A `python -m groupchat.server` process started on a free local
+               port with this process's settings.
+    --url      An already running server, e.g. `ws://127.0.0.1:8000`. Its own
+               settings apply, and it must share this process's database
+               because the synthetic users' sessions are created here.
+
+Message rate limits are disabled for the in-process and `--daphne` targets
+unless `--rate-limits` is passed; rejected messages are reported separately
+from lost ones.
+
+Usage:
+    python manage.py chat_loadgen --rooms 10 --members 50 --rate 5 --duration 30 --output load.json
+"""
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+from django.test import override_settings
+from django.utils import timezone
+from groupchat.models import GroupChatMessage
+
+from ._bench import ChatFixture, percentile, summarize_latencies
+from ._loadgen import InProcessClient, NetworkClient, session_cookie
+
+RATE_LIMITS_OFF = {'GROUPCHAT_USER_MESSAGE_RATE': 0, 'GROUPCHAT_ROOM_MESSAGE_RATE': 0}
+
+
+class Command(BaseCommand):
+    help = "Generates chat WebSocket load (rooms x members x message rate) and reports capacity metrics."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=5, help="Number of rooms.")
+        parser.add_argument('--members', type=int, default=20, help="Connected members per room.")
+        parser.add_argument('--rate', type=float, default=2.0, help="Messages per second sent in each room.")
+        parser.add_argument('--duration', type=float, default=10.0, help="Seconds of message traffic.")
+        parser.add_argument('--seed', type=int, default=0, help="Seed for sender choice and timing.")
+        parser.add_argument('--connect-concurrency', type=int, default=50, help="Connections opened at once.")
+        parser.add_argument('--drain-timeout', type=float, default=10.0, help="Seconds to wait for late deliveries.")
+        parser.add_argument('--batch', action='store_true', help="Connect with ?batch=1 to accept array frames.")
+        parser.add_argument('--rate-limits', action='store_true', help="Keep the message rate limits enabled.")
+        target = parser.add_mutually_exclusive_group()
+        target.add_argument('--daphne', action='store_true', help="Start a local chat server and connect over TCP.")
+        target.add_argument('--url', help="Base ws:// URL of a running server sharing this database.")
+        parser.add_argument('--output', help="Write the configuration and results to this JSON file.")
+
+    def handle(self, *args, **options):
+        if options['rooms'] < 1 or options['members'] < 1 or options['rate'] <= 0:
+            raise CommandError("--rooms and --members must be at least 1 and --rate positive.")
+        self.stdout.write(f"Seeding {options['rooms']} rooms x {options['members']} members...")
+        fixture = ChatFixture(members=options['members'], rooms=options['rooms'])
+        sessions, server = [], None
+        try:
+            cookies = {user.id: session_cookie(user, sessions) for user in fixture.users}
+            url = options['url']
+            if options['daphne']:
+                server, url = self.start_server(options['rate_limits'])
+            limits = {} if options['rate_limits'] or options['url'] else RATE_LIMITS_OFF
+            with override_settings(**limits):
+                results = async_to_sync(self.run_load)(fixture, cookies, url, options)
+        finally:
+            if server:
+                server.terminate()
+                server.wait(timeout=10)
+            for session in sessions:
+                session.delete()
+            fixture.cleanup()
+
+        for section in ('connect', 'delivery', 'database'):
+            self.report(section, results[section])
+        if options['output']:
+            config = {key: options[key] for key in (
+                'rooms', 'members', 'rate', 'duration', 'seed', 'connect_concurrency', 'batch', 'rate_limits',
+            )}
+            config['target'] = 'daphne' if options['daphne'] else options['url'] or 'in-process'
+            with open(options['output'], 'w') as output:
+                json.dump({'finished_at': timezone.now().isoformat(), 'config': config, 'results': results}, output, indent=2)
+            self.stdout.write(f"Wrote {options['output']}")
+
+    def report(self, label, result):
+        """Writes one result row to stdout."""
+        fields = ', '.join(f'{key}={value}' for key, value in result.items())
+        self.stdout.write(f'{label:<10} {fields}')
+
+    def start_server(self, rate_limits):
+        """
+        Starts `python -m groupchat.server` on a free localhost port and waits
+        until it accepts connections.
+
+        Returns:
+            tuple: The `subprocess.Popen` and the server's base `ws://` URL.
+        """
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'bookhaven.settings'))
+        if not rate_limits:
+            env.update({name: '0' for name in RATE_LIMITS_OFF})
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'groupchat.server', '-b', '127.0.0.1', '-p', str(port), 'bookhaven.asgi:application'],
+            env=env, cwd=settings.BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f"The chat server exited: {server.stderr.read().decode()[-2000:]}")
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return server, f'ws://127.0.0.1:{port}'
+            except OSError:
+                time.sleep(0.2)
+        server.terminate()
+        raise CommandError("The chat server did not start listening within 30 seconds.")
+
+    async def run_load(self, fixture, cookies, url, options):
+        """Connects every member, runs the message traffic and returns the result sections."""
+        application = None
+        if not url:
+            from bookhaven.asgi import application
+        query = '?batch=1' if options['batch'] else ''
+
+        def make_client(group_id, user):
+            path = f'/ws/chat/{group_id}/{query}'
+            if url:
+                return NetworkClient(url.rstrip('/') + path, cookies[user.id])
+            return InProcessClient(application, path, cookies[user.id])
+
+        # --- connect ---
+        rooms = {group_id: [] for group_id in fixture.members}
+        connect_ms, failures = [], [0]
+        semaphore = asyncio.Semaphore(options['connect_concurrency'])
+
+        async def connect(group_id, user):
+            async with semaphore:
+                client = make_client(group_id, user)
+                started = time.perf_counter()
+                try:
+                    connected = await client.connect()
+                except Exception:
+                    connected = False
+                if connected:
+                    connect_ms.append((time.perf_counter() - started) * 1000)
+                    rooms[group_id].append(client)
+                else:
+                    failures[0] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            connect(group_id, user) for group_id, users in fixture.members.items() for user in users
+        ))
+        connect_elapsed = time.perf_counter() - started
+        clients = [client for room in rooms.values() for client in room]
+        connect = {
+            'connections': len(clients),
+            'failed': failures[0],
+            'connects_per_sec': round(len(clients) / connect_elapsed, 1),
+            'p50_ms': round(percentile(connect_ms, 50), 3),
+            'p99_ms': round(percentile(connect_ms, 99), 3),
+        }
+
+        # --- traffic ---
+        sent, delivered, rejected, latencies_ms = {}, Counter(), set(), []
+
+        async def read(client):
+            while True:
+                text = await client.receive()
+                if text is None:
+                    return
+                received = time.perf_counter()
+                frame = json.loads(text)
+                for item in frame if isinstance(frame, list) else (frame,):
+                    temp_id = item.get('temp_id')
+                    if temp_id not in sent:
+                        continue
+                    if item.get('message_type') == 'new_message':
+                        delivered[temp_id] += 1
+                        latencies_ms.append((received - sent[temp_id][0]) * 1000)
+                    elif item.get('type') == 'message.error':
+                        rejected.add(temp_id)
+
+        async def send_room(index, group_id, members):
+            rng = random.Random(f"{options['seed']}:{index}")
+            interval = 1 / options['rate']
+            await asyncio.sleep(rng.random() * interval) # Keep the rooms out of lockstep.
+            room_started = time.perf_counter()
+            for sequence in range(int(options['rate'] * options['duration'])):
+                temp_id = f'load_{index}_{sequence}'
+                sent[temp_id] = (time.perf_counter(), group_id)
+                await rng.choice(members).send(json.dumps({'message': f'Load test message {sequence}', 'temp_id': temp_id}))
+                await asyncio.sleep(max(0.0, room_started + (sequence + 1) * interval - time.perf_counter()))
+
+        readers = [asyncio.ensure_future(read(client)) for client in clients]
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            send_room(index, group_id, members) for index, (group_id, members) in enumerate(rooms.items()) if members
+        ))
+        traffic_elapsed = time.perf_counter() - started
+
+        def expected():
+            return sum(len(rooms[group_id]) for temp_id, (_, group_id) in sent.items() if temp_id not in rejected)
+
+        deadline = time.perf_counter() + options['drain_timeout']
+        while sum(delivered.values()) < expected() and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        total_expected, total_delivered = expected(), sum(delivered.values())
+        delivery = {
+            'sent': len(sent),
+            'sent_per_sec': round(len(sent) / traffic_elapsed, 1),
+            'rejected': len(rejected),
+            'expected': total_expected,
+            'delivered': total_delivered,
+            'lost': total_expected - total_delivered,
+            'loss_pct': round((total_expected - total_delivered) / total_expected * 100, 3) if total_expected else 0.0,
+            'deliveries_per_sec': round(total_delivered / traffic_elapsed, 1),
+            **summarize_latencies(latencies_ms),
+        }
+
+        # --- database ---
+        accepted = len(sent) - len(rejected)
+        stored = GroupChatMessage.objects.filter(group_id__in=list(rooms))
+        deadline = time.perf_counter() + options['drain_timeout']
+        while await stored.acount() < accepted and time.perf_counter() < deadline:
+            await asyncio.sleep(0.1) # Write-behind batches may still be in flight.
+        span = await stored.aaggregate(first=Min('timestamp'), last=Max('timestamp'))
+        writes = await stored.acount()
+        seconds = (span['last'] - span['first']).total_seconds() if writes > 1 else 0
+        database = {
+            'writes': writes,
+            'missing': accepted - writes,
+            'writes_per_sec': round(writes / seconds, 1) if seconds else float(writes),
+        }
+
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+        return {'connect': connect, 'delivery': delivery, 'database': database}
@@ -0,0 +1,321 @@
+"""
+Management command replaying captured chat traffic (see `groupchat.recorder`)
+into this process's `bookhaven.asgi.application`.
+
+Recorded rooms and users are mapped onto a synthetic fixture with as many
+rooms, and as many members per room, as the logs contain, so a replay needs
+no production data. Every recorded connection is opened, fed its frames and
+closed at its recorded time divided by `--speed` (0 replays without delays).
+Frames are re-encoded with the recorded codec, resume requests (`last_id`)
+are dropped, and upload chunks are re-sent as zero bytes of the recorded size
+once the replayed `upload.start` has been answered. A multiplexed connection
+is replayed by the fixture member standing in for its user in the first room
+it subscribed to, made a member of its other rooms too, with the 'group' of
+every frame mapped onto the fixture.
+
+Reports message echo latency (from sending a message until its broadcast
+arrives back on the same connection), the server's per-stage latency
+histograms (`groupchat.metrics`) and the database queries issued, by
+statement type. `--output` writes the results as JSON, and `--baseline`
+compares them with an earlier output, e.g. from another build.
+
+Message rate limits and traffic recording are disabled while replaying,
+unless `--rate-limits` is passed.
+
+Usage:
+    python manage.py chat_replay logs/chat-*.msgpack.gz --speed 10 --output new.json --baseline old.json
+"""
+import asyncio
+import json
+import time
+from collections import defaultdict
+from datetime import datetime
+from urllib.parse import parse_qsl, urlencode
+
+import msgpack
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from discussions.models import GroupMembership
+from groupchat import metrics
+from groupchat.persistence import get_message_writer, write_behind_enabled
+from groupchat.recorder import read_log
+from groupchat.uploads import encode_chunk
+from groupchat.wire import CODECS, FIELD_NAMES
+
+from ._bench import ChatFixture, QueryProfile, summarize_latencies
+from ._loadgen import InProcessClient, session_cookie
+
+CODECS_BY_NAME = {codec.name: codec for codec in CODECS}
+ECHO_TIMEOUT = 10 # seconds a connection waits for its last messages' echoes before closing
+
+
+def decode_server_frame(codec, data):
+    """Returns the frames in a server frame (a batch is an array of frames), with long field names."""
+    if codec.name == 'json':
+        frame = json.loads(data)
+    else:
+        frame = msgpack.unpackb(data, raw=False)
+    frames = frame if isinstance(frame, list) else [frame]
+    if codec.name != 'json':
+        frames = [{FIELD_NAMES.get(key, key): value for key, value in item.items()} for item in frames]
+    return frames
+
+
+def flatten(results, prefix=''):
+    """Returns `{'section.key': number}` for every numeric leaf of a results dict."""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+class Command(BaseCommand):
+    help = "Replays captured chat WebSocket traffic in-process and reports latency and DB-query profiles."
+
+    def add_arguments(self, parser):
+        parser.add_argument('logs', nargs='+', help="Traffic logs written with GROUPCHAT_RECORD_DIR.")
+        parser.add_argument('--speed', type=float, default=1.0, help="Replay speed factor; 0 replays without delays.")
+        parser.add_argument('--rate-limits', action='store_true', help="Keep the message rate limits enabled.")
+        parser.add_argument('--output', help="Write the results to this JSON file.")
+        parser.add_argument('--baseline', help="Compare the results with an earlier --output file.")
+
+    def handle(self, *args, **options):
+        if options['speed'] < 0:
+            raise CommandError("--speed must not be negative.")
+        recorded, logs = self.load(options['logs'])
+        if not recorded:
+            raise CommandError("The logs contain no connections.")
+
+        # Map the recorded rooms and users onto a fixture of the same shape.
+        room_users = defaultdict(list)
+        for connection in recorded:
+            for group_id in connection['groups']:
+                users = room_users[group_id]
+                if connection['user_id'] not in users:
+                    users.append(connection['user_id'])
+        if not room_users:
+            raise CommandError("The logs contain no connections to a room.")
+        rooms = sorted(room_users)
+        fixture = ChatFixture(members=max(len(users) for users in room_users.values()), rooms=len(rooms))
+        sessions = []
+        try:
+            cookies, members, group_map = {}, {}, {}
+            for group, group_id in zip(fixture.groups, rooms):
+                group_map[group_id] = group.id
+                for member, user_id in zip(fixture.members[group.id], room_users[group_id]):
+                    members[group_id, user_id] = member
+                    cookies[group_id, user_id] = (group.id, session_cookie(member, sessions))
+            for connection in recorded:
+                if connection['group_id'] is None and connection['groups']:
+                    first, *others = connection['groups']
+                    member = members[first, connection['user_id']]
+                    GroupMembership.objects.bulk_create(
+                        [GroupMembership(user=member, group_id=group_map[group_id]) for group_id in others],
+                        ignore_conflicts=True,
+                    )
+                    cookies[None, connection['user_id']] = (None, cookies[first, connection['user_id']][1])
+            overrides = {'GROUPCHAT_RECORD_DIR': None}
+            if not options['rate_limits']:
+                overrides.update(GROUPCHAT_USER_MESSAGE_RATE=0, GROUPCHAT_ROOM_MESSAGE_RATE=0)
+            self.stdout.write(f"Replaying {len(recorded)} connections from {logs} log(s) in {len(rooms)} rooms...")
+            profile = QueryProfile()
+            profile.install()
+            try:
+                with override_settings(**overrides):
+                    results = async_to_sync(self.replay)(recorded, cookies, group_map, options['speed'], profile)
+            finally:
+                profile.uninstall()
+        finally:
+            for session in sessions:
+                session.delete()
+            fixture.cleanup()
+        results['replay']['logs'] = logs
+
+        for section in ('replay', 'echo'):
+            self.report(section, results[section])
+        for stage, summary in results['stages'].items():
+            self.report(f'stage.{stage}', summary)
+        for verb, summary in results['queries'].items():
+            self.report(f'sql.{verb}', summary if isinstance(summary, dict) else {'queries': summary})
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+            self.stdout.write(f"Wrote {options['output']}")
+        if options['baseline']:
+            self.compare(options['baseline'], results)
+
+    def report(self, label, result):
+        """Writes one result row to stdout."""
+        fields = ', '.join(f'{key}={value}' for key, value in result.items())
+        self.stdout.write(f'{label:<22} {fields}')
+
+    def load(self, paths):
+        """
+        Reads traffic logs into one timeline.
+
+        Returns:
+            tuple: The recorded connections, each a dict with 'group_id'
+                   (None if multiplexed), 'groups' (the rooms it used, in
+                   order), 'user_id', 'codec', 'query', 'start' and 'events'
+                   (times in milliseconds from the earliest log's start), and
+                   the number of logs read.
+        """
+        parsed = []
+        for path in paths:
+            try:
+                records = read_log(path)
+                header = next(records)
+                parsed.append((datetime.fromisoformat(header['started_at']), list(records)))
+            except (OSError, ValueError, StopIteration) as e:
+                raise CommandError(f"Cannot read {path}: {e}")
+        origin = min(started for started, _ in parsed)
+        timeline = {}
+        for index, (started, records) in enumerate(parsed):
+            offset_ms = (started - origin).total_seconds() * 1000
+            for kind, t, conn, *fields in records:
+                key = (index, conn)
+                if kind == 'c':
+                    group_id, user_id, codec, query = fields
+                    timeline[key] = {
+                        'group_id': group_id, 'groups': [] if group_id is None else [group_id], 'user_id': user_id,
+                        'codec': codec, 'query': query, 'start': offset_ms + t, 'events': [],
+                    }
+                elif key in timeline:
+                    connection = timeline[key]
+                    connection['events'].append((offset_ms + t, kind, fields))
+                    frame = fields[0] if kind == 'r' else None
+                    if connection['group_id'] is None and frame and frame.get('type') == 'subscribe':
+                        if isinstance(frame.get('group'), int) and frame['group'] not in connection['groups']:
+                            connection['groups'].append(frame['group'])
+        # A multiplexed connection that never subscribed has no room to stand in for.
+        connections = [connection for connection in timeline.values() if connection['groups']]
+        return sorted(connections, key=lambda connection: connection['start']), len(parsed)
+
+    async def replay(self, recorded, cookies, group_map, speed, profile):
+        """Runs every recorded connection against the in-process application and returns the results."""
+        from bookhaven.asgi import application
+
+        counters = defaultdict(int)
+        latencies_ms = []
+        started = time.perf_counter()
+
+        async def at(t_ms):
+            if speed:
+                await asyncio.sleep(max(0.0, started + t_ms / 1000 / speed - time.perf_counter()))
+
+        async def read(client, codec, pending, uploads):
+            while True:
+                data = await client.receive()
+                if data is None:
+                    return
+                received = time.perf_counter()
+                for frame in decode_server_frame(codec, data):
+                    temp_id = frame.get('temp_id')
+                    if frame.get('type') == 'upload.ready':
+                        uploads[temp_id] = frame['upload_id']
+                    elif temp_id in pending and frame.get('message_type') == 'new_message':
+                        latencies_ms.append((received - pending.pop(temp_id)) * 1000)
+                    elif temp_id in pending and frame.get('type') == 'message.error':
+                        pending.pop(temp_id)
+                        counters['errors'] += 1
+
+        async def run(connection):
+            await at(connection['start'])
+            group_id, cookie = cookies[connection['group_id'], connection['user_id']]
+            codec = CODECS_BY_NAME[connection['codec']]
+            query = urlencode([(key, value) for key, value in parse_qsl(connection['query']) if key != 'last_id'])
+            path = '/ws/chat/' if group_id is None else f'/ws/chat/{group_id}/'
+            client = InProcessClient(
+                application, path + (f'?{query}' if query else ''), cookie,
+                subprotocols=[codec.subprotocol] if codec.subprotocol else None,
+            )
+            if not await client.connect():
+                counters['failed_connections'] += 1
+                return
+            counters['connections'] += 1
+            pending, uploads = {}, {}
+            reader = asyncio.ensure_future(read(client, codec, pending, uploads))
+            for t, kind, fields in connection['events']:
+                await at(t)
+                if kind == 'r':
+                    frame = fields[0]
+                    counters['frames'] += 1
+                    if frame is None:
+                        await client.send('{') # The recorded frame was invalid.
+                        continue
+                    if isinstance(frame.get('group'), int):
+                        frame = {**frame, 'group': group_map.get(frame['group'], frame['group'])}
+                    if frame.get('type') == 'subscribe':
+                        frame = {key: value for key, value in frame.items() if key != 'last_id'}
+                    elif frame.get('type') == 'upload.start':
+                        frame = {key: value for key, value in frame.items() if key != 'upload_id'}
+                    elif not frame.get('type') and frame.get('temp_id'):
+                        counters['messages'] += 1
+                        pending[frame['temp_id']] = time.perf_counter()
+                    await client.send(codec.encode(frame))
+                elif kind == 'u':
+                    temp_id, offset, size = fields
+                    for _ in range(100): # Wait up to 5s for the replayed upload.start to be answered.
+                        if temp_id in uploads:
+                            break
+                        await asyncio.sleep(0.05)
+                    if temp_id in uploads:
+                        counters['upload_chunks'] += 1
+                        await client.send(encode_chunk(uploads[temp_id], offset, bytes(size)))
+                elif kind == 'd':
+                    break
+            deadline = time.perf_counter() + ECHO_TIMEOUT
+            while pending and time.perf_counter() < deadline: # Let the last echoes arrive.
+                await asyncio.sleep(0.05)
+            counters['unanswered'] += len(pending)
+            reader.cancel()
+            await client.close()
+
+        metrics.reset()
+        await asyncio.gather(*(run(connection) for connection in recorded))
+        if write_behind_enabled():
+            await get_message_writer().flush()
+        elapsed = time.perf_counter() - started
+
+        stages = {
+            stage: {key: summary[key] for key in ('count', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms')}
+            for stage, summary in metrics.snapshot().items() if summary['count']
+        }
+        return {
+            'replay': {
+                'speed': speed,
+                'connections': counters['connections'],
+                'failed_connections': counters['failed_connections'],
+                'frames': counters['frames'],
+                'upload_chunks': counters['upload_chunks'],
+                'seconds': round(elapsed, 3),
+            },
+            'echo': {
+                'messages': counters['messages'],
+                'answered': len(latencies_ms),
+                'errors': counters['errors'],
+                'unanswered': counters['unanswered'],
+                **summarize_latencies(latencies_ms),
+            },
+            'stages': stages,
+            'queries': profile.summary(counters['messages']),
+        }
+
+    def compare(self, path, results):
+        """Prints every numeric result next to its value in the baseline file."""
+        try:
+            with open(path) as baseline_file:
+                baseline = flatten(json.load(baseline_file))
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Cannot read baseline {path}: {e}")
+        self.stdout.write(f'\nCompared with {path}:')
+        for key, value in flatten(results).items():
+            if key not in baseline:
+                continue
+            before = baseline[key]
+            change = f'{(value - before) / before * 100:+.1f}%' if before else 'n/a'
+            self.stdout.write(f'{key:<40} {before:>12} -> {value:<12} {change}')
@@ -0,0 +1,62 @@
+"""
+Management command listing chat room loads and routes, and pinning rooms to
+worker pools (see `groupchat.affinity`).
+
+Loads are the sums of the reports the live workers published to the shared
+cache. Pins take effect on every worker within
+`GROUPCHAT_AFFINITY_REPORT_INTERVAL` seconds; connected sockets then move
+over `GROUPCHAT_AFFINITY_MOVE_WINDOW` seconds.
+
+Usage:
+    python manage.py chat_rooms --limit 20
+    python manage.py chat_rooms --pin 12 hot-1
+    python manage.py chat_rooms --unpin 12
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+from groupchat.affinity import pin, pins, room_loads, route, route_event, routing_enabled, unpin
+from groupchat.consumers import room_group_name
+
+
+class Command(BaseCommand):
+    help = "Lists chat rooms by load with the worker pool serving each, and pins rooms to pools."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20, help="Rooms to list, busiest first.")
+        parser.add_argument('--pin', nargs=2, metavar=('GROUP', 'POOL'), help="Pin a group's room to a pool until unpinned.")
+        parser.add_argument('--unpin', type=int, metavar='GROUP', help="Return a group's room to its hashed pool.")
+
+    def handle(self, *args, **options):
+        if options['pin'] or options['unpin'] is not None:
+            if not routing_enabled():
+                raise CommandError("Room routing is off; set GROUPCHAT_AFFINITY_POOLS.")
+            if options['pin']:
+                group_id, pool = int(options['pin'][0]), options['pin'][1]
+                try:
+                    pin(group_id, pool)
+                except ValueError as e:
+                    raise CommandError(str(e))
+                self.stdout.write(f"Pinned group {group_id} to pool {pool}.")
+            else:
+                group_id = options['unpin']
+                if not unpin(group_id):
+                    raise CommandError(f"Group {group_id} is not pinned.")
+                self.stdout.write(f"Unpinned group {group_id}; it is served by pool {route(group_id)}.")
+            # Workers also notice at their next report; this moves the room's sockets right away.
+            async_to_sync(get_channel_layer().group_send)(room_group_name(group_id), route_event(group_id, route(group_id)))
+            return
+
+        loads = room_loads()[:options['limit']]
+        if not loads:
+            self.stdout.write("No worker reported any chat room.")
+            return
+        table = pins(load['group'] for load in loads)
+        self.stdout.write(f"{'group':>8} {'msg/s':>8} {'frames/s':>10} {'sockets':>8} {'workers':>8}  pool")
+        for load in loads:
+            pinned = table.get(load['group'])
+            note = '' if pinned is None else ' (pinned)' if pinned['expires'] is None else ' (hot)'
+            self.stdout.write(
+                f"{load['group']:>8} {load['rate']:>8} {load['deliveries']:>10} {load['sockets']:>8} {load['workers']:>8}"
+                f"  {load['pool'] or '-'}{note}"
+            )
@@ -0,0 +1,232 @@
+"""
+In-process instrumentation for the chat hot path.
+
+Each stage of a message's life (auth, membership check, DB save,
+`group_send`, per-recipient `send`, ...) feeds a fixed-bucket latency
+histogram. Histograms are per process and are exposed, with the counters
+`counters()` collects from the other chat modules, by
+`groupchat.views.chat_metrics_view` as JSON or Prometheus text.
+
+Settings:
+    GROUPCHAT_METRICS_ENABLED (bool): Master switch. Defaults to True.
+    GROUPCHAT_METRICS_SAMPLE_RATE (float): Fraction of stage timings recorded
+        (0.0-1.0). Defaults to 1.0.
+    GROUPCHAT_METRICS_STAGE_SAMPLE_RATES (dict): Per-stage overrides, e.g.
+        `{'send': 0.05}` to sample only 5% of per-recipient sends.
+    GROUPCHAT_LOG_INTERVAL (float): Minimum seconds between repeated
+        rate-limited log records with the same key. Defaults to 10.
+    GROUPCHAT_METRICS_TOKEN (str): Bearer token that, besides a staff
+        session, grants access to the metrics view. Unset by default.
+"""
+import bisect
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# Upper bounds of the histogram buckets, in milliseconds; the last bucket is +Inf.
+BUCKET_BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram:
+    """A thread-safe cumulative latency histogram with fixed millisecond buckets."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clears all observations."""
+        with self._lock:
+            self.counts = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+            self.total = 0
+            self.sum_ms = 0.0
+            self.max_ms = 0.0
+
+    def observe(self, value_ms):
+        """Records one observation, in milliseconds."""
+        with self._lock:
+            self.counts[bisect.bisect_left(BUCKET_BOUNDS_MS, value_ms)] += 1
+            self.total += 1
+            self.sum_ms += value_ms
+            if value_ms > self.max_ms:
+                self.max_ms = value_ms
+
+    def percentile(self, pct):
+        """Returns the upper bound of the bucket holding the `pct` percentile (0-100)."""
+        if not self.total:
+            return 0.0
+        rank = pct / 100 * self.total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKET_BOUNDS_MS[index] if index < len(BUCKET_BOUNDS_MS) else self.max_ms
+        return self.max_ms
+
+    def snapshot(self):
+        """Returns a JSON-ready summary of the histogram."""
+        with self._lock:
+            return {
+                'count': self.total,
+                'sum_ms': round(self.sum_ms, 3),
+                'mean_ms': round(self.sum_ms / self.total, 3) if self.total else 0.0,
+                'max_ms': round(self.max_ms, 3),
+                'p50_ms': self.percentile(50),
+                'p90_ms': self.percentile(90),
+                'p99_ms': self.percentile(99),
+                'buckets': {str(bound): count for bound, count in zip(BUCKET_BOUNDS_MS + ('+Inf',), self.counts)},
+            }
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def histogram(stage):
+    """Returns the histogram for `stage`, creating it on first use."""
+    hist = _histograms.get(stage)
+    if hist is None:
+        with _histograms_lock:
+            hist = _histograms.setdefault(stage, Histogram())
+    return hist
+
+
+def should_sample(stage):
+    """Returns True if a timing of `stage` should be recorded under the sampling settings."""
+    if not getattr(settings, 'GROUPCHAT_METRICS_ENABLED', True):
+        return False
+    rates = getattr(settings, 'GROUPCHAT_METRICS_STAGE_SAMPLE_RATES', {})
+    rate = rates.get(stage, getattr(settings, 'GROUPCHAT_METRICS_SAMPLE_RATE', 1.0))
+    return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+
+
+def observe(stage, seconds):
+    """Records a duration in seconds for `stage`, subject to sampling."""
+    if should_sample(stage):
+        histogram(stage).observe(seconds * 1000)
+
+
+@contextmanager
+def track(stage):
+    """
+    Times the enclosed block (which may contain awaits) into `stage`'s histogram.
+
+    The sampling decision is taken on entry, so unsampled blocks cost one
+    settings lookup and no clock reads.
+    """
+    if not should_sample(stage):
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram(stage).observe((time.perf_counter() - started) * 1000)
+
+
+def snapshot():
+    """Returns `{stage: histogram summary}` for every stage seen so far."""
+    return {stage: hist.snapshot() for stage, hist in sorted(_histograms.items())}
+
+
+def reset():
+    """Clears every histogram."""
+    for hist in list(_histograms.values()):
+        hist.reset()
+
+
+def counters():
+    """
+    Collects the in-process counters of every chat component, by section.
+
+    Imported here rather than at module level because those modules record
+    into this one.
+
+    Returns:
+        dict: `{section: {counter: value}}`, e.g. `counters()['admission']['shed']`.
+    """
+    from content.derivatives import stats as derivative_stats
+    from discussions.membership import membership_cache_stats
+    from .admission import stats as admission_stats
+    from .affinity import stats as affinity_stats
+    from .archive import stats as archive_stats
+    from .batching import stats as batching_stats
+    from .consumers import multiplex_stats
+    from .drain import stats as drain_stats
+    from .middleware import stats as auth_cache_stats
+    from .outbound import stats as outbound_stats
+    from .persistence import message_writer_stats
+    from .ratelimit import message_rate_limiter
+    from .unread import stats as read_marker_stats
+    return {
+        'membership_cache': membership_cache_stats(),
+        'write_behind': message_writer_stats(),
+        'rate_limit': message_rate_limiter.stats,
+        'outbound': outbound_stats,
+        'batching': batching_stats,
+        'read_marker': read_marker_stats,
+        'image_derivatives': derivative_stats,
+        'archive': archive_stats,
+        'multiplex': multiplex_stats,
+        'auth_cache': auth_cache_stats,
+        'admission': admission_stats,
+        'drain': drain_stats,
+        'affinity': affinity_stats,
+    }
+
+
+def prometheus_text(extra_gauges=None):
+    """
+    Renders the histograms (and optional `{name: value}` gauges) in the
+    Prometheus text exposition format.
+    """
+    lines = [
+        '# HELP groupchat_stage_latency_ms Latency of chat hot-path stages in milliseconds.',
+        '# TYPE groupchat_stage_latency_ms histogram',
+    ]
+    for stage, hist in sorted(_histograms.items()):
+        with hist._lock:
+            cumulative = 0
+            for bound, count in zip(BUCKET_BOUNDS_MS + ('+Inf',), hist.counts):
+                cumulative += count
+                lines.append(f'groupchat_stage_latency_ms_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'groupchat_stage_latency_ms_sum{{stage="{stage}"}} {hist.sum_ms}')
+            lines.append(f'groupchat_stage_latency_ms_count{{stage="{stage}"}} {hist.total}')
+    for name, value in sorted((extra_gauges or {}).items()):
+        lines.append(f'# TYPE groupchat_{name} gauge')
+        lines.append(f'groupchat_{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class RateLimitedLog:
+    """
+    Emits at most one record per key every `GROUPCHAT_LOG_INTERVAL` seconds and
+    reports how many were suppressed in between.
+
+    Arguments are passed through to the logger unformatted, so suppressed or
+    disabled records never build their message string.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self._last = {}
+        self._suppressed = {}
+
+    def log(self, level, key, msg, *args, **kwargs):
+        """Logs `msg % args` at `level` unless `key` was logged too recently."""
+        if not self.logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        interval = getattr(settings, 'GROUPCHAT_LOG_INTERVAL', 10.0)
+        if now - self._last.get(key, float('-inf')) < interval:
+            self._suppressed[key] = self._suppressed.get(key, 0) + 1
+            return
+        self._last[key] = now
+        suppressed = self._suppressed.pop(key, 0)
+        if suppressed:
+            msg = f'{msg} (%d similar records suppressed)'
+            args = args + (suppressed,)
+        self.logger.log(level, msg, *args, **kwargs)
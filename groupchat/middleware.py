@@ -0,0 +1,200 @@
+"""
+ASGI middleware for the chat WebSocket stack.
+
+Every handshake resolves its session and user. With channels'
+`AuthMiddlewareStack` that is a session lookup plus a user fetch through the
+thread pool, and after a worker restart every client reconnects at once.
+`CachedAuthMiddlewareStack` resolves both through Django's cache instead:
+
+    groupchat:auth:session:<HMAC of the session key>  -> (user_id, backend, session auth hash), or () if anonymous
+    groupchat:auth:user:<user_id>                     -> (the user without its password, its session auth hashes)
+
+Session keys are stored only as HMACs and users without their password hash,
+so the cache holds neither a usable session key nor a password hash; a cached
+user's `password` is a deferred field, which `save()` leaves alone.
+
+On a miss the session is read through the configured `SESSION_ENGINE`: the
+database, or the cookie itself with signed-cookie sessions. Every hit is
+still checked like `django.contrib.auth.get_user` does: the backend must be
+configured and the session auth hash must match the user's, under the
+current `SECRET_KEY` or one of `SECRET_KEY_FALLBACKS`.
+
+Entries live `GROUPCHAT_AUTH_CACHE_TIMEOUT` seconds. Logging out invalidates
+the session's entry and saving or deleting a user invalidates theirs
+(handlers in `groupchat.signals`); a password change is also caught by the
+hash check. Invalidation leaves a tombstone for `INVALIDATION_GRACE` seconds
+and misses only `add()` their result, so a handshake that read the old state
+just before the change cannot put it back. A session that expires in the
+database can authenticate handshakes for at most the timeout. Invalidation
+reaches other workers only through a shared cache (`CACHE_REDIS_URL`).
+
+Settings:
+    GROUPCHAT_AUTH_CACHE_TIMEOUT (int): Entry lifetime in seconds; 0 resolves
+        every handshake through the session store. Defaults to 60.
+    GROUPCHAT_AUTH_CACHE_ALIAS (str): Cache alias to use. Defaults to 'default'.
+"""
+import copy
+
+from channels.auth import AuthMiddleware
+from channels.db import database_sync_to_async
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model, load_backend
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from . import metrics
+
+INVALIDATED = 'invalidated' # Tombstone value; see the module docstring
+INVALIDATION_GRACE = 5 # seconds
+
+stats = {'session_hits': 0, 'session_misses': 0, 'user_hits': 0, 'user_misses': 0, 'rejected': 0}
+
+
+def _cache():
+    return caches[getattr(settings, 'GROUPCHAT_AUTH_CACHE_ALIAS', 'default')]
+
+
+def auth_cache_timeout():
+    """Returns the lifetime of cached sessions and users in seconds; 0 when caching is off."""
+    return getattr(settings, 'GROUPCHAT_AUTH_CACHE_TIMEOUT', 60)
+
+
+def session_cache_key(session_key):
+    """Returns the cache key of a session, derived from an HMAC of its key."""
+    return 'groupchat:auth:session:' + salted_hmac('groupchat.middleware.session', session_key).hexdigest()
+
+
+def user_cache_key(user_id):
+    """Returns the cache key holding a user instance."""
+    return f'groupchat:auth:user:{user_id}'
+
+
+def invalidate_session(session_key):
+    """Invalidates the cached entry of a session."""
+    if session_key:
+        _cache().set(session_cache_key(session_key), INVALIDATED, INVALIDATION_GRACE)
+
+
+def invalidate_user(user_id):
+    """Invalidates the cached instance of a user."""
+    _cache().set(user_cache_key(user_id), INVALIDATED, INVALIDATION_GRACE)
+
+
+def _read_session(session):
+    """
+    Reads a session and its user from their stores. Runs in one thread hop,
+    like channels' `get_user`.
+
+    Returns:
+        tuple: The session's entry, `(user_id, backend path, session auth hash)`
+        or () if it is not logged in, and the user, or None.
+    """
+    user_id = session.get(SESSION_KEY)
+    backend_path = session.get(BACKEND_SESSION_KEY)
+    if user_id is None or backend_path is None:
+        return (), None
+    entry = get_user_model()._meta.pk.to_python(user_id), backend_path, session.get(HASH_SESSION_KEY)
+    user = None
+    if backend_path in settings.AUTHENTICATION_BACKENDS:
+        user = load_backend(backend_path).get_user(entry[0])
+    return entry, user
+
+
+async def _store_user(user, timeout):
+    """
+    Caches a user read from their backend.
+
+    Returns:
+        tuple: The user and their session auth hashes (empty for users without them).
+    """
+    hashes = ()
+    if hasattr(user, 'get_session_auth_hash'):
+        hashes = (user.get_session_auth_hash(), *user.get_session_auth_fallback_hash())
+    stored = copy.copy(user)
+    stored.__dict__.pop('password', None) # Deferred from now on
+    await _cache().aadd(user_cache_key(user.pk), (stored, hashes), timeout)
+    return user, hashes
+
+
+async def _get_user(user_id, backend_path, timeout):
+    """Returns the user and their session auth hashes from the cache or their backend, or None if there is no such (active) user."""
+    cached = await _cache().aget(user_cache_key(user_id))
+    if cached is not None and cached != INVALIDATED:
+        stats['user_hits'] += 1
+        return cached
+    stats['user_misses'] += 1
+    user = await load_backend(backend_path).aget_user(user_id)
+    return await _store_user(user, timeout) if user is not None else None
+
+
+async def aresolve_user(session):
+    """
+    Returns the user a session is logged in as, going through the cache.
+
+    Args:
+        session (SessionBase): The handshake's session, not loaded yet.
+
+    Returns:
+        The user, or `AnonymousUser` if the session is not logged in or no longer valid.
+    """
+    session_key = session.session_key
+    if not session_key:
+        return AnonymousUser()
+    timeout = auth_cache_timeout()
+    key = session_cache_key(session_key)
+    entry = await _cache().aget(key)
+    found = None
+    if entry is None or entry == INVALIDATED:
+        stats['session_misses'] += 1
+        entry, user = await database_sync_to_async(_read_session)(session)
+        await _cache().aadd(key, entry, timeout)
+        if user is not None:
+            stats['user_misses'] += 1
+            found = await _store_user(user, timeout)
+    else:
+        stats['session_hits'] += 1
+    if not entry:
+        return AnonymousUser()
+
+    user_id, backend_path, session_hash = entry
+    if found is None and backend_path in settings.AUTHENTICATION_BACKENDS:
+        found = await _get_user(user_id, backend_path, timeout)
+    if found is None:
+        return AnonymousUser()
+    user, hashes = found
+    if hashes and not (session_hash and any(constant_time_compare(session_hash, value) for value in hashes)):
+        stats['rejected'] += 1
+        await _cache().adelete(key) # E.g. the password changed; the next HTTP request flushes the session
+        return AnonymousUser()
+    return user
+
+
+class TimedAuthMiddleware(AuthMiddleware):
+    """`AuthMiddleware` that records user resolution time under the `auth` stage."""
+
+    async def resolve_scope(self, scope):
+        with metrics.track('auth'):
+            await super().resolve_scope(scope)
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """`AuthMiddleware` resolving sessions and users through the cache (see the module docstring), timed under `auth`."""
+
+    async def resolve_scope(self, scope):
+        with metrics.track('auth'):
+            if auth_cache_timeout():
+                scope['user']._wrapped = await aresolve_user(scope['session'])
+            else:
+                await super().resolve_scope(scope)
+
+
+def TimedAuthMiddlewareStack(inner):
+    """Drop-in replacement for `channels.auth.AuthMiddlewareStack` with auth timing."""
+    return CookieMiddleware(SessionMiddleware(TimedAuthMiddleware(inner)))
+
+
+def CachedAuthMiddlewareStack(inner):
+    """`TimedAuthMiddlewareStack` with cached session and user resolution."""
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.1 on 2026-10-18 08:15
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groupchat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='groupchatmessage',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, help_text='The date and time when the message was created.'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.1 on 2026-10-18 08:20
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0003_discussiongroup_unique_group_name_per_creator'),
+        ('groupchat', '0002_groupchatmessage_timestamp_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='groupchatmessage',
+            index=models.Index(fields=['group', 'timestamp', 'id'], name='groupchat_msg_history_idx'),
+        ),
+    ]
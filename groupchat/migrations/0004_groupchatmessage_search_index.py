@@ -0,0 +1,61 @@
+# Full-text search index; see groupchat/search.py.
+#
+# The DDL is a frozen copy of what search.py applied when this migration was
+# written, so later edits there do not change what it does. Changing the index
+# needs a new migration.
+
+from django.db import migrations
+
+INDEX_SQL = {
+    'postgresql': [
+        "ALTER TABLE groupchat_groupchatmessage ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS "
+        "(to_tsvector('english'::regconfig, coalesce(text_content, ''))) STORED",
+        "CREATE INDEX IF NOT EXISTS groupchat_msg_search_idx ON groupchat_groupchatmessage USING gin (search_vector)",
+    ],
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS groupchat_message_fts USING fts5("
+        "text_content, content='groupchat_groupchatmessage', content_rowid='id', tokenize='porter unicode61')",
+        "CREATE TRIGGER IF NOT EXISTS groupchat_message_fts_ai AFTER INSERT ON groupchat_groupchatmessage BEGIN "
+        "INSERT INTO groupchat_message_fts(rowid, text_content) VALUES (new.id, new.text_content); END",
+        "CREATE TRIGGER IF NOT EXISTS groupchat_message_fts_ad AFTER DELETE ON groupchat_groupchatmessage BEGIN "
+        "INSERT INTO groupchat_message_fts(groupchat_message_fts, rowid, text_content) "
+        "VALUES ('delete', old.id, old.text_content); END",
+        "CREATE TRIGGER IF NOT EXISTS groupchat_message_fts_au AFTER UPDATE OF text_content ON groupchat_groupchatmessage BEGIN "
+        "INSERT INTO groupchat_message_fts(groupchat_message_fts, rowid, text_content) "
+        "VALUES ('delete', old.id, old.text_content); "
+        "INSERT INTO groupchat_message_fts(rowid, text_content) VALUES (new.id, new.text_content); END",
+        # Index the rows written before the table existed.
+        "INSERT INTO groupchat_message_fts(groupchat_message_fts) VALUES ('rebuild')",
+    ],
+}
+
+DROP_SQL = {
+    'postgresql': [
+        "DROP INDEX IF EXISTS groupchat_msg_search_idx",
+        "ALTER TABLE groupchat_groupchatmessage DROP COLUMN IF EXISTS search_vector",
+    ],
+    'sqlite': [
+        "DROP TRIGGER IF EXISTS groupchat_message_fts_ai",
+        "DROP TRIGGER IF EXISTS groupchat_message_fts_ad",
+        "DROP TRIGGER IF EXISTS groupchat_message_fts_au",
+        "DROP TABLE IF EXISTS groupchat_message_fts",
+    ],
+}
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []): # No index on other databases
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groupchat', '0003_groupchatmessage_history_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(run(INDEX_SQL), run(DROP_SQL)),
+    ]
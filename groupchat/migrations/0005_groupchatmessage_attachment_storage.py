@@ -0,0 +1,19 @@
+# Generated by Django 5.2.1 on 2026-10-18 09:02
+
+import groupchat.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groupchat', '0004_groupchatmessage_search_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='groupchatmessage',
+            name='file_attachment',
+            field=models.FileField(blank=True, help_text='An optional file attached to the message.', null=True, storage=groupchat.storage.attachment_storage, upload_to='group_chat_files/%Y/%m/%d/'),
+        ),
+    ]
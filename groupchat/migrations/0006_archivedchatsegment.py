@@ -0,0 +1,37 @@
+# Generated by Django 5.2.1 on 2026-10-18 09:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discussions', '0005_discussiongroup_chat_archive_days'),
+        ('groupchat', '0005_groupchatmessage_attachment_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedChatSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(help_text='First day of the month the messages were sent in.')),
+                ('first_timestamp', models.DateTimeField()),
+                ('first_message_id', models.BigIntegerField()),
+                ('last_timestamp', models.DateTimeField()),
+                ('last_message_id', models.BigIntegerField()),
+                ('min_message_id', models.BigIntegerField()),
+                ('max_message_id', models.BigIntegerField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('group', models.ForeignKey(help_text='The discussion group the messages belong to.', on_delete=django.db.models.deletion.CASCADE, related_name='chat_archive_segments', to='discussions.discussiongroup')),
+            ],
+            options={
+                'verbose_name': 'Archived Chat Segment',
+                'verbose_name_plural': 'Archived Chat Segments',
+                'indexes': [models.Index(fields=['group', 'last_timestamp', 'last_message_id'], name='groupchat_archive_last_idx'), models.Index(fields=['group', 'first_timestamp', 'first_message_id'], name='groupchat_archive_first_idx')],
+            },
+        ),
+    ]
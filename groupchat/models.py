@@ -6,7 +6,9 @@ real-time chat messages within discussion groups.
 """
 from django.conf import settings
 from django.db import models
+from django.utils import timezone
 from discussions.models import DiscussionGroup # Assuming DiscussionGroup is in discussions.models
+from .storage import attachment_storage
 
 class GroupChatMessage(models.Model):
     """
@@ -37,12 +39,14 @@ class GroupChatMessage(models.Model):
     )
     file_attachment = models.FileField(
         upload_to='group_chat_files/%Y/%m/%d/', 
+        storage=attachment_storage, # Deduplicated; see storage.py
         blank=True, 
         null=True,
         help_text="An optional file attached to the message."
     )
     timestamp = models.DateTimeField(
-        auto_now_add=True,
+        default=timezone.now,
+        editable=False, # Set on creation; explicit so write-behind batches keep the broadcast time
         help_text="The date and time when the message was created."
     )
 
@@ -61,5 +65,54 @@ class GroupChatMessage(models.Model):
 
     class Meta:
         ordering = ['timestamp'] # Order messages by when they were sent
+        indexes = [
+            # Backs keyset pagination of a group's history by (timestamp, id).
+            models.Index(fields=['group', 'timestamp', 'id'], name='groupchat_msg_history_idx'),
+        ]
         verbose_name = "Group Chat Message"
         verbose_name_plural = "Group Chat Messages"
+
+
+class ArchivedChatSegment(models.Model):
+    """
+    A compressed run of a group's old chat messages, moved out of
+    `GroupChatMessage` by `manage.py chat_archive` (see archive.py).
+
+    Attributes:
+        group (ForeignKey): The discussion group the messages belong to.
+        month (DateField): First day of the (UTC) month the messages were sent in.
+        first_timestamp, first_message_id: History position of the oldest message.
+        last_timestamp, last_message_id: History position of the newest message.
+        min_message_id, max_message_id: Range of the message IDs, for lookups by ID.
+        message_count (PositiveIntegerField): Number of messages in the segment.
+        data (BinaryField): The messages, as gzip-compressed msgpack.
+        created_at (DateTimeField): When the segment was written.
+    """
+    group = models.ForeignKey(
+        DiscussionGroup,
+        on_delete=models.CASCADE,
+        related_name='chat_archive_segments',
+        help_text="The discussion group the messages belong to."
+    )
+    month = models.DateField(help_text="First day of the month the messages were sent in.")
+    first_timestamp = models.DateTimeField()
+    first_message_id = models.BigIntegerField()
+    last_timestamp = models.DateTimeField()
+    last_message_id = models.BigIntegerField()
+    min_message_id = models.BigIntegerField()
+    max_message_id = models.BigIntegerField()
+    message_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.message_count} messages of group {self.group_id} from {self.month:%Y-%m}"
+
+    class Meta:
+        indexes = [
+            # Back read-through paging in both directions.
+            models.Index(fields=['group', 'last_timestamp', 'last_message_id'], name='groupchat_archive_last_idx'),
+            models.Index(fields=['group', 'first_timestamp', 'first_message_id'], name='groupchat_archive_first_idx'),
+        ]
+        verbose_name = "Archived Chat Segment"
+        verbose_name_plural = "Archived Chat Segments"
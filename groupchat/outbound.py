@@ -0,0 +1,130 @@
+"""
+Bounded per-connection outbound queue for chat frames.
+
+Frames pushed by the room (messages, presence) are queued here instead of
+being sent from the channel-layer handler, and a per-connection task writes
+them to the socket. When the server applies write backpressure (see
+`groupchat.server.ChatServer`) a slow client's frames accumulate here, up to
+`GROUPCHAT_OUTBOUND_QUEUE_SIZE`, and then `GROUPCHAT_OUTBOUND_POLICY` decides:
+
+    drop_oldest: discard the oldest queued frame.
+    coalesce:    replace every queued droppable frame, and the new one, with a
+                 single `messages.skipped` frame so the client resyncs.
+    disconnect:  close the connection; the client reconnects and resumes.
+
+Frames that must not be dropped (replies to the client's own requests)
+wait for space rather than overflow. If they alone fill the queue, so that
+no policy can make room, the connection is closed whatever the policy.
+"""
+import asyncio
+import logging
+from collections import deque
+
+from django.conf import settings
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ('drop_oldest', 'coalesce', 'disconnect')
+
+stats = {'queued': 0, 'sent': 0, 'dropped': 0, 'overflows': 0}
+
+
+class OutboundQueue:
+    """
+    Queues `send()` keyword arguments for one connection and writes them in order.
+
+    Args:
+        send: The consumer's `send` coroutine function.
+        skipped_frame: Callable returning the `send()` kwargs of a
+            `messages.skipped` frame for a number of skipped frames (coalesce policy).
+        maxsize (int, optional): Defaults to `GROUPCHAT_OUTBOUND_QUEUE_SIZE`.
+        policy (str, optional): Defaults to `GROUPCHAT_OUTBOUND_POLICY`.
+    """
+
+    def __init__(self, send, skipped_frame, maxsize=None, policy=None):
+        self.maxsize = maxsize or getattr(settings, 'GROUPCHAT_OUTBOUND_QUEUE_SIZE', 256)
+        self.policy = policy or getattr(settings, 'GROUPCHAT_OUTBOUND_POLICY', 'coalesce')
+        if self.policy not in POLICIES:
+            raise ValueError(f"GROUPCHAT_OUTBOUND_POLICY must be one of {POLICIES}, not {self.policy!r}.")
+        self._send = send
+        self._skipped_frame = skipped_frame
+        self._items = deque() # (kwargs, droppable, is_skipped_marker)
+        self._skipped = 0
+        self.overflowed = False # Set by the consumer once it closed the connection for overflowing
+        self._ready = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, kwargs):
+        """
+        Queues a droppable frame pushed by the room, applying the overflow policy.
+
+        Returns:
+            bool: False if the queue is full and the policy is `disconnect`,
+                or every queued frame is one that must not be dropped.
+        """
+        if len(self._items) >= self.maxsize:
+            stats['overflows'] += 1
+            if self.policy == 'disconnect':
+                return False
+            if self.policy == 'coalesce':
+                if not any(droppable or is_marker for _, droppable, is_marker in self._items):
+                    return False
+                self._coalesce()
+                return True
+            oldest = next((item for item in self._items if item[1]), None)
+            if oldest is None:
+                return False
+            self._items.remove(oldest)
+            stats['dropped'] += 1
+        self._append((kwargs, True, False))
+        return True
+
+    async def put_wait(self, kwargs):
+        """
+        Queues a frame that must not be dropped (replies to the client's own
+        requests, resume replay), waiting for space instead.
+        """
+        while len(self._items) >= self.maxsize:
+            self._space.clear()
+            await self._space.wait()
+        self._append((kwargs, False, False))
+
+    def _append(self, item):
+        self._items.append(item)
+        stats['queued'] += 1
+        self._ready.set()
+
+    def _coalesce(self):
+        kept = deque(item for item in self._items if not (item[1] or item[2]))
+        skipped = sum(1 for item in self._items if item[1]) + 1 # the incoming frame too
+        self._skipped += skipped
+        stats['dropped'] += skipped
+        self._items = kept
+        self._append((self._skipped_frame(self._skipped), False, True))
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            while self._items:
+                kwargs, _, is_marker = self._items.popleft()
+                if is_marker:
+                    self._skipped = 0
+                self._space.set()
+                try:
+                    with metrics.track('send'):
+                        await self._send(**kwargs)
+                except Exception as e:
+                    logger.debug("Outbound writer stopped: %s", e)
+                    return
+                stats['sent'] += 1
+            self._ready.clear()
+
+    def close(self):
+        """Stops the writer task; queued frames are discarded."""
+        self._task.cancel()
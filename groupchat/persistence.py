@@ -0,0 +1,259 @@
+"""
+Write-behind persistence for chat messages.
+
+When `GROUPCHAT_WRITE_BEHIND` is enabled the consumer no longer waits for an
+INSERT per message. Instead it asks the per-process `MessageWriter` for a
+message id and timestamp, broadcasts right away, and the writer coalesces the
+pending rows into `bulk_create` batches once `GROUPCHAT_WRITE_BEHIND_BATCH_SIZE`
+rows are queued or `GROUPCHAT_WRITE_BEHIND_FLUSH_INTERVAL` seconds have passed.
+
+Ids are allocated in-process (time-ordered, 41 bits of milliseconds, 6 bits
+of worker id and 6 bits of sequence) so they are known before the row exists.
+Every worker needs its own `GROUPCHAT_WORKER_ID` for them to be unique, and
+each process shares one allocator (`get_id_allocator()`) between its writers.
+While write-behind is on, messages saved outside the writer (the chat view,
+uploads, the admin) take their ids from it too (`groupchat.signals`), so the
+table's own sequence, which on SQLite continues after the largest stored id,
+never hands out an id the allocator issues later. Rows inserted without
+`save()` (raw SQL, `bulk_create` without ids) bypass this and must not be
+mixed with write-behind. The 53-bit total keeps ids exact as JavaScript
+numbers on the client.
+
+A failed batch is retried, then split into single-row inserts so only the
+rows that genuinely cannot be stored are lost; for those the sender's
+channel receives a `message.error` event carrying the original `temp_id`.
+"""
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from datetime import datetime, timezone as dt_timezone
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from . import metrics
+from .models import GroupChatMessage
+
+logger = logging.getLogger(__name__)
+
+# Custom epoch for message ids: 2025-01-01T00:00:00Z, in milliseconds.
+ID_EPOCH_MS = int(datetime(2025, 1, 1, tzinfo=dt_timezone.utc).timestamp() * 1000)
+WORKER_BITS = 6
+SEQUENCE_BITS = 6
+
+
+def write_behind_enabled():
+    """Returns True when chat messages should be persisted write-behind."""
+    return getattr(settings, 'GROUPCHAT_WRITE_BEHIND', False)
+
+
+class MessageIdAllocator:
+    """
+    Hands out unique, time-ordered 53-bit message ids without a database round trip.
+
+    Args:
+        worker_id (int): Distinguishes concurrently running processes, 0-63;
+            defaults to `GROUPCHAT_WORKER_ID`, which write-behind mode requires.
+            Without write-behind the writer only serves benchmarks and
+            `flush_buffers`, and 0 is used.
+
+    Raises:
+        ImproperlyConfigured: If write-behind is on and no worker id is set, or
+            the worker id does not fit in 6 bits.
+    """
+
+    def __init__(self, worker_id=None):
+        if worker_id is None:
+            worker_id = getattr(settings, 'GROUPCHAT_WORKER_ID', None)
+        if worker_id is None:
+            if write_behind_enabled():
+                raise ImproperlyConfigured("GROUPCHAT_WRITE_BEHIND requires a distinct GROUPCHAT_WORKER_ID per worker.")
+            worker_id = 0
+        if not 0 <= worker_id < 1 << WORKER_BITS:
+            raise ImproperlyConfigured(f"GROUPCHAT_WORKER_ID must be between 0 and {(1 << WORKER_BITS) - 1}, not {worker_id}.")
+        self.worker_id = worker_id
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        """Returns the next id, waiting for the next millisecond if the sequence is exhausted."""
+        with self._lock:
+            now_ms = int(time.time() * 1000)
+            if now_ms < self._last_ms:
+                now_ms = self._last_ms # Clock moved backwards: stay on the last millisecond.
+            if now_ms == self._last_ms:
+                self._sequence = (self._sequence + 1) & ((1 << SEQUENCE_BITS) - 1)
+                if self._sequence == 0:
+                    while now_ms <= self._last_ms:
+                        now_ms = int(time.time() * 1000)
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+            return ((now_ms - ID_EPOCH_MS) << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+
+_allocators = {} # GROUPCHAT_WORKER_ID -> this process's allocator
+_allocators_lock = threading.Lock()
+
+
+def get_id_allocator():
+    """
+    Returns this process's `MessageIdAllocator` for `GROUPCHAT_WORKER_ID`.
+    Everything allocating ids in the process shares it, so no two hand out
+    the same id.
+    """
+    worker_id = getattr(settings, 'GROUPCHAT_WORKER_ID', None)
+    if worker_id is None:
+        return MessageIdAllocator() # Refused under write-behind; otherwise its ids only serve benchmarks
+    with _allocators_lock:
+        allocator = _allocators.get(worker_id)
+        if allocator is None:
+            allocator = _allocators[worker_id] = MessageIdAllocator(worker_id)
+        return allocator
+
+
+class MessageWriter:
+    """
+    Buffers chat messages and persists them in `bulk_create` batches.
+
+    One writer exists per event loop (i.e. per daphne process); use
+    `get_message_writer()` rather than instantiating it directly outside of
+    benchmarks.
+
+    Args:
+        batch_size (int): Flush as soon as this many rows are pending.
+        flush_interval (float): Flush pending rows at least this often, in seconds.
+        max_retries (int): Whole-batch retries before falling back to row-by-row inserts.
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None, max_retries=None):
+        self.batch_size = batch_size or getattr(settings, 'GROUPCHAT_WRITE_BEHIND_BATCH_SIZE', 64)
+        self.flush_interval = flush_interval or getattr(settings, 'GROUPCHAT_WRITE_BEHIND_FLUSH_INTERVAL', 0.05)
+        self.max_retries = max_retries if max_retries is not None else getattr(settings, 'GROUPCHAT_WRITE_BEHIND_RETRIES', 2)
+        self.allocator = get_id_allocator()
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._flusher = None
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.stats = {'enqueued': 0, 'persisted': 0, 'failed': 0, 'batches': 0}
+
+    def enqueue(self, user_id, group_id, text_content, temp_id=None, reply_channel=None):
+        """
+        Queues a message for persistence and returns it with its id and timestamp set.
+
+        Args:
+            user_id (int): ID of the sender.
+            group_id (int or str): ID of the discussion group.
+            text_content (str): The message text.
+            temp_id (str, optional): The client's temporary id, echoed back on failure.
+            reply_channel (str, optional): Channel name that receives `message.error` on failure.
+
+        Returns:
+            GroupChatMessage: The not-yet-saved message instance.
+        """
+        message = GroupChatMessage(
+            id=self.allocator.next_id(),
+            user_id=user_id,
+            group_id=int(group_id),
+            text_content=text_content,
+            timestamp=timezone.now(),
+        )
+        self._pending.append((message, temp_id, reply_channel))
+        self.stats['enqueued'] += 1
+        self._idle.clear()
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._run())
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+        return message
+
+    @property
+    def pending_count(self):
+        """Number of messages queued or currently being written."""
+        return len(self._pending) + self._in_flight
+
+    async def flush(self):
+        """Waits until every message queued so far has been written (or failed)."""
+        if self._pending:
+            self._wakeup.set()
+        await self._idle.wait()
+
+    async def _run(self):
+        while self._pending:
+            if len(self._pending) < self.batch_size:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+            self._in_flight = len(batch)
+            try:
+                await self._write(batch)
+            finally:
+                self._in_flight = 0
+        self._idle.set()
+
+    async def _write(self, batch):
+        messages = [message for message, _, _ in batch]
+        for attempt in range(self.max_retries + 1):
+            try:
+                with metrics.track('db_batch'):
+                    await GroupChatMessage.objects.abulk_create(messages)
+                self.stats['batches'] += 1
+                self.stats['persisted'] += len(batch)
+                return
+            except Exception as e:
+                logger.warning("Write-behind batch of %s failed (attempt %s): %s", len(batch), attempt + 1, e)
+                await asyncio.sleep(min(0.05 * 2 ** attempt, 1.0))
+
+        # The batch keeps failing: isolate the rows that cannot be stored.
+        for message, temp_id, reply_channel in batch:
+            try:
+                await GroupChatMessage.objects.abulk_create([message])
+                self.stats['persisted'] += 1
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.error("Write-behind could not persist message %s in group %s: %s", message.id, message.group_id, e)
+                await self._report_failure(message.group_id, temp_id, reply_channel)
+
+    async def _report_failure(self, group_id, temp_id, reply_channel):
+        if not (temp_id and reply_channel):
+            return
+        try:
+            await get_channel_layer().send(reply_channel, {
+                'type': 'message.error',
+                'group_id': group_id,
+                'temp_id': temp_id,
+                'error': 'Message could not be saved due to a server issue.',
+            })
+        except Exception as e:
+            logger.error("Write-behind could not report failure for temp_id %s: %s", temp_id, e)
+
+
+_writers = weakref.WeakKeyDictionary()
+
+
+def get_message_writer():
+    """Returns the `MessageWriter` bound to the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    writer = _writers.get(loop)
+    if writer is None:
+        writer = _writers[loop] = MessageWriter()
+    return writer
+
+
+def message_writer_stats():
+    """Returns the counters of every writer in this process, summed, plus the pending count."""
+    totals = {'enqueued': 0, 'persisted': 0, 'failed': 0, 'batches': 0, 'pending': 0}
+    for writer in list(_writers.values()):
+        for key, value in writer.stats.items():
+            totals[key] += value
+        totals['pending'] += writer.pending_count
+    return totals
@@ -0,0 +1,240 @@
+"""
+Online presence and typing indicators for chat rooms.
+
+Every connection joins the per-process `PresenceHub`, which keeps the local
+connections of each room and, once per `GROUPCHAT_PRESENCE_TICK`, merges
+what changed into a single `presence.delta` broadcast per room:
+
+    {'type': 'presence', 'group': group_id, 'online': [{'user_id', 'user_full_name'}, ...],
+     'offline': [user_id, ...], 'typing': [user_id, ...]}
+
+so a room receives at most one presence frame per tick however many members
+join, leave or type. Typing is throttled per user to one entry every
+`GROUPCHAT_TYPING_INTERVAL` seconds; clients show the indicator for a little
+longer than that and clear it when the user's message arrives.
+
+The room roster shared between workers lives in Django's cache as
+`{channel_name: [user_id, user_full_name, last_seen]}`. Each hub refreshes
+its own entries at least every third of `GROUPCHAT_PRESENCE_TIMEOUT`, and
+entries older than the timeout (a dead worker, a connection that stopped
+sending heartbeats) are dropped and reported offline by whichever worker
+syncs the room next. The roster is read-modify-written without locking, so
+presence is eventually consistent: a lost update heals on the next refresh.
+
+Settings:
+    GROUPCHAT_PRESENCE_TICK (float): Seconds between presence broadcasts. Defaults to 1.0.
+    GROUPCHAT_PRESENCE_TIMEOUT (float): Seconds without a heartbeat before a
+        connection counts as gone. Defaults to 60.
+    GROUPCHAT_PRESENCE_HEARTBEAT (float): Heartbeat interval asked of clients. Defaults to 25.
+    GROUPCHAT_TYPING_INTERVAL (float): Minimum seconds between typing entries per user. Defaults to 3.
+    GROUPCHAT_PRESENCE_CACHE_ALIAS (str): Cache holding the rosters. Defaults to 'default'.
+"""
+import asyncio
+import logging
+import time
+import weakref
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import caches
+from . import metrics
+from .wire import encode_for_broadcast
+
+logger = logging.getLogger(__name__)
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def roster_cache_key(group_id):
+    """Returns the cache key holding a room's shared roster."""
+    return f'groupchat:presence:{group_id}'
+
+
+def _online(roster):
+    """Returns `{user_id: user_full_name}` for the entries of a roster."""
+    return {user_id: name for user_id, name, _ in roster.values()}
+
+
+class _Room:
+    """The connections one process holds in a room and what changed since the last tick."""
+
+    def __init__(self):
+        self.connections = {} # channel_name -> [user_id, user_full_name, last_seen]
+        self.removed = set()
+        self.typing = set()
+        self.last_typing = {} # user_id -> time of the last typing entry
+        self.dirty = True
+        self.last_sync = 0.0
+
+
+class PresenceHub:
+    """
+    Tracks the connections of this process per room and broadcasts merged
+    presence deltas once per tick. Bound to one event loop; use
+    `get_presence_hub()`.
+    """
+
+    def __init__(self, tick=None, timeout=None, typing_interval=None, channel_layer=None):
+        self.tick = tick if tick is not None else _setting('GROUPCHAT_PRESENCE_TICK', 1.0)
+        self.timeout = timeout if timeout is not None else _setting('GROUPCHAT_PRESENCE_TIMEOUT', 60.0)
+        self.typing_interval = (
+            typing_interval if typing_interval is not None else _setting('GROUPCHAT_TYPING_INTERVAL', 3.0)
+        )
+        self.channel_layer = channel_layer or get_channel_layer()
+        self.rooms = {}
+        self.stats = {'ticks': 0, 'broadcasts': 0, 'typing_events': 0, 'typing_broadcast': 0}
+        self._task = None
+
+    @property
+    def cache(self):
+        return caches[_setting('GROUPCHAT_PRESENCE_CACHE_ALIAS', 'default')]
+
+    def join(self, group_id, channel_name, user_id, user_full_name):
+        """Registers a connection; it is announced on the next tick."""
+        room = self.rooms.setdefault(group_id, _Room())
+        room.connections[channel_name] = [user_id, user_full_name, time.time()]
+        room.removed.discard(channel_name)
+        room.dirty = True
+        self._ensure_running()
+
+    def leave(self, group_id, channel_name):
+        """Unregisters a connection; its user goes offline on the next tick unless still connected elsewhere."""
+        room = self.rooms.get(group_id)
+        if room and room.connections.pop(channel_name, None):
+            room.removed.add(channel_name)
+            room.dirty = True
+
+    def touch(self, group_id, channel_name):
+        """Records a heartbeat (any frame) from a connection. Never triggers a broadcast by itself."""
+        room = self.rooms.get(group_id)
+        connection = room.connections.get(channel_name) if room else None
+        if connection:
+            connection[2] = time.time()
+
+    def typing(self, group_id, user_id):
+        """
+        Records a typing event. Only the first event per user every
+        `typing_interval` seconds reaches the next broadcast.
+        """
+        self.stats['typing_events'] += 1
+        room = self.rooms.get(group_id)
+        if room is None:
+            return
+        now = time.monotonic()
+        if now - room.last_typing.get(user_id, float('-inf')) < self.typing_interval:
+            return
+        room.last_typing[user_id] = now
+        room.typing.add(user_id)
+        room.dirty = True
+
+    async def snapshot(self, group_id):
+        """
+        Returns the `presence` frame a newly connected client starts from:
+        everyone currently online in the room (per the shared roster plus this
+        process's connections) and the heartbeat interval it should keep.
+        """
+        roster = await self.cache.aget(roster_cache_key(group_id)) or {}
+        room = self.rooms.get(group_id)
+        if room:
+            for channel_name in room.removed:
+                roster.pop(channel_name, None)
+            roster.update(room.connections)
+        online = _online(self._fresh(roster))
+        return {
+            'type': 'presence',
+            'group': group_id,
+            'snapshot': True,
+            'online': [{'user_id': user_id, 'user_full_name': name} for user_id, name in online.items()],
+            'heartbeat': _setting('GROUPCHAT_PRESENCE_HEARTBEAT', 25),
+        }
+
+    def _fresh(self, roster):
+        cutoff = time.time() - self.timeout
+        return {channel: entry for channel, entry in roster.items() if entry[2] >= cutoff}
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while self.rooms:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Presence tick failed: %s", e, exc_info=True)
+
+    async def flush(self):
+        """Syncs every room that changed (or is due for a roster refresh) and broadcasts its delta."""
+        self.stats['ticks'] += 1
+        now = time.time()
+        refresh_every = self.timeout / 3
+        for group_id, room in list(self.rooms.items()):
+            self._expire_local(room, now)
+            if room.dirty or now - room.last_sync >= refresh_every:
+                with metrics.track('presence_sync'):
+                    await self._sync(group_id, room, now)
+            if not room.connections and not room.removed:
+                del self.rooms[group_id]
+
+    def _expire_local(self, room, now):
+        """Drops local connections that stopped sending heartbeats and asks them to close."""
+        cutoff = now - self.timeout
+        for channel_name, (_, _, last_seen) in list(room.connections.items()):
+            if last_seen < cutoff:
+                del room.connections[channel_name]
+                room.removed.add(channel_name)
+                room.dirty = True
+                asyncio.get_running_loop().create_task(
+                    self.channel_layer.send(channel_name, {'type': 'presence.expired'})
+                )
+
+    async def _sync(self, group_id, room, now):
+        key = roster_cache_key(group_id)
+        roster = await self.cache.aget(key) or {}
+        before = _online(roster)
+        for channel_name in room.removed:
+            roster.pop(channel_name, None)
+        roster.update({channel: list(entry) for channel, entry in room.connections.items()})
+        roster = self._fresh(roster)
+        await self.cache.aset(key, roster, int(self.timeout * 2))
+        after = _online(roster)
+
+        joined = {user_id: name for user_id, name in after.items() if user_id not in before}
+        left = [user_id for user_id in before if user_id not in after]
+        typing = [user_id for user_id in room.typing if user_id in after]
+        room.removed.clear()
+        room.typing.clear()
+        room.dirty = False
+        room.last_sync = now
+        if not (joined or left or typing):
+            return
+
+        frame = {
+            'type': 'presence',
+            'group': group_id,
+            'online': [{'user_id': user_id, 'user_full_name': name} for user_id, name in joined.items()],
+            'offline': left,
+            'typing': typing,
+        }
+        self.stats['broadcasts'] += 1
+        self.stats['typing_broadcast'] += len(typing)
+        await self.channel_layer.group_send(f'chat_{group_id}', {
+            'type': 'presence.delta',
+            'group_id': group_id,
+            'encoded': encode_for_broadcast(frame),
+        })
+
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def get_presence_hub():
+    """Returns the `PresenceHub` bound to the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = PresenceHub()
+    return hub
@@ -0,0 +1,108 @@
+"""
+Token-bucket rate limits for chat messages.
+
+Every message (and upload) a client sends takes one token from the sender's
+bucket and one from the room's. Buckets refill continuously at the
+configured rate up to their burst size. Buckets live in process memory, so
+with several workers the effective room limit is the per-worker limit times
+the number of workers the room's members are connected to.
+
+Settings:
+    GROUPCHAT_USER_MESSAGE_RATE (float): Sustained messages/sec per user. Defaults to 5.
+    GROUPCHAT_USER_MESSAGE_BURST (int): Messages a user may send back to back. Defaults to 10.
+    GROUPCHAT_ROOM_MESSAGE_RATE (float): Sustained messages/sec per room. Defaults to 50.
+    GROUPCHAT_ROOM_MESSAGE_BURST (int): Burst size per room. Defaults to 100.
+
+A rate of 0 disables that limit.
+"""
+import time
+
+from django.conf import settings
+
+
+class TokenBucket:
+    """A token bucket holding up to `burst` tokens, refilled at `rate` tokens per second."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def retry_after(self, now=None):
+        """Seconds until one token is available (0 if one is available now)."""
+        self._refill(now or time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Removes one token; only call after `retry_after()` returned 0."""
+        self.tokens -= 1
+
+    def is_full(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class MessageRateLimiter:
+    """Per-user and per-room token buckets for one process."""
+
+    PRUNE_EVERY = 1000 # checks between sweeps of idle (full) buckets
+
+    def __init__(self):
+        self.users = {}
+        self.rooms = {}
+        self.stats = {'allowed': 0, 'rejected_user': 0, 'rejected_room': 0}
+        self._checks = 0
+
+    def _bucket(self, buckets, key, rate_setting, rate_default, burst_setting, burst_default):
+        rate = getattr(settings, rate_setting, rate_default)
+        if rate <= 0:
+            return None
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, getattr(settings, burst_setting, burst_default))
+        return bucket
+
+    def check(self, user_id, group_id):
+        """
+        Takes a token from the user's and the room's bucket if both have one.
+
+        Returns:
+            tuple: `(scope, retry_after)`; `scope` is None when the message is
+                   allowed, otherwise 'user' or 'room', with the seconds to
+                   wait before retrying.
+        """
+        self._checks += 1
+        if self._checks % self.PRUNE_EVERY == 0:
+            self.prune()
+        now = time.monotonic()
+        user = self._bucket(self.users, user_id, 'GROUPCHAT_USER_MESSAGE_RATE', 5.0, 'GROUPCHAT_USER_MESSAGE_BURST', 10)
+        room = self._bucket(self.rooms, str(group_id), 'GROUPCHAT_ROOM_MESSAGE_RATE', 50.0, 'GROUPCHAT_ROOM_MESSAGE_BURST', 100)
+        wait = user.retry_after(now) if user else 0.0
+        if wait:
+            self.stats['rejected_user'] += 1
+            return 'user', wait
+        wait = room.retry_after(now) if room else 0.0
+        if wait:
+            self.stats['rejected_room'] += 1
+            return 'room', wait
+        for bucket in (user, room):
+            if bucket:
+                bucket.take()
+        self.stats['allowed'] += 1
+        return None, 0.0
+
+    def prune(self):
+        """Forgets buckets that have refilled completely; they behave exactly like new ones."""
+        now = time.monotonic()
+        for buckets in (self.users, self.rooms):
+            for key in [key for key, bucket in buckets.items() if bucket.is_full(now)]:
+                del buckets[key]
+
+
+message_rate_limiter = MessageRateLimiter()
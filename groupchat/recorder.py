@@ -0,0 +1,198 @@
+"""
+Opt-in capture of chat WebSocket traffic for deterministic replay.
+
+With `GROUPCHAT_RECORD_DIR` set, each process appends the connect, receive and
+disconnect events of (a `GROUPCHAT_RECORD_SAMPLE_RATE` fraction of) its chat
+connections to `chat-<pid>-<start>.msgpack.gz` in that directory. The log is a
+gzip stream of msgpack records; the first is a header map, every other one an
+array starting with its kind, its time in milliseconds since the header's
+`started_at`, and a connection number local to the log:
+
+    ['c', t, conn, group_id, user_id, codec_name, query_string]   connect
+    ['r', t, conn, frame]                                          received frame (decoded; None if invalid)
+    ['u', t, conn, temp_id, offset, size]                          upload chunk
+    ['d', t, conn, close_code]                                     disconnect
+
+`group_id` is None for a multiplexed connection (`ws/chat/`), whose frames
+name their group in 'group' instead. Frames are stored decoded, so a log
+replays with either codec. With
+`GROUPCHAT_RECORD_REDACT` (the default) message texts and file names are
+replaced by placeholders of the same length, and chunk data is never stored,
+so logs keep the shape of the traffic but not its content.
+
+Records are buffered in memory and written from a worker thread every
+`GROUPCHAT_RECORD_FLUSH_INTERVAL` seconds, each write appending one gzip
+member. `python manage.py chat_replay` feeds logs back into a local ASGI
+instance.
+
+Settings:
+    GROUPCHAT_RECORD_DIR (str): Directory for traffic logs; recording is off when unset.
+    GROUPCHAT_RECORD_SAMPLE_RATE (float): Fraction of connections recorded. Defaults to 1.0.
+    GROUPCHAT_RECORD_REDACT (bool): Replace message texts with placeholders. Defaults to True.
+    GROUPCHAT_RECORD_FLUSH_INTERVAL (float): Seconds between writes. Defaults to 1.0.
+"""
+import asyncio
+import gzip
+import logging
+import os
+import random
+import time
+import weakref
+from datetime import datetime, timezone
+
+import msgpack
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .uploads import UploadError, decode_chunk, is_chunk_frame
+
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = 'groupchat-traffic'
+LOG_VERSION = 2 # 2: connect records of multiplexed connections have no group
+
+
+def redact_frame(frame):
+    """Returns `frame` with its message text and file name replaced by placeholders of the same length."""
+    if isinstance(frame.get('message'), str):
+        frame = {**frame, 'message': 'x' * len(frame['message'])}
+    if isinstance(frame.get('file_name'), str):
+        stem, extension = os.path.splitext(frame['file_name'])
+        frame = {**frame, 'file_name': 'x' * len(stem) + extension}
+    return frame
+
+
+def read_log(path):
+    """
+    Yields the records of a traffic log, the header map first.
+
+    Raises:
+        ValueError: If the file is not a traffic log.
+    """
+    with gzip.open(path, 'rb') as log:
+        records = msgpack.Unpacker(log, raw=False)
+        header = next(records, None)
+        if not isinstance(header, dict) or header.get('format') != LOG_FORMAT:
+            raise ValueError(f"{path} is not a chat traffic log.")
+        yield header
+        yield from records
+
+
+class Recording:
+    """Records the events of one connection; created by `TrafficRecorder.open`."""
+
+    def __init__(self, recorder, conn, consumer):
+        self.recorder = recorder
+        self.conn = conn
+        self.consumer = consumer
+
+    def receive(self, text_data=None, bytes_data=None):
+        """Records a frame received from the client."""
+        if is_chunk_frame(bytes_data):
+            try:
+                upload_id, offset, data = decode_chunk(bytes_data)
+            except UploadError:
+                return
+            upload = self.consumer.uploads.get(upload_id)
+            self.recorder.append('u', self.conn, upload.temp_id if upload else None, offset, len(data))
+            return
+        try:
+            frame = self.consumer.codec.decode(text_data, bytes_data)
+        except ValueError:
+            frame = None
+        if not isinstance(frame, dict):
+            frame = None # Rejected by the consumer like an undecodable frame
+        if frame is not None and self.recorder.redact:
+            frame = redact_frame(frame)
+        self.recorder.append('r', self.conn, frame)
+
+    def disconnect(self, close_code):
+        """Records the end of the connection."""
+        self.recorder.append('d', self.conn, close_code)
+        self.recorder.open_recordings -= 1
+        if not self.recorder.open_recordings:
+            self.recorder.flush_soon() # Traffic stopped; don't leave the tail of the log in memory.
+
+
+class TrafficRecorder:
+    """
+    Buffers the records of this process's recorded connections and appends
+    them to its log. Bound to one event loop; use `get_traffic_recorder()`.
+    """
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        started = datetime.now(timezone.utc)
+        self.path = os.path.join(directory, f'chat-{os.getpid()}-{started:%Y%m%dT%H%M%S}.msgpack.gz')
+        self.sample_rate = getattr(settings, 'GROUPCHAT_RECORD_SAMPLE_RATE', 1.0)
+        self.redact = getattr(settings, 'GROUPCHAT_RECORD_REDACT', True)
+        self.flush_interval = getattr(settings, 'GROUPCHAT_RECORD_FLUSH_INTERVAL', 1.0)
+        self.started = time.monotonic()
+        self.records = [{
+            'format': LOG_FORMAT, 'version': LOG_VERSION, 'started_at': started.isoformat(), 'redacted': self.redact,
+        }]
+        self._connections = 0
+        self.open_recordings = 0
+        self._task = None
+        self._flushing = None
+
+    def open(self, consumer):
+        """
+        Starts recording an accepted connection, subject to the sample rate.
+
+        Returns:
+            Recording or None: The connection's recording, if it is sampled.
+        """
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return None
+        self._connections += 1
+        self.open_recordings += 1
+        self.append(
+            'c', self._connections, None if consumer.group_id is None else int(consumer.group_id),
+            consumer.user.id, consumer.codec.name,
+            consumer.scope.get('query_string', b'').decode(),
+        )
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return Recording(self, self._connections, consumer)
+
+    def append(self, kind, conn, *fields):
+        """Buffers one record stamped with the current relative time."""
+        self.records.append([kind, round((time.monotonic() - self.started) * 1000, 3), conn, *fields])
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Could not write traffic log %s: %s", self.path, e)
+
+    def flush_soon(self):
+        """Writes the buffered records now instead of at the next interval."""
+        self._flushing = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self):
+        """Appends the buffered records to the log as one gzip member."""
+        records, self.records = self.records, []
+        if records:
+            await sync_to_async(self._write, thread_sensitive=False)(records)
+
+    def _write(self, records):
+        packer = msgpack.Packer(use_bin_type=True)
+        with gzip.open(self.path, 'ab') as log:
+            log.write(b''.join(packer.pack(record) for record in records))
+
+
+_recorders = weakref.WeakKeyDictionary()
+
+
+def get_traffic_recorder():
+    """Returns the `TrafficRecorder` bound to the running event loop, or None when recording is off."""
+    directory = getattr(settings, 'GROUPCHAT_RECORD_DIR', None)
+    if not directory:
+        return None
+    loop = asyncio.get_running_loop()
+    recorder = _recorders.get(loop)
+    if recorder is None:
+        recorder = _recorders[loop] = TrafficRecorder(directory)
+    return recorder
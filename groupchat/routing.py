@@ -4,4 +4,5 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<group_id>\d+)/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/chat/$', consumers.MultiplexChatConsumer.as_asgi()),
 ] 
\ No newline at end of file
@@ -0,0 +1,231 @@
+"""
+Per-group full-text search over chat history.
+
+The index lives in the database and is maintained by it, so every write path
+(the consumer's `acreate`, write-behind `bulk_create`, finished uploads, the
+admin) updates it incrementally without application code:
+
+*   PostgreSQL: a stored generated `search_vector` tsvector column on the
+    messages table, computed from `text_content` with the `english`
+    configuration, with a GIN index. Changing `TEXT_SEARCH_CONFIG` needs a
+    migration that recreates the column.
+*   SQLite (local development): an external-content FTS5 table,
+    `groupchat_message_fts`, kept in sync by insert, update and delete
+    triggers.
+
+Migration 0004 applies a frozen copy of this DDL, so changing it here needs a
+new migration. Django rebuilds a SQLite table to alter it, which drops its
+triggers, so `ensure_search_index` also runs after every `migrate` (see
+`apps.py`) and recreates whatever is missing.
+
+Results are ranked (`ts_rank_cd` on PostgreSQL, BM25 on SQLite; higher is
+better) and paged by opaque cursors encoding the last result's `(rank, id)`,
+so a page is a bounded scan rather than an OFFSET. Snippets are HTML-escaped
+with the matched terms wrapped in `<mark>`.
+
+Only the hot table is indexed. Messages moved to the archive
+(`groupchat.archive`) are not searched; `archive.archived_until` gives the
+time up to which a group's history is archived.
+"""
+import base64
+import binascii
+import html
+import re
+
+from django.db import connection as default_connection
+from .history import page_size, serialize_message
+from .models import GroupChatMessage
+
+MESSAGE_TABLE = GroupChatMessage._meta.db_table
+FTS_TABLE = 'groupchat_message_fts'
+TEXT_SEARCH_CONFIG = 'english'
+SEARCH_MIGRATION = ('groupchat', '0004_groupchatmessage_search_index')
+
+# Markers placed around matches by the database; the snippet is escaped before they become <mark> tags.
+MATCH_START, MATCH_END = '\x02', '\x03'
+
+POSTGRES_INDEX_SQL = [
+    f"ALTER TABLE {MESSAGE_TABLE} ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS "
+    f"(to_tsvector('{TEXT_SEARCH_CONFIG}'::regconfig, coalesce(text_content, ''))) STORED",
+    f"CREATE INDEX IF NOT EXISTS groupchat_msg_search_idx ON {MESSAGE_TABLE} USING gin (search_vector)",
+]
+POSTGRES_DROP_SQL = [
+    "DROP INDEX IF EXISTS groupchat_msg_search_idx",
+    f"ALTER TABLE {MESSAGE_TABLE} DROP COLUMN IF EXISTS search_vector",
+]
+
+SQLITE_INDEX_SQL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+    f"text_content, content='{MESSAGE_TABLE}', content_rowid='id', tokenize='porter unicode61')",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON {MESSAGE_TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, text_content) VALUES (new.id, new.text_content); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON {MESSAGE_TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text_content) VALUES ('delete', old.id, old.text_content); END",
+    f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF text_content ON {MESSAGE_TABLE} BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text_content) VALUES ('delete', old.id, old.text_content); "
+    f"INSERT INTO {FTS_TABLE}(rowid, text_content) VALUES (new.id, new.text_content); END",
+]
+SQLITE_DROP_SQL = [
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ai",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ad",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_au",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+
+SEARCH_SQL = {
+    # The page is picked first so ts_headline only runs on the rows returned.
+    'postgresql': f"""
+        SELECT page.id, page.rank, ts_headline(%(config)s::regconfig, coalesce(m.text_content, ''), page.query,
+                                               %(headline)s)
+        FROM (
+            SELECT id, rank, query FROM (
+                SELECT m.id, ts_rank_cd(m.search_vector, q.query) AS rank, q.query
+                FROM {MESSAGE_TABLE} m, websearch_to_tsquery(%(config)s::regconfig, %(query)s) q(query)
+                WHERE m.group_id = %(group_id)s AND m.search_vector @@ q.query
+            ) hits
+            {{after}}
+            ORDER BY rank DESC, id DESC
+            LIMIT %(limit)s
+        ) page
+        JOIN {MESSAGE_TABLE} m ON m.id = page.id
+        ORDER BY page.rank DESC, page.id DESC
+    """,
+    'sqlite': f"""
+        SELECT id, rank, NULL FROM (
+            SELECT m.id AS id, -bm25({FTS_TABLE}) AS rank
+            FROM {FTS_TABLE} JOIN {MESSAGE_TABLE} m ON m.id = {FTS_TABLE}.rowid
+            WHERE {FTS_TABLE} MATCH %(query)s AND m.group_id = %(group_id)s
+        ) hits
+        {{after}}
+        ORDER BY rank DESC, id DESC
+        LIMIT %(limit)s
+    """,
+}
+AFTER_SQL = "WHERE rank < %(after_rank)s OR (rank = %(after_rank)s AND id < %(after_id)s)"
+# FTS5 snippets are fetched for the returned page only.
+SQLITE_SNIPPET_SQL = (
+    f"SELECT rowid, snippet({FTS_TABLE}, 0, %s, %s, '…', 16) FROM {FTS_TABLE} "
+    f"WHERE {FTS_TABLE} MATCH %s AND rowid IN ({{ids}})"
+)
+
+
+class InvalidSearch(ValueError):
+    """Raised when a search query or cursor cannot be used."""
+
+
+class SearchUnavailable(Exception):
+    """Raised when the database has no full-text search backend here."""
+
+
+def ensure_search_index(connection, drop=False):
+    """
+    Creates (or with `drop`, removes) the full-text index on `connection`.
+    Idempotent; a no-op on databases without a backend.
+    """
+    statements = {
+        'postgresql': POSTGRES_DROP_SQL if drop else POSTGRES_INDEX_SQL,
+        'sqlite': SQLITE_DROP_SQL if drop else SQLITE_INDEX_SQL,
+    }.get(connection.vendor, [])
+    with connection.cursor() as cursor:
+        missing = connection.vendor == 'sqlite' and not drop and FTS_TABLE not in connection.introspection.table_names(cursor)
+        for statement in statements:
+            cursor.execute(statement)
+        if missing:
+            # Index the rows written before the table existed.
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def encode_cursor(rank, message_id):
+    """Returns the opaque cursor pointing after the result `(rank, message_id)`."""
+    return base64.urlsafe_b64encode(f'{rank!r}|{message_id}'.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor produced by `encode_cursor`.
+
+    Returns:
+        tuple: `(rank, id)`.
+
+    Raises:
+        InvalidSearch: If the cursor is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        rank, message_id = raw.split('|')
+        return float(rank), int(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise InvalidSearch(f"Invalid search cursor: {cursor!r}") from e
+
+
+def fts5_query(query):
+    """
+    Turns free text into an FTS5 query matching messages that contain every
+    word, so FTS5 operators and syntax errors in user input have no effect.
+    """
+    return ' '.join(f'"{word}"' for word in re.findall(r'\w+', query))
+
+
+def mark_snippet(snippet):
+    """HTML-escapes a snippet and turns the match markers into `<mark>` tags."""
+    return html.escape(snippet).replace(MATCH_START, '<mark>').replace(MATCH_END, '</mark>')
+
+
+def search_messages(group_id, query, cursor=None, limit=None, connection=None):
+    """
+    Searches the text of a group's messages.
+
+    Args:
+        group_id (int): ID of the discussion group.
+        query (str): Free text; PostgreSQL also understands web-search syntax
+                     (quotes, `or`, `-word`).
+        cursor (str, optional): `next_cursor` of the previous page.
+        limit (int, optional): Page size; clamped by `history.page_size()`.
+        connection (optional): Database connection; defaults to 'default'.
+
+    Returns:
+        tuple: `(results, next_cursor)`. Each result is the message as
+               `serialize_message` returns it, plus 'rank' and 'snippet'; best
+               match first. `next_cursor` is None on the last page.
+
+    Raises:
+        InvalidSearch: If the query has no searchable words or the cursor is malformed.
+        SearchUnavailable: If the database has no full-text search backend.
+    """
+    connection = connection or default_connection
+    sql = SEARCH_SQL.get(connection.vendor)
+    if sql is None:
+        raise SearchUnavailable(f"Full-text chat search is not available on {connection.vendor}.")
+    query = (query or '').strip()
+    if connection.vendor == 'sqlite':
+        query = fts5_query(query)
+    if not query:
+        raise InvalidSearch("The search query has no words.")
+    after_rank, after_id = decode_cursor(cursor) if cursor else (None, None)
+    limit = page_size(limit)
+
+    params = {
+        'group_id': group_id, 'query': query, 'after_rank': after_rank, 'after_id': after_id, 'limit': limit + 1,
+        'config': TEXT_SEARCH_CONFIG,
+        'headline': f'StartSel="{MATCH_START}", StopSel="{MATCH_END}", MaxFragments=2, MaxWords=20, MinWords=8',
+    }
+    with connection.cursor() as db_cursor:
+        db_cursor.execute(sql.format(after=AFTER_SQL if cursor else ''), params)
+        rows = db_cursor.fetchall()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if rows and connection.vendor == 'sqlite':
+            db_cursor.execute(
+                SQLITE_SNIPPET_SQL.format(ids=', '.join(['%s'] * len(rows))),
+                [MATCH_START, MATCH_END, query, *(row[0] for row in rows)],
+            )
+            snippets = dict(db_cursor.fetchall())
+            rows = [(message_id, rank, snippets.get(message_id, '')) for message_id, rank, _ in rows]
+
+    messages = GroupChatMessage.objects.select_related('user').in_bulk([row[0] for row in rows])
+    results = []
+    for message_id, rank, snippet in rows:
+        if message_id in messages: # Deleted since the search ran
+            results.append({**serialize_message(messages[message_id]), 'rank': rank, 'snippet': mark_snippet(snippet or '')})
+    next_cursor = encode_cursor(rows[-1][1], rows[-1][0]) if has_more else None
+    return results, next_cursor
@@ -0,0 +1,153 @@
+"""
+Daphne launcher with chat-specific WebSocket options.
+
+Daphne does not expose autobahn's permessage-deflate options on its command
+line, so this module wraps its CLI with a `Server` subclass that applies them
+from settings once the WebSocket factory exists. The subclass also applies
+write backpressure: a WebSocket send waits while Twisted's write buffer for
+that connection is over its high-water mark, so a slow client's frames stay
+in the consumer's bounded outbound queue (see `groupchat.outbound`) instead
+of growing the transport buffer without limit. On SIGTERM or SIGINT it
+drains the chat connections (see `groupchat.drain`) before daphne cancels
+its application instances. It accepts exactly the same arguments as `daphne`:
+
+    python -m groupchat.server -b 0.0.0.0 -p 8001 bookhaven.asgi:application
+
+Settings:
+    GROUPCHAT_PERMESSAGE_DEFLATE (bool): Accept permessage-deflate offers.
+    GROUPCHAT_DEFLATE_NO_CONTEXT_TAKEOVER (bool): Reset the compressor after
+        every frame; trades ratio for a bounded per-connection memory cost.
+    GROUPCHAT_DEFLATE_WINDOW_BITS (int or None): Server LZ77 window size (9-15).
+    GROUPCHAT_DEFLATE_MEM_LEVEL (int or None): zlib memory level (1-9).
+"""
+import asyncio
+import logging
+
+from daphne.cli import CommandLineInterface
+from daphne.server import Server
+from twisted.internet import defer
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+
+logger = logging.getLogger(__name__)
+
+
+def permessage_deflate_accept(settings):
+    """
+    Returns an autobahn `perMessageCompressionAccept` callable built from
+    settings, or None when permessage-deflate is disabled.
+    """
+    if not getattr(settings, 'GROUPCHAT_PERMESSAGE_DEFLATE', False):
+        return None
+    from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+
+    no_context_takeover = getattr(settings, 'GROUPCHAT_DEFLATE_NO_CONTEXT_TAKEOVER', True)
+    window_bits = getattr(settings, 'GROUPCHAT_DEFLATE_WINDOW_BITS', None)
+    mem_level = getattr(settings, 'GROUPCHAT_DEFLATE_MEM_LEVEL', None)
+
+    def accept(offers):
+        for offer in offers:
+            if isinstance(offer, PerMessageDeflateOffer):
+                return PerMessageDeflateOfferAccept(
+                    offer,
+                    no_context_takeover=no_context_takeover if offer.accept_no_context_takeover else None,
+                    window_bits=window_bits if offer.accept_max_window_bits else None,
+                    mem_level=mem_level,
+                )
+        return None
+
+    return accept
+
+
+@implementer(IPushProducer)
+class WriteBufferProducer:
+    """
+    Push producer registered on a WebSocket transport. Twisted pauses it when
+    the transport's write buffer passes its high-water mark and resumes it
+    once the buffer drained, which toggles `writable`.
+    """
+
+    def __init__(self):
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def pauseProducing(self):
+        self.writable.clear()
+
+    def resumeProducing(self):
+        self.writable.set()
+
+    def stopProducing(self):
+        self.writable.set() # Disconnected: release waiting senders; daphne drops their frames.
+
+
+class ChatServer(Server):
+    """A daphne `Server` that applies the chat WebSocket options from settings and drains on shutdown."""
+
+    def __init__(self, *args, ready_callable=None, **kwargs):
+        self._next_ready_callable = ready_callable
+        super().__init__(*args, ready_callable=self.configure_websockets, **kwargs)
+
+    def configure_websockets(self):
+        """Runs after daphne built its WebSocket factory and before the reactor starts."""
+        from django.conf import settings
+
+        accept = permessage_deflate_accept(settings)
+        if accept:
+            self.ws_factory.setProtocolOptions(perMessageCompressionAccept=accept)
+            logger.info("permessage-deflate enabled for chat WebSockets.")
+        if self._next_ready_callable:
+            self._next_ready_callable()
+
+    async def handle_reply(self, protocol, message):
+        """Waits for the connection's write buffer to drain before passing on a WebSocket send."""
+        if message['type'] == 'websocket.send':
+            if not hasattr(protocol, 'write_buffer_producer'):
+                protocol.write_buffer_producer = self.watch_write_buffer(protocol)
+            if protocol.write_buffer_producer:
+                await protocol.write_buffer_producer.writable.wait()
+        await super().handle_reply(protocol, message)
+
+    def kill_all_applications(self):
+        """
+        Runs before the reactor shuts down: drains the chat connections, then
+        lets daphne cancel whatever application instances are left.
+        """
+        from .drain import drain
+
+        def kill_remaining(result):
+            return Server.kill_all_applications(self)
+
+        drained = defer.Deferred.fromFuture(asyncio.ensure_future(drain()))
+        drained.addErrback(lambda failure: logger.error("Chat drain failed: %s", failure.getErrorMessage()))
+        drained.addBoth(kill_remaining)
+        return drained
+
+    def watch_write_buffer(self, protocol):
+        """
+        Registers a `WriteBufferProducer` on a WebSocket's transport, replacing
+        the HTTP channel the connection was upgraded from. Returns None when the
+        transport does not support it.
+        """
+        transport = getattr(protocol, 'transport', None)
+        if transport is None or not hasattr(transport, 'registerProducer'):
+            return None
+        producer = WriteBufferProducer()
+        try:
+            if getattr(transport, 'producer', None) is not None:
+                transport.unregisterProducer()
+            transport.registerProducer(producer, True)
+        except RuntimeError as e:
+            logger.debug("Write backpressure unavailable for %s: %s", protocol, e)
+            return None
+        return producer
+
+
+class ChatCommandLineInterface(CommandLineInterface):
+    """The daphne command line, running a `ChatServer`."""
+
+    server_class = ChatServer
+
+
+if __name__ == '__main__':
+    ChatCommandLineInterface.entrypoint()
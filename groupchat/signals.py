@@ -0,0 +1,71 @@
+"""
+Signal handlers for the groupchat application.
+
+Keeps the handshake auth cache in `groupchat.middleware` consistent with
+logouts and user changes, gives messages saved outside the write-behind
+writer their ids, and deletes the attachments of deleted messages.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.contrib.auth.signals import user_logged_out
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from .middleware import invalidate_session, invalidate_user
+from .models import GroupChatMessage
+from .persistence import get_id_allocator, write_behind_enabled
+
+_keep_attachments = ContextVar('groupchat_keep_attachments', default=False)
+
+
+@contextmanager
+def attachments_kept():
+    """Deletes messages within the block without deleting their attachments, e.g. when archiving moves them."""
+    token = _keep_attachments.set(True)
+    try:
+        yield
+    finally:
+        _keep_attachments.reset(token)
+
+
+@receiver(user_logged_out)
+def invalidate_logged_out_session(sender, request, user, **kwargs):
+    """Invalidates the cached entry of the session being logged out."""
+    session = getattr(request, 'session', None)
+    if session is not None:
+        invalidate_session(session.session_key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_user_cache(sender, instance, **kwargs):
+    """
+    Invalidates the cached user once the change is committed, so handshakes
+    see a new password, a deactivation or a deletion.
+    """
+    transaction.on_commit(lambda: invalidate_user(instance.pk))
+
+
+@receiver(pre_save, sender=GroupChatMessage)
+def allocate_message_id(sender, instance, raw=False, **kwargs):
+    """
+    Gives a new message saved outside the write-behind writer an id from the
+    process's allocator while write-behind is on (see `groupchat.persistence`).
+    """
+    if instance.pk is None and not raw and write_behind_enabled():
+        instance.pk = get_id_allocator().next_id()
+
+
+@receiver(post_delete, sender=GroupChatMessage)
+def delete_attachment(sender, instance, **kwargs):
+    """
+    Deletes a deleted message's attachment once the delete is committed. With
+    deduplicated storage this drops one link from its blob, so
+    `chat_dedup_media --prune` can reclaim blobs nothing links any more.
+    """
+    if not instance.file_attachment or _keep_attachments.get():
+        return
+    storage, name = instance.file_attachment.storage, instance.file_attachment.name
+    transaction.on_commit(lambda: storage.delete(name))
@@ -0,0 +1,157 @@
+"""
+Content-addressed, deduplicated storage for chat attachments.
+
+The same PDFs and images are attached in many groups. `ContentAddressedStorage`
+stores each distinct file once, as a blob named by its SHA-256 under
+`GROUPCHAT_BLOB_DIR` (inside `MEDIA_ROOT`):
+
+    group_chat_blobs/3f/3f9a...e1                          the bytes, stored once
+    group_chat_files/2026/05/18/report.pdf  ─┐ hard links to the blob, one per
+    group_chat_files/2026/06/02/report.pdf  ─┘ message, under the usual names
+
+The attachment names, URLs and paths are unchanged, so everything that serves
+or reads them (downloads, X-Accel-Redirect) works as before. The blob's link
+count is its reference count: each attachment adds one link and deleting an
+attachment removes one, as deleting its message does (`groupchat.signals`;
+archiving keeps it). A blob whose count dropped back to 1 is referenced
+by nothing but the blob store and is removed by
+`manage.py chat_dedup_media --prune`.
+
+Content is hashed while it is streamed into a staging file next to the blobs.
+Uploads already on disk as temporary files (the chunked WebSocket uploads,
+large form uploads) are moved to the staging file and hashed there. The
+staging file is then linked under the attachment's name first, so the
+content is referenced before the blob store is touched. Next it becomes the
+blob, or, if the content is already stored, the name is re-pointed at the
+existing blob and the staged bytes are freed. Blobs are created with
+`link()`, which never replaces an existing file, so identical uploads racing
+each other end up sharing one blob. A blob pruned between those two steps is
+simply stored again from the staged copy.
+
+`attachment_storage` is the `file_attachment` field's storage: this class with
+`GROUPCHAT_ATTACHMENT_DEDUP` (the default), else the default storage. The
+blob store must be on the same file system as the attachments. Where hard
+links fail, an attachment is stored as a plain file outside the blob store
+(not deduplicated) rather than as a copy of a blob, which the link count
+could not account for.
+
+Settings:
+    GROUPCHAT_ATTACHMENT_DEDUP (bool): Store chat attachments deduplicated. Defaults to True.
+    GROUPCHAT_BLOB_DIR (str): Blob directory, relative to `MEDIA_ROOT`. Defaults to 'group_chat_blobs'.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import uuid
+
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage, default_storage
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def file_digest(path):
+    """Returns the SHA-256 hex digest of a file on disk."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """A `FileSystemStorage` that stores each distinct content once and hard-links names to it."""
+
+    def __init__(self, *args, blob_dir=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.blob_dir = blob_dir or getattr(settings, 'GROUPCHAT_BLOB_DIR', 'group_chat_blobs')
+
+    def blob_path(self, digest):
+        """Returns the absolute path of the blob holding the content with this SHA-256."""
+        return self.path(os.path.join(self.blob_dir, digest[:2], digest))
+
+    def stage(self, content):
+        """
+        Writes `content` to a new staging file in the blob directory, hashing it.
+
+        Args:
+            content (File): The content; temporary files are consumed.
+
+        Returns:
+            tuple: The staging file's path and the content's SHA-256 hex digest.
+        """
+        staging_dir = self.path(self.blob_dir)
+        os.makedirs(staging_dir, exist_ok=True)
+        fd, staging = tempfile.mkstemp(dir=staging_dir, prefix='.staging-')
+        try:
+            if hasattr(content, 'temporary_file_path'):
+                os.close(fd)
+                file_move_safe(content.temporary_file_path(), staging, allow_overwrite=True) # A rename on one file system
+                return staging, file_digest(staging)
+            digest = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as staged:
+                for chunk in content.chunks(HASH_BLOCK_SIZE):
+                    digest.update(chunk)
+                    staged.write(chunk)
+            return staging, digest.hexdigest()
+        except BaseException:
+            os.remove(staging)
+            raise
+
+    def share_blob(self, staging, digest, full_path):
+        """
+        Makes the staged content, already linked at `full_path`, the blob for
+        `digest`, or re-points `full_path` at the existing blob.
+        """
+        blob = self.blob_path(digest)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        while True:
+            try:
+                os.link(staging, blob) # Never replaces a blob, so concurrent identical uploads share one
+                return
+            except FileExistsError:
+                pass
+            # Link under a temporary name and rename over the attachment, so the name never goes missing.
+            temp_path = f'{full_path}.dedup-{uuid.uuid4().hex}'
+            try:
+                os.link(blob, temp_path)
+            except FileNotFoundError:
+                continue # Pruned since it was found; store the staged content as the blob instead
+            os.replace(temp_path, full_path)
+            return
+
+    def _save(self, name, content):
+        staging, digest = self.stage(content)
+        try:
+            if self.file_permissions_mode is not None:
+                os.chmod(staging, self.file_permissions_mode)
+            while True:
+                full_path = self.path(name)
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                try:
+                    os.link(staging, full_path)
+                    break
+                except FileExistsError:
+                    name = self.get_available_name(name) # Taken since `save()` picked it
+                except OSError as e:
+                    logger.warning("Hard links failed in %s (%s); storing %s without deduplication.", self.location, e, name)
+                    file_move_safe(staging, full_path)
+                    return str(name).replace('\\', '/')
+            self.share_blob(staging, digest, full_path)
+            return str(name).replace('\\', '/')
+        finally:
+            try:
+                os.remove(staging)
+            except FileNotFoundError:
+                pass # Moved into place without deduplication
+
+
+def attachment_storage():
+    """Storage of `GroupChatMessage.file_attachment` (see the module docstring)."""
+    if getattr(settings, 'GROUPCHAT_ATTACHMENT_DEDUP', True):
+        return ContentAddressedStorage()
+    return default_storage
@@ -6,6 +6,7 @@ Django templates related to the groupchat app.
 """
 import os
 from django import template
+from content.derivatives import is_image as is_renderable_image
 
 register = template.Library()
 
@@ -19,4 +20,12 @@ def filename_only(value):
         return os.path.basename(value.name)
     elif isinstance(value, str): # Handles string paths
         return os.path.basename(value)
-    return value # Return original value if not a known file path type 
\ No newline at end of file
+    return value # Return original value if not a known file path type 
+
+@register.filter(name='is_image')
+def is_image(value):
+    """
+    Returns True if a file (or file name) is an image that is shown as a thumbnail.
+    Example: 'group_chat_files/2023/05/17/photo.jpg' -> True
+    """
+    return is_renderable_image(getattr(value, 'name', value) or '')
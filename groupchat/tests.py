@@ -1,3 +1,815 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import glob
+import hashlib
+import io
+import os
+import importlib.util
+import math
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import AsyncToSync, SyncToAsync, async_to_sync, sync_to_async
+from channels_redis.core import RedisChannelLayer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from discussions.models import GroupMembership
+from groupchat.admission import AdmissionMiddleware, executor_queue_depth, get_admission_controller
+from groupchat.affinity import HashRing, pin, pins, publish_load, room_loads, route, unpin
+from groupchat.consumers import ChatConsumer, MultiplexChatConsumer
+from groupchat.management.commands._fanout import start_stand_in_servers
+from groupchat.middleware import CachedAuthMiddlewareStack
+from groupchat.middleware import stats as auth_stats
+from groupchat.routing import websocket_urlpatterns
+from groupchat.management.commands._bench import ChatFixture, chat_communicator, receive_frame
+from groupchat.archive import archive_group
+from groupchat.drain import drain
+from groupchat.models import GroupChatMessage
+from groupchat.outbound import OutboundQueue
+from groupchat.persistence import SEQUENCE_BITS, WORKER_BITS, MessageIdAllocator, get_message_writer
+from groupchat.recorder import get_traffic_recorder, read_log
+from groupchat.storage import ContentAddressedStorage
+from groupchat.unread import ReadMarker
+from groupchat.uploads import encode_chunk
+
+
+class ChatConsumerTestCase(TransactionTestCase):
+    """
+    Base class for tests driving chat consumers through `WebsocketCommunicator`.
+
+    Consumers reach the database from executor threads, so these run outside
+    a transaction and `fixture` creates its rows for real.
+    """
+
+    members, rooms = 2, 1
+
+    def setUp(self):
+        cache.clear()
+        self.fixture = ChatFixture(members=self.members, rooms=self.rooms)
+        self.addCleanup(self.fixture.cleanup)
+
+    async def connect(self, user=None, group_id=None, application=None):
+        """Connects `user` (the first member by default) and skips the presence snapshot."""
+        communicator = chat_communicator(
+            application or ChatConsumer.as_asgi(), user or self.fixture.users[0], group_id or self.fixture.group.id
+        )
+        connected, _ = await communicator.connect(timeout=10)
+        self.assertTrue(connected)
+        await communicator.receive_json_from(timeout=10)
+        return communicator
+
+
+class HandleFrameTests(ChatConsumerTestCase):
+
+    async def test_non_map_frame_gets_message_error(self):
+        communicator = await self.connect()
+        for payload in ([1, 2], "hello", 42, None):
+            await communicator.send_json_to(payload)
+            frame = await receive_frame(communicator, timeout=10)
+            self.assertEqual(frame['type'], 'message.error')
+            self.assertEqual(frame['group'], self.fixture.group.id)
+        await communicator.disconnect()
+
+
+class ResumeTests(ChatConsumerTestCase):
+
+    @override_settings(
+        GROUPCHAT_WRITE_BEHIND=True, GROUPCHAT_WORKER_ID=1, GROUPCHAT_WRITE_BEHIND_FLUSH_INTERVAL=60,
+        GROUPCHAT_USER_MESSAGE_RATE=0, GROUPCHAT_ROOM_MESSAGE_RATE=0,
+    )
+    async def test_resume_from_a_message_still_queued_for_writing(self):
+        sender = await self.connect()
+        sent = []
+        for text in ('first', 'second'):
+            await sender.send_json_to({'message': text, 'temp_id': text})
+            sent.append(await receive_frame(sender, timeout=10))
+        self.assertFalse(await GroupChatMessage.objects.filter(id=sent[0]['id']).aexists()) # Still queued
+
+        communicator = chat_communicator(
+            ChatConsumer.as_asgi(), self.fixture.users[1], self.fixture.group.id, query=f"last_id={sent[0]['id']}"
+        )
+        connected, _ = await communicator.connect(timeout=10)
+        self.assertTrue(connected)
+        replayed = await receive_frame(communicator, timeout=10)
+        self.assertEqual((replayed['id'], replayed['replayed']), (sent[1]['id'], True))
+        complete = await receive_frame(communicator, timeout=10)
+        self.assertEqual(complete, {'type': 'resume.complete', 'group': self.fixture.group.id, 'replayed': 1, 'truncated': False})
+        await communicator.disconnect()
+        await sender.disconnect()
+
+
+class MembershipRevocationTests(ChatConsumerTestCase):
+
+    async def test_revoked_member_is_refused(self):
+        user = self.fixture.users[1]
+        communicator = await self.connect(user)
+        await communicator.disconnect()
+        # Outside a transaction the on_commit invalidation runs right away.
+        await GroupMembership.objects.filter(user=user, group=self.fixture.group).adelete()
+        communicator = chat_communicator(ChatConsumer.as_asgi(), user, self.fixture.group.id)
+        connected, _ = await communicator.connect(timeout=10)
+        self.assertFalse(connected)
+
+
+class CachedAuthTests(ChatConsumerTestCase):
+
+    async def handshake(self):
+        """Connects with the test client's session cookie through the cached auth stack; returns whether it was accepted."""
+        cookie = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        communicator = WebsocketCommunicator(
+            CachedAuthMiddlewareStack(URLRouter(websocket_urlpatterns)), f'/ws/chat/{self.fixture.group.id}/',
+            headers=[(b'cookie', f'{settings.SESSION_COOKIE_NAME}={cookie}'.encode())],
+        )
+        connected, _ = await communicator.connect(timeout=10)
+        if connected:
+            await communicator.disconnect()
+        return connected
+
+    async def log_in(self):
+        user = self.fixture.users[0]
+        await sync_to_async(self.client.force_login)(user)
+        self.assertTrue(await self.handshake())
+        hits = auth_stats['session_hits']
+        self.assertTrue(await self.handshake())
+        self.assertEqual(auth_stats['session_hits'], hits + 1) # Served from the cache from now on
+        return user
+
+    async def test_logged_out_session_is_refused(self):
+        await self.log_in()
+        cookie = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        await sync_to_async(self.client.logout)()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = cookie # A client still holding the old cookie
+        self.assertFalse(await self.handshake())
+
+    async def test_changed_password_is_refused(self):
+        user = await self.log_in()
+        user.set_password('changed')
+        await user.asave()
+        self.assertFalse(await self.handshake())
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.signed_cookies')
+    async def test_signed_cookie_session_survives_key_rotation(self):
+        user = await self.log_in()
+        with override_settings(SECRET_KEY='rotated-' + settings.SECRET_KEY, SECRET_KEY_FALLBACKS=[settings.SECRET_KEY]):
+            await sync_to_async(cache.clear)() # Resolve the cookie and the session auth hash again
+            self.assertTrue(await self.handshake())
+            user.set_password('changed')
+            await user.asave()
+            self.assertFalse(await self.handshake())
+
+
+class WriteBehindTests(ChatConsumerTestCase):
+
+    @override_settings(GROUPCHAT_WRITE_BEHIND=True, GROUPCHAT_WORKER_ID=3)
+    async def test_messages_saved_outside_the_writer_take_allocator_ids(self):
+        user, group = self.fixture.users[0], self.fixture.group
+        writer = get_message_writer()
+        for index in range(3):
+            writer.enqueue(user.id, group.id, f'queued {index}')
+        saved = await GroupChatMessage.objects.acreate(user=user, group=group, text_content='through the view')
+        for index in range(3, 6):
+            writer.enqueue(user.id, group.id, f'queued {index}')
+        await writer.flush()
+        self.assertEqual((saved.id >> SEQUENCE_BITS) & ((1 << WORKER_BITS) - 1), 3)
+        self.assertEqual(writer.stats['failed'], 0)
+        self.assertEqual(await GroupChatMessage.objects.filter(group=group).acount(), 7)
+
+
+class MessageIdAllocatorTests(SimpleTestCase):
+
+    @override_settings(GROUPCHAT_WRITE_BEHIND=True, GROUPCHAT_WORKER_ID=None)
+    def test_write_behind_requires_worker_id(self):
+        with self.assertRaises(ImproperlyConfigured):
+            MessageIdAllocator()
+
+    def test_worker_id_must_fit(self):
+        with self.assertRaises(ImproperlyConfigured):
+            MessageIdAllocator(worker_id=64)
+
+    def test_ids_are_increasing_and_carry_worker_id(self):
+        allocator = MessageIdAllocator(worker_id=5)
+        ids = [allocator.next_id() for _ in range(1000)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual({(message_id >> SEQUENCE_BITS) & 63 for message_id in ids}, {5})
+
+
+@unittest.skipUnless(importlib.util.find_spec('fakeredis'), "requires fakeredis (see requirements-dev.txt)")
+class ShardedFanoutTests(SimpleTestCase):
+    """Group sends over the `chat_benchmark fanout --stand-in` servers reach every member on every shard."""
+
+    async def test_every_subscriber_on_every_shard_receives(self):
+        hosts = start_stand_in_servers(3)
+        sender = RedisChannelLayer(hosts=hosts)
+        # One layer per simulated worker; a worker's channels share the shard of its client prefix.
+        workers, covered = [], set()
+        while covered != set(range(len(hosts))) or len(workers) < 6:
+            layer = RedisChannelLayer(hosts=hosts)
+            channels = [await layer.new_channel() for _ in range(2)]
+            workers.append((layer, channels))
+            covered.add(layer.consistent_hash(layer.non_local_name(channels[0])))
+            self.assertLess(len(workers), 100)
+        groups, covered = [], set()
+        while covered != set(range(len(hosts))):
+            groups.append(f'chat_test_{len(groups)}')
+            covered.add(sender.consistent_hash(groups[-1]))
+
+        for group in groups:
+            for layer, channels in workers:
+                for channel in channels:
+                    await layer.group_add(group, channel)
+        for sequence, group in enumerate(groups):
+            await sender.group_send(group, {'type': 'chat.message', 'group': group, 'seq': sequence})
+
+        for layer, channels in workers:
+            for channel in channels:
+                received = [await asyncio.wait_for(layer.receive(channel), 5) for _ in groups]
+                self.assertEqual(sorted(event['group'] for event in received), sorted(groups))
+        for layer, _ in [(sender, None), *workers]:
+            await layer.close_pools()
+
+
+@override_settings(GROUPCHAT_METRICS_TOKEN='scrape-me')
+class ChatMetricsViewTests(TestCase):
+
+    def test_requires_staff_or_token(self):
+        url = reverse('groupchat:chat_metrics')
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='127.0.0.1').status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = self.client.get(url, HTTP_AUTHORIZATION='Bearer scrape-me')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('admission', response.json())
+        response = self.client.get(url, {'format': 'prometheus'}, HTTP_AUTHORIZATION='Bearer scrape-me')
+        self.assertIn(b'groupchat_membership_cache_hits', response.content)
+
+    def test_rejects_post(self):
+        response = self.client.post(reverse('groupchat:chat_metrics'), HTTP_AUTHORIZATION='Bearer scrape-me')
+        self.assertEqual(response.status_code, 405)
+
+
+class ChunkedUploadTests(ChatConsumerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings_override = override_settings(
+            MEDIA_ROOT=directory, GROUPCHAT_UPLOAD_TEMP_DIR=f'{directory}/parts',
+            GROUPCHAT_USER_MESSAGE_RATE=0, GROUPCHAT_ROOM_MESSAGE_RATE=0,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    async def start(self, communicator, size):
+        await communicator.send_json_to({'type': 'upload.start', 'temp_id': 't1', 'file_name': 'big.bin', 'size': size})
+        return await receive_frame(communicator, timeout=10)
+
+    async def test_streamed_file_is_stored_intact_in_bounded_memory(self):
+        size = 48 * 1024 * 1024
+        communicator = await self.connect()
+        peak_before_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        ready = await self.start(communicator, size)
+        self.assertEqual(ready['type'], 'upload.ready')
+        chunk, window = ready['chunk_size'], ready['window']
+        digest = hashlib.sha256()
+        sent = acked = 0
+        while acked < size:
+            while sent < size and sent - acked < chunk * window:
+                data = sent.to_bytes(8, 'big') * (min(chunk, size - sent) // 8)
+                digest.update(data)
+                await communicator.send_to(bytes_data=encode_chunk(ready['upload_id'], sent, data))
+                sent += len(data)
+            frame = await receive_frame(communicator, timeout=30)
+            self.assertEqual(frame['type'], 'upload.ack')
+            acked = frame['offset']
+        broadcast = await receive_frame(communicator, timeout=60)
+        await communicator.disconnect()
+
+        growth_mib = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_before_kb) / 1024
+        self.assertLess(growth_mib, 24) # Half the file: nothing holds it whole
+        message = await GroupChatMessage.objects.aget(id=broadcast['id'])
+        with message.file_attachment.open('rb') as stored:
+            self.assertEqual(hashlib.file_digest(stored, 'sha256').hexdigest(), digest.hexdigest())
+
+    @override_settings(GROUPCHAT_UPLOAD_USER_QUOTA=3000)
+    async def test_unfinished_uploads_share_a_per_user_quota(self):
+        first = await self.connect()
+        self.assertEqual((await self.start(first, 2000))['type'], 'upload.ready')
+        await first.disconnect() # The partial upload stays on disk for a resume.
+        second = await self.connect()
+        refused = await self.start(second, 2000)
+        self.assertEqual(refused['type'], 'message.error')
+        self.assertEqual((await self.start(second, 1000))['type'], 'upload.ready')
+        await second.disconnect()
+
+
+class ContentAddressedStorageTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.storage = ContentAddressedStorage(location=directory)
+        self.blob = self.storage.blob_path(hashlib.sha256(b'report').hexdigest())
+
+    def test_identical_content_is_stored_once(self):
+        first = self.storage.save('a/report.pdf', ContentFile(b'report'))
+        second = self.storage.save('b/report.pdf', ContentFile(b'report'))
+        inodes = {os.stat(self.storage.path(name)).st_ino for name in (first, second)}
+        self.assertEqual(inodes, {os.stat(self.blob).st_ino})
+        self.assertEqual(os.stat(self.blob).st_nlink, 3)
+
+    def test_blob_pruned_mid_save_is_stored_again(self):
+        self.storage.save('a/report.pdf', ContentFile(b'report'))
+        link = os.link
+
+        def prune_first(source, target):
+            if source == self.blob and os.path.exists(self.blob):
+                os.remove(self.storage.path('a/report.pdf'))
+                os.remove(self.blob) # What `chat_dedup_media --prune` does once the blob is unreferenced
+            return link(source, target)
+
+        with mock.patch('groupchat.storage.os.link', side_effect=prune_first):
+            name = self.storage.save('b/report.pdf', ContentFile(b'report'))
+        self.assertEqual(os.stat(self.storage.path(name)).st_ino, os.stat(self.blob).st_ino)
+        with self.storage.open(name) as stored:
+            self.assertEqual(stored.read(), b'report')
+
+    def test_without_hard_links_attachments_are_plain_files(self):
+        with mock.patch('groupchat.storage.os.link', side_effect=OSError(1, 'Operation not permitted')), \
+                self.assertLogs('groupchat.storage', 'WARNING'):
+            name = self.storage.save('a/report.pdf', ContentFile(b'report'))
+        self.assertEqual(os.stat(self.storage.path(name)).st_nlink, 1)
+        self.assertFalse(os.path.exists(self.blob))
+        self.assertEqual(os.listdir(self.storage.path(self.storage.blob_dir)), [])
+
+
+class AttachmentCleanupTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings_override = override_settings(MEDIA_ROOT=directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.fixture = ChatFixture(members=1)
+
+    def attach(self, content):
+        message = GroupChatMessage(user=self.fixture.users[0], group=self.fixture.group)
+        message.file_attachment.save('report.pdf', ContentFile(content))
+        return message
+
+    def test_deleted_messages_release_their_blob_for_pruning(self):
+        messages = [self.attach(b'report') for _ in range(2)]
+        blob = messages[0].file_attachment.storage.blob_path(hashlib.sha256(b'report').hexdigest())
+        with self.captureOnCommitCallbacks(execute=True):
+            messages[0].delete()
+        self.assertFalse(os.path.exists(messages[0].file_attachment.path))
+        self.assertEqual(os.stat(blob).st_nlink, 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            messages[1].delete()
+        with mock.patch('groupchat.management.commands.chat_dedup_media.PRUNE_GRACE', -1):
+            call_command('chat_dedup_media', prune=True, stdout=io.StringIO())
+        self.assertFalse(os.path.exists(blob))
+
+    def test_archiving_keeps_attachments(self):
+        message = self.attach(b'report')
+        GroupChatMessage.objects.filter(pk=message.pk).update(timestamp=datetime.datetime(2020, 3, 5, tzinfo=datetime.timezone.utc))
+        with self.captureOnCommitCallbacks(execute=True):
+            archive_group(self.fixture.group)
+        self.assertFalse(GroupChatMessage.objects.filter(pk=message.pk).exists())
+        self.assertTrue(os.path.exists(message.file_attachment.path))
+
+
+class AttachmentViewTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        settings_override = override_settings(MEDIA_ROOT=directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.fixture = ChatFixture(members=2)
+        self.content = bytes(range(250)) * 4
+        message = GroupChatMessage(user=self.fixture.users[0], group=self.fixture.group)
+        message.file_attachment.save('notes.bin', ContentFile(self.content))
+        self.url = reverse('groupchat:chat_attachment', args=[self.fixture.group.id, message.id])
+        self.client.force_login(self.fixture.users[0])
+
+    def get(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, body
+
+    def test_ranges(self):
+        response, body = self.get()
+        self.assertEqual((response.status_code, body, response['Accept-Ranges']), (200, self.content, 'bytes'))
+        response, body = self.get(Range='bytes=-100')
+        self.assertEqual((response.status_code, response['Content-Range'], body), (206, 'bytes 900-999/1000', self.content[-100:]))
+        response, body = self.get(Range='bytes=990-2000')
+        self.assertEqual((response.status_code, response['Content-Range'], body), (206, 'bytes 990-999/1000', self.content[990:]))
+        response, _ = self.get(Range='bytes=1000-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */1000'))
+
+    def test_conditional_requests(self):
+        etag = self.get()[0]['ETag']
+        response, body = self.get(Range='bytes=0-9', **{'If-Range': '"stale"'})
+        self.assertEqual((response.status_code, body), (200, self.content))
+        response, body = self.get(Range='bytes=0-9', **{'If-Range': etag})
+        self.assertEqual((response.status_code, body), (206, self.content[:10]))
+        self.assertEqual(self.get(**{'If-None-Match': f'"other", W/{etag}'})[0].status_code, 304)
+        self.assertEqual(self.get(**{'If-None-Match': '"other"'})[0].status_code, 200)
+
+    def test_only_members_may_download(self):
+        self.client.force_login(self.fixture.users[1])
+        GroupMembership.objects.filter(user=self.fixture.users[1]).delete()
+        cache.clear()
+        self.assertEqual(self.get()[0].status_code, 403)
+        self.client.logout()
+        self.assertEqual(self.get()[0].status_code, 302) # To the login page
+        self.client.force_login(self.fixture.users[0])
+        missing = reverse('groupchat:chat_attachment', args=[self.fixture.group.id, 10 ** 12])
+        self.assertEqual(self.client.get(missing).status_code, 404)
+
+
+class OutboundQueueTests(SimpleTestCase):
+
+    async def stalled_queue(self, policy):
+        """Returns a queue of 3 whose writer is stuck sending the first frame."""
+        stalled = asyncio.Event()
+        queue = OutboundQueue(lambda **kwargs: stalled.wait(), lambda count: {'skipped': count}, maxsize=3, policy=policy)
+        self.addCleanup(queue.close)
+        queue.put({'text': 'in flight'})
+        await asyncio.sleep(0)
+        return queue
+
+    async def test_overflow_sheds_droppable_frames(self):
+        for policy in ('drop_oldest', 'coalesce'):
+            queue = await self.stalled_queue(policy)
+            await queue.put_wait({'text': 'reply'})
+            for sequence in range(10):
+                self.assertTrue(queue.put({'text': sequence}))
+            self.assertLessEqual(len(queue), 3)
+            self.assertIn(({'text': 'reply'}, False, False), queue._items)
+
+    async def test_full_of_replies_refuses_under_every_policy(self):
+        for policy in ('drop_oldest', 'coalesce', 'disconnect'):
+            queue = await self.stalled_queue(policy)
+            for sequence in range(3):
+                await queue.put_wait({'text': f'reply {sequence}'})
+            self.assertFalse(queue.put({'text': 'broadcast'}))
+            self.assertEqual(len(queue), 3)
+
+
+class AdmissionTests(ChatConsumerTestCase):
+
+    async def refusal(self, user, application=None):
+        """Connects `user` and returns the `connect.rejected` frame and close code they get."""
+        communicator = chat_communicator(application or ChatConsumer.as_asgi(), user, self.fixture.group.id)
+        connected, _ = await communicator.connect(timeout=10)
+        self.assertTrue(connected) # Accepted only to be told why and for how long
+        frame = await communicator.receive_json_from(timeout=10)
+        close = await communicator.receive_output(timeout=10)
+        self.assertEqual(close['type'], 'websocket.close')
+        return frame, close['code']
+
+    @override_settings(GROUPCHAT_ADMISSION_MAX_USER_CONNECTIONS=1)
+    async def test_per_user_cap(self):
+        first = await self.connect()
+        self.assertEqual(
+            await self.refusal(self.fixture.users[0]),
+            ({'type': 'connect.rejected', 'code': 'too_many_connections', 'retry_after': 5}, 4029),
+        )
+        await first.disconnect()
+        await (await self.connect()).disconnect() # The slot is free again
+
+    @override_settings(GROUPCHAT_ADMISSION_MAX_GROUP_CONNECTIONS=1)
+    async def test_per_group_cap(self):
+        first = await self.connect()
+        self.assertEqual(
+            await self.refusal(self.fixture.users[1]),
+            ({'type': 'connect.rejected', 'code': 'group_full', 'retry_after': 5}, 4029),
+        )
+        await first.disconnect()
+
+    @override_settings(GROUPCHAT_ADMISSION_MAX_CONNECTIONS=1, GROUPCHAT_ADMISSION_RETRY_AFTER=2)
+    async def test_per_process_cap(self):
+        first = await self.connect()
+        self.assertEqual(
+            await self.refusal(self.fixture.users[1]),
+            ({'type': 'connect.rejected', 'code': 'server_full', 'retry_after': 2}, 4013),
+        )
+        await first.disconnect()
+
+    @override_settings(GROUPCHAT_ADMISSION_MAX_LOOP_LAG=0.05, GROUPCHAT_ADMISSION_RETRY_AFTER=3)
+    async def test_loop_lag_sheds_with_stretched_retry_after(self):
+        application = AdmissionMiddleware(ChatConsumer.as_asgi())
+        controller = get_admission_controller()
+        controller.loop_lag() # Starts sampling
+        await asyncio.sleep(0)
+        time.sleep(0.2) # Blocks the event loop past its next sample
+        self.assertEqual(
+            await self.refusal(self.fixture.users[0], application),
+            ({'type': 'connect.rejected', 'code': 'overloaded', 'retry_after': 3}, 4013),
+        )
+        controller.shed_ratio = 4.0 # Four shed for every handshake let in
+        time.sleep(0.2)
+        frame, code = await self.refusal(self.fixture.users[0], application)
+        self.assertEqual((frame['retry_after'], code), (12, 4013))
+
+
+class DrainTests(ChatConsumerTestCase):
+
+    members = 12
+
+    async def test_reconnects_are_spread_over_the_window(self):
+        window = 3.0
+        communicators = [await self.connect(user) for user in self.fixture.users]
+        closed_at = []
+
+        async def follow(communicator):
+            frame = await receive_frame(communicator, timeout=10)
+            self.assertEqual(frame['type'], 'reconnect')
+            await asyncio.sleep(frame['after'])
+            await communicator.disconnect()
+            closed_at.append(time.monotonic())
+            return frame['after']
+
+        clients = [asyncio.ensure_future(follow(communicator)) for communicator in communicators]
+        result = await drain(window=window, timeout=window + 5)
+        afters = await asyncio.gather(*clients)
+
+        self.assertEqual(result['left'], self.members)
+        self.assertEqual(sorted(afters), [round(window * index / self.members, 1) for index in range(self.members)])
+        limit = math.ceil(self.members / window) + 1 # One more for a close landing on the second's boundary
+        for started in closed_at:
+            self.assertLessEqual(sum(started <= at < started + 1 for at in closed_at), limit)
+
+    async def test_executor_queue_depth_survives_asgiref_internals_changing(self):
+        self.assertGreaterEqual(executor_queue_depth(), 0)
+        with mock.patch.object(AsyncToSync, 'loop_thread_executors', None), \
+                mock.patch.object(SyncToAsync, 'single_thread_executor', None):
+            self.assertEqual(executor_queue_depth(), 0)
+
+
+class MultiplexTests(ChatConsumerTestCase):
+    members, rooms = 1, 2
+
+    async def mux_connect(self):
+        communicator = WebsocketCommunicator(MultiplexChatConsumer.as_asgi(), '/ws/chat/')
+        communicator.scope['user'] = self.fixture.users[0]
+        connected, _ = await communicator.connect(timeout=10)
+        self.assertTrue(connected)
+        return communicator
+
+    async def request(self, communicator, frame):
+        """Sends a frame (or raw text) and returns the reply, skipping presence frames."""
+        if isinstance(frame, str):
+            await communicator.send_to(text_data=frame)
+        else:
+            await communicator.send_json_to(frame)
+        return await receive_frame(communicator, timeout=10)
+
+    @override_settings(GROUPCHAT_USER_MESSAGE_RATE=0, GROUPCHAT_ROOM_MESSAGE_RATE=0)
+    async def test_subscribe_send_and_unsubscribe(self):
+        member_of, other = (group.id for group in self.fixture.groups)
+        communicator = await self.mux_connect()
+        self.assertEqual(await self.request(communicator, {'type': 'subscribe', 'group': member_of}), {'type': 'subscribed', 'group': member_of})
+        self.assertEqual((await self.request(communicator, {'type': 'subscribe', 'group': other}))['code'], 'not_member')
+        self.assertEqual((await self.request(communicator, {'type': 'subscribe', 'group': 'x'}))['code'], 'invalid')
+
+        sent = await self.request(communicator, {'group': member_of, 'message': 'hello', 'temp_id': 't1'})
+        self.assertEqual((sent['group'], sent['temp_id'], sent['text']), (member_of, 't1', 'hello'))
+        for frame in ([1, 2], '{not json'):
+            self.assertEqual(await self.request(communicator, frame), {'type': 'message.error', 'group': None, 'error': 'Frames must be JSON objects.'})
+        refused = await self.request(communicator, {'group': other, 'message': 'hello'})
+        self.assertEqual((refused['type'], refused['code'], refused['group']), ('message.error', 'not_subscribed', other))
+
+        self.assertEqual(await self.request(communicator, {'type': 'unsubscribe', 'group': member_of}), {'type': 'unsubscribed', 'group': member_of})
+        refused = await self.request(communicator, {'group': member_of, 'message': 'hello', 'temp_id': 't2'})
+        self.assertEqual((refused['code'], refused['temp_id']), ('not_subscribed', 't2'))
+        await communicator.disconnect()
+
+    @override_settings(GROUPCHAT_MUX_MAX_SUBSCRIPTIONS=1)
+    async def test_subscriptions_are_capped(self):
+        await GroupMembership.objects.acreate(user=self.fixture.users[0], group=self.fixture.groups[1])
+        communicator = await self.mux_connect()
+        first, second = (group.id for group in self.fixture.groups)
+        self.assertEqual((await self.request(communicator, {'type': 'subscribe', 'group': first}))['type'], 'subscribed')
+        self.assertEqual((await self.request(communicator, {'type': 'subscribe', 'group': second}))['code'], 'too_many_subscriptions')
+        await communicator.disconnect()
+
+    @override_settings(GROUPCHAT_MUX_MAX_CONNECTIONS=1)
+    async def test_another_connection_replaces_the_oldest(self):
+        oldest = await self.mux_connect()
+        newest = await self.mux_connect()
+        self.assertEqual(await oldest.receive_output(timeout=10), {'type': 'websocket.close', 'code': 4009})
+        await newest.disconnect()
+
+
+class MultiplexRecordingTests(ChatConsumerTestCase):
+    members, rooms = 1, 2
+
+    def setUp(self):
+        super().setUp()
+        GroupMembership.objects.create(user=self.fixture.users[0], group=self.fixture.groups[1])
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    async def record(self):
+        """Records one multiplexed session sending a message to each of the fixture's rooms."""
+        communicator = WebsocketCommunicator(MultiplexChatConsumer.as_asgi(), '/ws/chat/')
+        communicator.scope['user'] = self.fixture.users[0]
+        connected, _ = await communicator.connect(timeout=10)
+        self.assertTrue(connected)
+        for group in self.fixture.groups:
+            await communicator.send_json_to({'type': 'subscribe', 'group': group.id})
+            self.assertEqual((await receive_frame(communicator, timeout=10))['type'], 'subscribed')
+            await communicator.send_json_to({'group': group.id, 'message': 'hello', 'temp_id': f't{group.id}'})
+            self.assertEqual((await receive_frame(communicator, timeout=10))['temp_id'], f't{group.id}')
+        await communicator.disconnect()
+        await get_traffic_recorder().flush()
+        return get_traffic_recorder().path
+
+    def test_multiplexed_frames_are_recorded_and_replayed(self):
+        with override_settings(GROUPCHAT_RECORD_DIR=self.directory, GROUPCHAT_RECORD_REDACT=False):
+            async_to_sync(self.record)()
+        path, = glob.glob(f'{self.directory}/*.msgpack.gz')
+        header, connect, *records = read_log(path)
+        self.assertEqual(connect[3], None)
+        sent = [record[3] for record in records if record[0] == 'r' and 'message' in record[3]]
+        self.assertEqual([frame['group'] for frame in sent], [group.id for group in self.fixture.groups])
+
+        output = io.StringIO()
+        call_command('chat_replay', path, '--speed', '0', stdout=output)
+        self.assertRegex(output.getvalue(), r'echo\s+messages=2, answered=2,')
+
+
+class HistoryApiTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.fixture = ChatFixture(members=1)
+        user, group = self.fixture.users[0], self.fixture.group
+        self.client.force_login(user)
+        messages = GroupChatMessage.objects.bulk_create(
+            GroupChatMessage(user=user, group=group, text_content=f'm{index}') for index in range(11)
+        )
+        # Three messages per timestamp, and later ids on older timestamps, so only (timestamp, id) orders them.
+        base = datetime.datetime(2025, 6, 1, tzinfo=datetime.timezone.utc)
+        for index, message in enumerate(messages):
+            message.timestamp = base - datetime.timedelta(seconds=index // 3)
+        GroupChatMessage.objects.bulk_update(messages, ['timestamp'])
+        self.expected = [message.id for message in sorted(messages, key=lambda message: (message.timestamp, message.id))]
+        self.url = reverse('groupchat:chat_history', args=[group.id])
+
+    def page(self, **params):
+        response = self.client.get(self.url, {'limit': 2, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_cursors_walk_ties_without_duplicates_or_gaps(self):
+        page = self.page()
+        older = [message['id'] for message in page['messages']]
+        while page['older_cursor']:
+            page = self.page(before=page['older_cursor'])
+            older = [message['id'] for message in page['messages']] + older
+        self.assertEqual(older, self.expected)
+
+        first = self.expected[0]
+        cursor = next(message['cursor'] for message in self.page(limit=200)['messages'] if message['id'] == first)
+        newer = [first]
+        while cursor:
+            page = self.page(after=cursor)
+            newer += [message['id'] for message in page['messages']]
+            cursor = page['newer_cursor']
+        self.assertEqual(newer, self.expected)
+
+    def test_malformed_cursor_is_rejected(self):
+        self.assertEqual(self.client.get(self.url, {'before': 'not a cursor'}).status_code, 400)
+
+
+class SearchArchiveTests(TestCase):
+
+    def setUp(self):
+        cache.clear() # Row ids are reused after rollbacks; drop membership flags of earlier tests
+        self.fixture = ChatFixture(members=1)
+        user, group = self.fixture.users[0], self.fixture.group
+        self.client.force_login(user)
+        self.old = GroupChatMessage.objects.create(user=user, group=group, text_content='an archived wombat')
+        GroupChatMessage.objects.filter(pk=self.old.pk).update(timestamp=datetime.datetime(2020, 3, 5, tzinfo=datetime.timezone.utc))
+        GroupChatMessage.objects.create(user=user, group=group, text_content='a recent wombat')
+        self.url = reverse('groupchat:chat_search', args=[group.id])
+
+    def test_reports_how_far_back_search_reached(self):
+        self.assertIsNone(self.client.get(self.url, {'q': 'wombat'}).json()['searched_until'])
+        archive_group(self.fixture.group)
+        response = self.client.get(self.url, {'q': 'wombat'}).json()
+        self.assertEqual(response['searched_until'], '2020-03-05T00:00:00+00:00')
+        self.assertEqual([result['text'] for result in response['results']], ['a recent wombat'])
+
+
+class ReadMarkerTests(TestCase):
+
+    def setUp(self):
+        self.fixture = ChatFixture(members=1)
+        self.user, group = self.fixture.users[0], self.fixture.group
+        self.first, self.second = (
+            GroupChatMessage.objects.create(user=self.user, group=group, text_content=text) for text in ('one', 'two')
+        )
+        self.membership = GroupMembership.objects.get(user=self.user, group=group)
+
+    def watermark(self):
+        self.membership.refresh_from_db()
+        return self.membership.last_read_message_id
+
+    async def flush_marks(self, *marks):
+        marker = ReadMarker(flush_interval=3600)
+        for message, with_timestamp in marks:
+            marker.mark(self.user.id, self.fixture.group.id, message.id, message.timestamp if with_timestamp else None)
+        await marker.flush()
+        marker._task.cancel()
+
+    async def test_out_of_order_mark_does_not_move_back(self):
+        for with_timestamp in (True, False):
+            await self.flush_marks((self.second, with_timestamp), (self.first, with_timestamp))
+            self.assertEqual(await sync_to_async(self.watermark)(), self.second.id)
+
+    async def test_flush_does_not_overwrite_a_further_watermark(self):
+        # Another worker already wrote a further mark.
+        await GroupMembership.objects.filter(pk=self.membership.pk).aupdate(
+            last_read=self.second.timestamp, last_read_message_id=self.second.id
+        )
+        await self.flush_marks((self.first, False))
+        self.assertEqual(await sync_to_async(self.watermark)(), self.second.id)
+
+
+@override_settings(
+    GROUPCHAT_AFFINITY_POOLS={'a': '/chat-a', 'b': '/chat-b', 'c': '/chat-c'},
+    GROUPCHAT_AFFINITY_DEDICATED_POOLS={'hot': '/chat-hot'}, GROUPCHAT_AFFINITY_REPORT_INTERVAL=0,
+)
+class AffinityTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_ring_spreads_rooms_and_moves_only_a_removed_pools_rooms(self):
+        keys = [f'chat_{group_id}' for group_id in range(6000)]
+        ring = HashRing(['a', 'b', 'c'])
+        before = {key: ring.lookup(key) for key in keys}
+        for pool in 'abc':
+            self.assertAlmostEqual(list(before.values()).count(pool) / len(keys), 1 / 3, delta=0.06)
+        after = HashRing(['a', 'b']).lookup
+        self.assertTrue(all(after(key) == pool for key, pool in before.items() if pool != 'c'))
+
+    def test_pins_override_the_ring_until_unpinned_or_expired(self):
+        hashed = route(7)
+        pin(7, 'hot')
+        self.assertEqual(route(7), 'hot')
+        self.assertTrue(unpin(7))
+        self.assertFalse(unpin(7))
+        self.assertEqual(route(7), hashed)
+
+        pin(7, 'hot', ttl=60)
+        self.assertEqual(pins([7, 8]), {7: {'pool': 'hot', 'expires': mock.ANY}})
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertEqual(route(7), hashed)
+        with self.assertRaises(ValueError):
+            pin(7, 'nowhere')
+
+    def test_concurrent_reports_keep_every_worker(self):
+        workers = 16
+        barrier = threading.Barrier(workers)
+
+        def report(index):
+            for _ in range(5):
+                barrier.wait()
+                publish_load(f'host:{index}', {1: (1.0, 2.0, 1), 100 + index: (0.5, 0.5, 1)}, 60)
+
+        def slow_get(*args, **kwargs):
+            value = cache.get(*args, **kwargs)
+            time.sleep(0.005) # Lets the other workers' writes land between a read and the write after it
+            return value
+
+        threads = [threading.Thread(target=report, args=(index,)) for index in range(workers)]
+        with mock.patch('groupchat.affinity.cache', mock.Mock(wraps=cache, get=slow_get)):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        loads = {load['group']: load for load in room_loads()}
+        self.assertEqual(len(loads), workers + 1)
+        self.assertEqual((loads[1]['workers'], loads[1]['rate'], loads[1]['sockets']), (workers, 16.0, workers))
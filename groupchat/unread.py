@@ -0,0 +1,229 @@
+"""
+Read watermarks and unread counts for chat.
+
+Each `GroupMembership` carries a read watermark, the `(last_read,
+last_read_message_id)` position of the last message its user has read. It is
+unset until the first read, which counts everything since `date_joined` as
+unread. Clients advance it with a `{'type': 'read', 'id': <message id>}`
+frame on the chat socket, and sending a message advances the sender's own.
+
+Watermark writes are batched: the per-process `ReadMarker` keeps only the
+furthest mark per membership and writes the accumulated marks every
+`GROUPCHAT_READ_FLUSH_INTERVAL` seconds with one lookup of the marked
+messages' timestamps and one conditional UPDATE, so a user scrolling through
+a busy room costs at most one row update per interval. Marks only ever move
+a watermark forward: a mark arriving out of order does not replace a further
+one, and the UPDATE only touches rows whose stored watermark is older, so
+workers flushing the same membership cannot move it back. A mark whose
+message is not stored yet (e.g. still queued by the write-behind writer) is
+retried at the next flush, then dropped.
+
+Unread counts are not stored. `unread_counts` computes them for all of a
+user's groups in one query, each a range scan over the
+`(group, timestamp, id)` history index that stops one past
+`GROUPCHAT_UNREAD_CAP` messages, so a badge never costs more than the cap to
+count.
+
+Settings:
+    GROUPCHAT_READ_FLUSH_INTERVAL (float): Seconds between watermark writes. Defaults to 5.
+    GROUPCHAT_UNREAD_CAP (int): Highest count computed; badges show "99+" beyond it. Defaults to 99.
+"""
+import asyncio
+import logging
+import weakref
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import BigIntegerField, Case, DateTimeField, Q, Value, When
+from discussions.models import GroupMembership
+from .models import GroupChatMessage
+
+logger = logging.getLogger(__name__)
+
+stats = {'marks': 0, 'flushes': 0, 'advanced': 0, 'dropped': 0}
+
+LOOKUP_CHUNK = 200 # memberships per UPDATE; one OR term each, and SQLite caps expression depth at 1000
+
+UNREAD_SQL = f"""
+    SELECT gm.group_id, (
+        SELECT COUNT(*) FROM (
+            SELECT 1 FROM {GroupChatMessage._meta.db_table} m
+            WHERE m.group_id = gm.group_id
+              AND (m.timestamp > COALESCE(gm.last_read, gm.date_joined)
+                   OR (m.timestamp = gm.last_read AND m.id > gm.last_read_message_id))
+            LIMIT %s
+        ) unread
+    )
+    FROM {GroupMembership._meta.db_table} gm
+    WHERE gm.user_id = %s
+"""
+
+
+def unread_cap():
+    """Returns the highest unread count `unread_counts` computes."""
+    return getattr(settings, 'GROUPCHAT_UNREAD_CAP', 99)
+
+
+def unread_counts(user_id):
+    """
+    Counts the unread chat messages in every group the user is a member of.
+
+    Args:
+        user_id (int): ID of the user.
+
+    Returns:
+        dict: `{group_id: count}` for every membership; counts stop at
+              `unread_cap() + 1`, meaning "more than the cap".
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(UNREAD_SQL, [unread_cap() + 1, user_id])
+        return dict(cursor.fetchall())
+
+
+def unread_badge(count):
+    """Returns the badge text for an unread count: '' for none, e.g. '99+' above the cap."""
+    cap = unread_cap()
+    if not count:
+        return ''
+    return f'{cap}+' if count > cap else str(count)
+
+
+class ReadMarker:
+    """
+    Collects read marks and writes them to the memberships' watermarks in
+    batches. Bound to one event loop; use `get_read_marker()`.
+    """
+
+    RETRIES = 1 # flushes a mark waits for its message to be stored
+    MAX_CANDIDATES = 8 # marks kept per membership until a flush looks up which is furthest
+
+    def __init__(self, flush_interval=None):
+        self.flush_interval = flush_interval if flush_interval is not None else getattr(
+            settings, 'GROUPCHAT_READ_FLUSH_INTERVAL', 5.0
+        )
+        self._pending = {} # (user_id, group_id) -> {message_id: [timestamp or None, retries left]}
+        self._task = None
+
+    def mark(self, user_id, group_id, message_id, timestamp=None):
+        """
+        Records that the user has read the group's messages up to `message_id`.
+
+        Args:
+            user_id (int): ID of the reader.
+            group_id (int or str): ID of the discussion group.
+            message_id (int): ID of the newest message read.
+            timestamp (datetime, optional): The message's timestamp, when known;
+                saves looking it up.
+        """
+        stats['marks'] += 1
+        self._merge((user_id, int(group_id)), message_id, timestamp, self.RETRIES)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def _merge(self, key, message_id, timestamp, retries):
+        """
+        Adds a mark to a membership's pending ones, keeping only the furthest
+        of those with a known position. Marks still to be looked up are kept
+        until the flush can compare them.
+        """
+        candidates = self._pending.setdefault(key, {})
+        if message_id in candidates and candidates[message_id][0] is not None:
+            return
+        candidates[message_id] = [timestamp, retries]
+        known = [(timestamp, message_id) for message_id, (timestamp, _) in candidates.items() if timestamp is not None]
+        for _, stale_id in sorted(known)[:-1]:
+            del candidates[stale_id]
+        if len(candidates) > self.MAX_CANDIDATES:
+            del candidates[min(candidates)] # Ids roughly follow time; the lowest is the least likely to be furthest
+
+    def pending_count(self):
+        """Number of memberships with an unwritten mark."""
+        return len(self._pending)
+
+    async def _run(self):
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error("Read watermarks could not be written: %s", e)
+
+    async def flush(self):
+        """Writes the pending marks that move a watermark forward."""
+        marks, self._pending = self._pending, {}
+        if not marks:
+            return
+        stats['flushes'] += 1
+
+        # Resolve the positions of marks that came without a timestamp, checking the message's group.
+        lookup = [message_id for candidates in marks.values() for message_id, (timestamp, _) in candidates.items() if timestamp is None]
+        found = {}
+        if lookup:
+            found = {
+                message_id: (group_id, timestamp)
+                async for message_id, group_id, timestamp in
+                GroupChatMessage.objects.filter(id__in=lookup).values_list('id', 'group_id', 'timestamp')
+            }
+        positions = {}
+        for key, candidates in marks.items():
+            for message_id, (timestamp, retries) in candidates.items():
+                if timestamp is None:
+                    group_id, timestamp = found.get(message_id, (None, None))
+                    if timestamp is None and retries:
+                        self._merge(key, message_id, None, retries - 1)
+                        continue
+                    if group_id != key[1]:
+                        stats['dropped'] += 1
+                        continue
+                positions[key] = max(positions.get(key, (timestamp, message_id)), (timestamp, message_id))
+        if positions:
+            stats['advanced'] += await self._advance(positions)
+        if self._pending and (self._task is None or self._task.done()):
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+
+    async def _advance(self, positions):
+        """
+        Moves the watermarks of `{(user_id, group_id): (timestamp, message_id)}`
+        forward in one UPDATE per `LOOKUP_CHUNK` memberships, matching only rows
+        whose stored watermark is unset or older.
+
+        Returns:
+            int: The number of watermarks that moved.
+        """
+        keys, updated = list(positions), 0
+        for start in range(0, len(keys), LOOKUP_CHUNK):
+            chunk = keys[start:start + LOOKUP_CHUNK]
+            behind = reduce(or_, (
+                Q(user_id=user_id, group_id=group_id) & (
+                    Q(last_read__isnull=True) | Q(last_read__lt=positions[user_id, group_id][0])
+                    | Q(last_read=positions[user_id, group_id][0], last_read_message_id__lt=positions[user_id, group_id][1])
+                    | Q(last_read=positions[user_id, group_id][0], last_read_message_id__isnull=True)
+                )
+                for user_id, group_id in chunk
+            ))
+            updated += await GroupMembership.objects.filter(behind).aupdate(
+                last_read=Case(*(
+                    When(user_id=user_id, group_id=group_id, then=Value(positions[user_id, group_id][0]))
+                    for user_id, group_id in chunk
+                ), output_field=DateTimeField()),
+                last_read_message_id=Case(*(
+                    When(user_id=user_id, group_id=group_id, then=Value(positions[user_id, group_id][1]))
+                    for user_id, group_id in chunk
+                ), output_field=BigIntegerField()),
+            )
+        return updated
+
+
+_markers = weakref.WeakKeyDictionary()
+
+
+def get_read_marker():
+    """Returns the `ReadMarker` bound to the running event loop, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    marker = _markers.get(loop)
+    if marker is None:
+        marker = _markers[loop] = ReadMarker()
+    return marker
@@ -0,0 +1,304 @@
+"""
+Resumable chunked file uploads over the chat WebSocket.
+
+Protocol (field names as in `wire.FIELD_CODES`):
+
+1.  The client sends `{'type': 'upload.start', 'temp_id', 'file_name', 'size',
+    'message'?, 'upload_id'?}`. Passing the `upload_id` of an earlier,
+    unfinished upload resumes it.
+2.  The server answers `{'type': 'upload.ready', 'upload_id', 'offset',
+    'chunk_size', 'window'}`; `offset` is the number of bytes it already holds.
+3.  The client streams binary chunk frames (see `encode_chunk`) starting at
+    `offset`, each at most `chunk_size` bytes, keeping no more than `window`
+    chunks unacknowledged.
+4.  Every chunk is written to a temp file before the server answers
+    `{'type': 'upload.ack', 'upload_id', 'offset'}`. An ack whose offset is
+    lower than what the client sent means the chunk was out of order and the
+    client must rewind to it.
+5.  Once `size` bytes arrived the file is moved into
+    `GroupChatMessage.file_attachment` and broadcast like any other message.
+
+Because the consumer handles one frame at a time and only acknowledges after
+the disk write, the window is the backpressure: at most `window * chunk_size`
+bytes of an upload are ever in memory.
+
+Partial uploads survive disconnects in `GROUPCHAT_UPLOAD_TEMP_DIR`, one
+subdirectory per user, and are purged once untouched for
+`GROUPCHAT_UPLOAD_EXPIRY` seconds. A user's unfinished uploads may announce
+at most `GROUPCHAT_UPLOAD_USER_QUOTA` bytes between them, whichever
+connections they arrive on.
+"""
+import json
+import os
+import struct
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+from django.core.files import File
+from django.utils.text import get_valid_filename
+from .attachments import schedule_derivatives
+from .models import GroupChatMessage
+
+# First byte of a binary chunk frame. 0xC1 is never used by msgpack and is not
+# valid UTF-8, so chunk frames cannot be mistaken for msgpack or JSON frames.
+CHUNK_MARKER = b'\xc1'
+_CHUNK_HEADER = struct.Struct('>16sQ') # upload id (UUID bytes), byte offset
+
+DEFAULT_CHUNK_SIZE = 256 * 1024
+DEFAULT_WINDOW = 4
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+DEFAULT_USER_QUOTA = 512 * 1024 * 1024
+DEFAULT_EXPIRY = 60 * 60
+PURGE_INTERVAL = 5 * 60 # seconds between sweeps for expired partial uploads
+
+_last_purge = 0.0
+
+
+class UploadError(ValueError):
+    """Raised when an upload request or chunk is invalid."""
+
+
+def chunk_size():
+    """Maximum payload of one chunk frame, in bytes."""
+    return getattr(settings, 'GROUPCHAT_UPLOAD_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+
+def window():
+    """Number of chunks a client may send ahead of the last acknowledgement."""
+    return getattr(settings, 'GROUPCHAT_UPLOAD_WINDOW', DEFAULT_WINDOW)
+
+
+def upload_dir():
+    """Directory holding partial uploads; created on first use."""
+    path = getattr(settings, 'GROUPCHAT_UPLOAD_TEMP_DIR', None) or os.path.join(
+        settings.FILE_UPLOAD_TEMP_DIR or tempfile.gettempdir(), 'groupchat-uploads'
+    )
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def user_upload_dir(user_id):
+    """Directory holding one user's partial uploads; created on first use."""
+    path = os.path.join(upload_dir(), str(int(user_id)))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def expiry():
+    """Seconds a partial upload may go untouched before it is purged."""
+    return getattr(settings, 'GROUPCHAT_UPLOAD_EXPIRY', DEFAULT_EXPIRY)
+
+
+def is_chunk_frame(bytes_data):
+    """Returns True if a binary frame is an upload chunk."""
+    return bytes_data is not None and bytes_data[:1] == CHUNK_MARKER
+
+
+def encode_chunk(upload_id, offset, data):
+    """Builds the binary frame carrying `data` at `offset` of upload `upload_id`."""
+    return CHUNK_MARKER + _CHUNK_HEADER.pack(uuid.UUID(upload_id).bytes, offset) + data
+
+
+def decode_chunk(bytes_data):
+    """
+    Splits a chunk frame.
+
+    Returns:
+        tuple: `(upload_id, offset, data)`, with `data` a memoryview of the frame.
+
+    Raises:
+        UploadError: If the frame is too short or the chunk exceeds the chunk size.
+    """
+    header_end = len(CHUNK_MARKER) + _CHUNK_HEADER.size
+    if len(bytes_data) < header_end:
+        raise UploadError("Truncated upload chunk.")
+    raw_id, offset = _CHUNK_HEADER.unpack_from(bytes_data, len(CHUNK_MARKER))
+    data = memoryview(bytes_data)[header_end:]
+    if len(data) > chunk_size():
+        raise UploadError(f"Upload chunks may not exceed {chunk_size()} bytes.")
+    return uuid.UUID(bytes=raw_id).hex, offset, data
+
+
+def _last_touched(directory, upload_id):
+    """Returns when an upload's part file (or, before any chunk, its metadata) last changed, or None if it is gone."""
+    for suffix in ('.part', '.json'):
+        try:
+            return os.path.getmtime(os.path.join(directory, upload_id + suffix))
+        except OSError:
+            pass
+    return None
+
+
+def purge_stale_uploads(max_age=None):
+    """
+    Deletes partial uploads untouched for `max_age` seconds (default
+    `GROUPCHAT_UPLOAD_EXPIRY`). An upload's metadata goes with its part file,
+    so a long upload that is still receiving chunks is kept whole.
+
+    Returns:
+        int: The number of uploads removed.
+    """
+    cutoff = time.time() - (max_age if max_age is not None else expiry())
+    removed = 0
+    for directory, _, names in os.walk(upload_dir()):
+        for upload_id in {os.path.splitext(name)[0] for name in names}:
+            touched = _last_touched(directory, upload_id)
+            if touched is None or touched >= cutoff:
+                continue
+            for suffix in ('.part', '.json'):
+                try:
+                    os.remove(os.path.join(directory, upload_id + suffix))
+                except OSError:
+                    pass # Finalized or purged concurrently.
+            removed += 1
+    return removed
+
+
+def reserved_bytes(user_id):
+    """Returns the sizes announced by a user's partial uploads that have not expired, summed."""
+    directory = user_upload_dir(user_id)
+    cutoff = time.time() - expiry()
+    total = 0
+    for name in os.listdir(directory):
+        upload_id, extension = os.path.splitext(name)
+        if extension != '.json' or (_last_touched(directory, upload_id) or 0) < cutoff:
+            continue
+        try:
+            with open(os.path.join(directory, name)) as meta:
+                total += json.load(meta)['size']
+        except (OSError, ValueError, KeyError):
+            pass # Finalized or purged concurrently.
+    return total
+
+
+class _PartFile(File):
+    """An open part file that storages may move into place instead of copying."""
+
+    def temporary_file_path(self):
+        """Lets `FileSystemStorage` move the part file instead of copying it."""
+        return self.file.name
+
+
+class ChunkedUpload:
+    """
+    One upload being received: its metadata, the open part file and the
+    number of bytes written so far. All methods do blocking I/O and are meant
+    to run in a worker thread.
+    """
+
+    def __init__(self, upload_id, user_id, group_id, file_name, size, text=None, temp_id=None):
+        self.upload_id = upload_id
+        self.user_id = user_id
+        self.group_id = int(group_id)
+        self.file_name = file_name
+        self.size = size
+        self.text = text
+        self.temp_id = temp_id
+        self.part_path = os.path.join(user_upload_dir(user_id), f'{upload_id}.part')
+        self.meta_path = os.path.join(user_upload_dir(user_id), f'{upload_id}.json')
+        self._file = None
+        self.offset = 0
+
+    @classmethod
+    def open(cls, user_id, group_id, file_name, size, upload_id=None, text=None, temp_id=None):
+        """
+        Starts a new upload, or resumes `upload_id` if it belongs to the same
+        user, group and file.
+
+        Raises:
+            UploadError: If the file name or size is invalid, or a new upload
+                would take the user past `GROUPCHAT_UPLOAD_USER_QUOTA`.
+        """
+        global _last_purge
+        if time.monotonic() - _last_purge > PURGE_INTERVAL:
+            _last_purge = time.monotonic()
+            purge_stale_uploads()
+
+        max_size = getattr(settings, 'GROUPCHAT_UPLOAD_MAX_SIZE', DEFAULT_MAX_SIZE)
+        if not isinstance(size, int) or not 0 < size <= max_size:
+            raise UploadError(f"Uploads must be between 1 byte and {max_size} bytes.")
+        try:
+            file_name = get_valid_filename(os.path.basename(str(file_name or '')))
+        except Exception as e:
+            raise UploadError("Invalid file name.") from e
+
+        upload = cls._resume(upload_id, user_id, group_id, file_name, size, text, temp_id)
+        if upload is None:
+            quota = getattr(settings, 'GROUPCHAT_UPLOAD_USER_QUOTA', DEFAULT_USER_QUOTA)
+            if reserved_bytes(user_id) + size > quota:
+                raise UploadError(f"Unfinished uploads may not exceed {quota} bytes; finish or cancel one first.")
+            upload = cls(uuid.uuid4().hex, user_id, group_id, file_name, size, text, temp_id)
+            with open(upload.meta_path, 'w') as meta:
+                json.dump({
+                    'user_id': user_id, 'group_id': upload.group_id, 'file_name': file_name, 'size': size,
+                }, meta)
+        upload._file = open(upload.part_path, 'ab')
+        upload.offset = upload._file.tell()
+        return upload
+
+    @classmethod
+    def _resume(cls, upload_id, user_id, group_id, file_name, size, text, temp_id):
+        try:
+            upload_id = uuid.UUID(str(upload_id)).hex
+        except ValueError:
+            return None
+        upload = cls(upload_id, user_id, group_id, file_name, size, text, temp_id)
+        try:
+            with open(upload.meta_path) as meta:
+                stored = json.load(meta)
+        except (OSError, ValueError):
+            return None
+        expected = {'user_id': user_id, 'group_id': upload.group_id, 'file_name': file_name, 'size': size}
+        return upload if stored == expected else None
+
+    @property
+    def complete(self):
+        return self.offset >= self.size
+
+    def write(self, data):
+        """
+        Appends `data` at the current offset.
+
+        Raises:
+            UploadError: If the data would exceed the announced size.
+        """
+        if self.offset + len(data) > self.size:
+            raise UploadError("Upload exceeds its announced size.")
+        self._file.write(data)
+        self.offset += len(data)
+
+    def close(self):
+        """Closes the part file, keeping it for a later resume."""
+        if self._file and not self._file.closed:
+            self._file.close()
+
+    def discard(self):
+        """Closes and deletes the partial upload."""
+        self.close()
+        for path in (self.part_path, self.meta_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def finalize(self):
+        """
+        Stores the completed file as a new message's attachment.
+
+        The part file is handed to the storage as a temporary file, so the
+        default file system storage moves it into `MEDIA_ROOT` instead of
+        copying it. Images get their derivatives queued.
+
+        Returns:
+            GroupChatMessage: The saved message.
+        """
+        self.close()
+        message = GroupChatMessage(user_id=self.user_id, group_id=self.group_id, text_content=self.text or None)
+        with _PartFile(open(self.part_path, 'rb'), name=self.file_name) as part:
+            message.file_attachment.save(self.file_name, part, save=False)
+        message.save()
+        self.discard()
+        schedule_derivatives(message)
+        return message
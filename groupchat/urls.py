@@ -10,4 +10,8 @@ app_name = 'groupchat'
 
 urlpatterns = [
     path('group/<int:group_id>/chat/', views.group_chat_view, name='group_chat_view'),
+    path('group/<int:group_id>/chat/history/', views.chat_history_api, name='chat_history'),
+    path('group/<int:group_id>/chat/search/', views.chat_search_api, name='chat_search'),
+    path('group/<int:group_id>/chat/attachment/<int:message_id>/', views.chat_attachment_view, name='chat_attachment'),
+    path('chat/metrics/', views.chat_metrics_view, name='chat_metrics'),
 ] 
\ No newline at end of file
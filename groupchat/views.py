@@ -5,25 +5,33 @@ This module contains views for rendering the chat interface,
 handling message submissions, and managing user interactions
 within group chats.
 """
+import hmac
+
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseForbidden, JsonResponse # JsonResponse for potential AJAX later
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse # JsonResponse for potential AJAX later
+from django.views.decorators.http import require_safe
 from django.conf import settings # Import settings
 from django.contrib import messages as django_messages # Alias to avoid conflict with model field
-from discussions.models import DiscussionGroup, GroupMembership
-from .models import GroupChatMessage
+from discussions.membership import is_member
+from discussions.models import DiscussionGroup
+from . import metrics
+from .affinity import pool_address, room_stats, route
+from .archive import archived_until, find_message as find_archived_message
+from .attachments import schedule_derivatives, serve_attachment
+from .history import InvalidCursor, encode_cursor, fetch_page, serialize_message
 from .forms import MessageForm # Import the new form
+from .models import GroupChatMessage
+from .search import InvalidSearch, SearchUnavailable, search_messages
 
 @login_required
 def group_chat_view(request, group_id):
     """
     Handles displaying the chat interface for a specific group and processing new messages.
     """
-    group = get_object_or_404(DiscussionGroup, id=group_id)
+    group = get_object_or_404(DiscussionGroup.objects.select_related('content_item__book'), id=group_id)
     
-    try:
-        GroupMembership.objects.get(user=request.user, group=group)
-    except GroupMembership.DoesNotExist:
+    if not is_member(request.user.id, group.id):
         django_messages.error(request, "You are not a member of this group and cannot view its chat.")
         # Consider redirecting to a more appropriate page, like dashboard or group list
         return redirect('dashboard:index', username=request.user.username) 
@@ -36,6 +44,7 @@ def group_chat_view(request, group_id):
             message.group = group
             try:
                 message.save()
+                schedule_derivatives(message)
                 # django_messages.success(request, "Message sent!") # Optional success message
             except Exception as e:
                 django_messages.error(request, f"Could not send message: {e}")
@@ -71,16 +80,125 @@ def group_chat_view(request, group_id):
         form = MessageForm()
     # For an invalid POST, `form` is already the bound form from above.
 
-    chat_messages = GroupChatMessage.objects.filter(group=group).select_related('user').order_by('timestamp')
+    # Only the latest page is rendered; older pages are fetched from chat_history_api on scroll.
+    chat_messages, has_older = fetch_page(group.id)
+    pool = route(group.id)
     
     context = {
         'group': group,
         'messages': chat_messages, # Renamed to avoid conflict if 'messages' context processor is used by Django messages
+        'older_cursor': encode_cursor(chat_messages[0]) if has_older else '',
         'form': form, 
         'platform_name': settings.PLATFORM_NAME,
+        'chat_socket_base': pool_address(pool) if pool else '', # The room's worker pool with affinity routing (see affinity.py)
     }
     return render(request, 'groupchat/group_chat_interface.html', context)
 
+@login_required
+def chat_history_api(request, group_id):
+    """
+    Returns one page of a group's chat history as JSON.
+
+    Query parameters:
+        before: Cursor; return the page of messages older than it.
+        after: Cursor; return the page of messages newer than it.
+        limit: Page size (clamped to GROUPCHAT_HISTORY_MAX_PAGE_SIZE).
+
+    Without a cursor the latest page is returned. Messages are always in
+    chronological order; `older_cursor`/`newer_cursor` address the adjacent
+    pages and are null when no such page exists.
+    """
+    if not is_member(request.user.id, group_id):
+        return JsonResponse({'error': 'You are not a member of this group.'}, status=403)
+
+    before = request.GET.get('before')
+    after = request.GET.get('after')
+    try:
+        page, has_more = fetch_page(group_id, before=before, after=after, limit=request.GET.get('limit'))
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    has_older = has_more if not after else True
+    has_newer = has_more if after else bool(before)
+    return JsonResponse({
+        'messages': [serialize_message(message) for message in page],
+        'older_cursor': encode_cursor(page[0]) if page and has_older else None,
+        'newer_cursor': encode_cursor(page[-1]) if page and has_newer else None,
+    })
+
+@login_required
+@require_safe
+def chat_attachment_view(request, group_id, message_id):
+    """
+    Downloads the attachment of a chat message, for members of its group.
+
+    Supports Range, ETag and Last-Modified, or hands the bytes to the front
+    proxy with GROUPCHAT_ATTACHMENT_SENDFILE (see attachments.py). With
+    `?size=thumb` or `?size=preview`, images are served scaled down.
+    """
+    if not is_member(request.user.id, group_id):
+        return HttpResponseForbidden("You are not a member of this group.")
+    message = (
+        GroupChatMessage.objects.only('id', 'group_id', 'file_attachment').filter(id=message_id, group_id=group_id).first()
+        or find_archived_message(group_id, message_id)
+    )
+    if message is None:
+        raise Http404("No such message.")
+    if not message.file_attachment:
+        raise Http404("This message has no attachment.")
+    return serve_attachment(request, message, size=request.GET.get('size'))
+
+@login_required
+def chat_search_api(request, group_id):
+    """
+    Searches a group's chat history and returns one page of ranked results as JSON.
+
+    Query parameters:
+        q: The search text.
+        cursor: `next_cursor` of the previous page.
+        limit: Page size (clamped to GROUPCHAT_HISTORY_MAX_PAGE_SIZE).
+
+    Each result carries the message (as in chat_history_api), its `rank` and
+    an HTML `snippet` with the matches wrapped in <mark>; its `cursor` is a
+    chat_history_api cursor for loading the conversation around it.
+    `next_cursor` is null on the last page. Archived messages are not
+    searched: `searched_until` is the time of the newest one, so only
+    messages sent after it can be found, and is null while nothing is archived.
+    """
+    if not is_member(request.user.id, group_id):
+        return JsonResponse({'error': 'You are not a member of this group.'}, status=403)
+
+    try:
+        results, next_cursor = search_messages(
+            group_id, request.GET.get('q'), cursor=request.GET.get('cursor'), limit=request.GET.get('limit')
+        )
+    except InvalidSearch as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except SearchUnavailable as e:
+        return JsonResponse({'error': str(e)}, status=501)
+    until = archived_until(group_id)
+    return JsonResponse({
+        'results': results, 'next_cursor': next_cursor, 'searched_until': until.isoformat() if until else None,
+    })
+
+@require_safe
+def chat_metrics_view(request):
+    """
+    Exposes this process's chat latency histograms and counters, as JSON or,
+    with `?format=prometheus`, as Prometheus text. Staff users and requests
+    bearing `GROUPCHAT_METRICS_TOKEN` only.
+    """
+    token = getattr(settings, 'GROUPCHAT_METRICS_TOKEN', None)
+    has_token = bool(token) and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not (has_token or request.user.is_staff):
+        return HttpResponseForbidden("Metrics require a staff account or the metrics token.")
+
+    sections = metrics.counters()
+    if request.GET.get('format') == 'prometheus':
+        gauges = {f'{section}_{key}': value for section, values in sections.items() for key, value in values.items()}
+        return HttpResponse(metrics.prometheus_text(gauges), content_type='text/plain; version=0.0.4')
+    return JsonResponse({'stages': metrics.snapshot(), **sections, 'rooms': room_stats})
+
 # Placeholder view until implementation starts
 from django.http import HttpResponse
 def placeholder_view(request):
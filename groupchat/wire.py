@@ -0,0 +1,144 @@
+"""
+Wire formats for chat WebSocket frames.
+
+Clients that offer the `bookhaven.chat.v1+msgpack` subprotocol get binary
+msgpack frames with one- or two-letter field codes and integer millisecond
+epoch timestamps; everyone else keeps the original JSON text frames.
+
+Broadcast events carry each frame pre-encoded in every format
+(`encode_for_broadcast`), so a message fanned out to a large room is
+serialized once per format instead of once per recipient. `encode_batch`
+joins such pre-encoded frames into one array frame without decoding them.
+"""
+import json
+from datetime import datetime
+
+import msgpack
+
+MSGPACK_SUBPROTOCOL = 'bookhaven.chat.v1+msgpack'
+
+# Long field name -> short code used by the msgpack format.
+FIELD_CODES = {
+    'type': 'y',
+    'message_type': 'm',
+    'id': 'i',
+    'temp_id': 't',
+    'user_id': 'u',
+    'username': 'n',
+    'user_full_name': 'f',
+    'text': 'x',
+    'message': 'g',
+    'timestamp': 's',
+    'file_url': 'fu',
+    'file_name': 'fn',
+    'cursor': 'c',
+    'replayed': 'r',
+    'truncated': 'tr',
+    'error': 'e',
+    'upload_id': 'ui',
+    'offset': 'o',
+    'online': 'on',
+    'offline': 'of',
+    'typing': 'ty',
+    'snapshot': 'sn',
+    'heartbeat': 'hb',
+    'code': 'cd',
+    'retry_after': 'ra',
+    'count': 'ct',
+    'group': 'gr',
+    'last_id': 'li',
+}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+_packer = msgpack.Packer()
+
+
+def _epoch_ms(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return int(value.timestamp() * 1000)
+
+
+class JsonCodec:
+    """The original JSON text frames with long field names and ISO timestamps."""
+
+    name = 'json'
+    subprotocol = None
+
+    def encode(self, frame):
+        """Returns `frame` as JSON text."""
+        return json.dumps(frame)
+
+    def decode(self, text_data=None, bytes_data=None):
+        """Parses an incoming frame; raises ValueError if it is not valid JSON."""
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+    def encode_batch(self, payloads):
+        """Joins encoded frames into one JSON array."""
+        return '[' + ','.join(payloads) + ']'
+
+    def send_kwargs(self, payload):
+        """Returns the `send()` keyword arguments carrying an encoded payload."""
+        return {'text_data': payload}
+
+
+class MsgpackCodec:
+    """Binary msgpack frames with short field codes and epoch-millisecond timestamps."""
+
+    name = 'msgpack'
+    subprotocol = MSGPACK_SUBPROTOCOL
+
+    def encode(self, frame):
+        """Returns `frame` as msgpack bytes with short field codes."""
+        compact = {}
+        for key, value in frame.items():
+            if key == 'timestamp' and value is not None:
+                value = _epoch_ms(value)
+            compact[FIELD_CODES.get(key, key)] = value
+        return msgpack.packb(compact, use_bin_type=True)
+
+    def decode(self, text_data=None, bytes_data=None):
+        """Unpacks an incoming frame back to long field names; raises ValueError on bad input."""
+        if bytes_data is None:
+            raise ValueError("msgpack frames must be sent as binary messages.")
+        try:
+            compact = msgpack.unpackb(bytes_data, raw=False)
+        except Exception as e:
+            raise ValueError(f"Invalid msgpack frame: {e}") from e
+        if not isinstance(compact, dict):
+            raise ValueError("msgpack frames must be maps.")
+        return {FIELD_NAMES.get(key, key): value for key, value in compact.items()}
+
+    def encode_batch(self, payloads):
+        """Joins encoded frames into one msgpack array (an array header followed by its packed items)."""
+        return _packer.pack_array_header(len(payloads)) + b''.join(payloads)
+
+    def send_kwargs(self, payload):
+        """Returns the `send()` keyword arguments carrying an encoded payload."""
+        return {'bytes_data': payload}
+
+
+CODECS = (JsonCodec(), MsgpackCodec())
+DEFAULT_CODEC = CODECS[0]
+
+
+def negotiate_codec(offered_subprotocols):
+    """
+    Picks the codec for a connection from the subprotocols the client offered.
+
+    Args:
+        offered_subprotocols (list): `scope['subprotocols']` of the handshake.
+
+    Returns:
+        The matching codec, or the JSON codec when none matches.
+    """
+    for codec in CODECS:
+        if codec.subprotocol and codec.subprotocol in (offered_subprotocols or ()):
+            return codec
+    return DEFAULT_CODEC
+
+
+def encode_for_broadcast(frame):
+    """Returns `{codec name: encoded frame}` for every supported codec."""
+    return {codec.name: codec.encode(frame) for codec in CODECS}
+
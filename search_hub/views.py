@@ -14,7 +14,7 @@ def search_discussions_view(request):
     Handles searching and filtering for discussion groups.
     """
     form = DiscussionSearchForm(request.GET or None)
-    results = DiscussionGroup.objects.all().select_related('creator', 'content_item') # Start with all, then filter
+    results = DiscussionGroup.objects.all().select_related('creator', 'content_item__book') # Start with all, then filter
     query = None
     applied_filters = {}
 